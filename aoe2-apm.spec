@@ -31,6 +31,7 @@ a = Analysis(
         'mgz.body',
         'mgz.model',
         'mgz.reference',
+        'apm_preload',  # imported by name by the worker fork server
         'tkinter',
         'tkinter.filedialog',
         'tkinter.messagebox',
@@ -0,0 +1,482 @@
+"""
+Streaming per-player statistics for AOE2 Record APM Analyzer.
+Accumulators are fed one action at a time during the action-counting pass,
+so no per-player action lists need to be kept.
+"""
+
+import heapq
+import math
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from mgz.fast import Action
+
+
+# Burst window lengths in seconds
+DEFAULT_BURST_WINDOWS = (10, 60)
+
+# Number of burst windows reported per player and window length
+DEFAULT_BURST_TOP_K = 3
+
+
+class _BurstState:
+    """Sliding-window state for one player and one window length."""
+
+    __slots__ = ('recent', 'best_count', 'best_end', 'top')
+
+    def __init__(self):
+        self.recent = deque()
+        self.best_count = 0
+        self.best_end = None
+        self.top = []
+
+
+class BurstTracker:
+    """
+    Finds each player's busiest non-overlapping windows of a fixed length.
+
+    Each action is added in timestamp order. Only the actions inside the
+    current window are kept, so memory per player is bounded by the peak
+    action rate rather than the game length, and each action is processed
+    in amortized constant time.
+
+    A window ending at the current action is a candidate. The best candidate
+    is kept until the sliding window no longer overlaps it, at which point
+    it is committed to the player's top-k list.
+    """
+
+    def __init__(self, window_seconds: float, top_k: int = DEFAULT_BURST_TOP_K):
+        """
+        Initialize the tracker.
+
+        Args:
+            window_seconds: Window length in seconds
+            top_k: Number of windows to report per player
+        """
+        self.window_ms = window_seconds * 1000
+        self.top_k = top_k
+        self._players: Dict[int, _BurstState] = {}
+
+    def add(self, player_number: int, timestamp_ms: float):
+        """Add an action at the given game time."""
+        state = self._players.get(player_number)
+        if state is None:
+            state = self._players[player_number] = _BurstState()
+
+        recent = state.recent
+        recent.append(timestamp_ms)
+        window_start = timestamp_ms - self.window_ms
+        while recent[0] <= window_start:
+            recent.popleft()
+
+        if state.best_end is not None and window_start >= state.best_end:
+            self._commit(state)
+
+        if len(recent) > state.best_count:
+            state.best_count = len(recent)
+            state.best_end = timestamp_ms
+
+    def _commit(self, state: _BurstState):
+        """Move the current best window into the player's top-k heap."""
+        entry = (state.best_count, -state.best_end)
+        if len(state.top) < self.top_k:
+            heapq.heappush(state.top, entry)
+        elif entry > state.top[0]:
+            heapq.heapreplace(state.top, entry)
+
+        state.best_count = 0
+        state.best_end = None
+
+    def results(self, player_number: int) -> List[Dict]:
+        """
+        Get a player's top burst windows, busiest first.
+
+        Returns:
+            List of dictionaries with the window's start and end (in seconds),
+            its action count and the equivalent APM
+        """
+        state = self._players.get(player_number)
+        if state is None:
+            return []
+
+        top = list(state.top)
+        if state.best_end is not None:
+            top.append((state.best_count, -state.best_end))
+
+        windows = []
+        for count, negative_end in heapq.nlargest(self.top_k, top):
+            end = -negative_end
+            windows.append({
+                'start_seconds': round(max(end - self.window_ms, 0) / 1000, 1),
+                'end_seconds': round(end / 1000, 1),
+                'actions': count,
+                'apm': round(count / (self.window_ms / 60000), 2)
+            })
+        return windows
+
+
+class BurstDetector:
+    """Tracks burst windows of several lengths at once."""
+
+    def __init__(self, window_seconds: Sequence[float] = DEFAULT_BURST_WINDOWS,
+                 top_k: int = DEFAULT_BURST_TOP_K):
+        """
+        Initialize the detector.
+
+        Args:
+            window_seconds: Window lengths in seconds
+            top_k: Number of windows to report per player and window length
+        """
+        self.trackers = {f"{seconds:g}s": BurstTracker(seconds, top_k) for seconds in window_seconds}
+
+    def add(self, player_number: int, timestamp_ms: float, action_type: Any = None, payload: Dict = None):
+        """Add an action at the given game time."""
+        for tracker in self.trackers.values():
+            tracker.add(player_number, timestamp_ms)
+
+    def results(self, player_number: int) -> Dict[str, List[Dict]]:
+        """Get a player's top burst windows for each window length."""
+        return {label: tracker.results(player_number) for label, tracker in self.trackers.items()}
+
+
+# Interval histogram layout: bucket 0 holds intervals under 1 ms (actions in
+# the same game tick), buckets 1..64 split 1 ms - 65.5 s into log-scale
+# buckets, four per doubling, and the last bucket holds anything longer
+INTERVAL_BUCKETS_PER_DOUBLING = 4
+INTERVAL_MAX_MS = 2 ** 16
+INTERVAL_BUCKETS = 16 * INTERVAL_BUCKETS_PER_DOUBLING + 2
+
+
+class IntervalHistogram:
+    """
+    Log-scale histogram of the time between consecutive actions.
+
+    Buckets are fixed, so histograms from different games can be merged by
+    adding their counts. Percentiles are interpolated within a bucket, so
+    they are accurate to a few percent (each bucket spans a factor of 1.19).
+    """
+
+    __slots__ = ('counts',)
+
+    def __init__(self, counts: Sequence[int] = ()):
+        """
+        Initialize the histogram.
+
+        Args:
+            counts: Optional bucket counts, as returned by to_dict()['counts']
+        """
+        self.counts = [0] * INTERVAL_BUCKETS
+        for index, count in enumerate(counts[:INTERVAL_BUCKETS]):
+            self.counts[index] = count
+
+    @staticmethod
+    def bucket(interval_ms: float) -> int:
+        """Get the bucket index of an interval."""
+        if interval_ms < 1:
+            return 0
+        if interval_ms >= INTERVAL_MAX_MS:
+            return INTERVAL_BUCKETS - 1
+        return int(math.log2(interval_ms) * INTERVAL_BUCKETS_PER_DOUBLING) + 1
+
+    @staticmethod
+    def bucket_bounds(index: int) -> Tuple[float, float]:
+        """Get the lower and upper bound in milliseconds of a bucket."""
+        if index == 0:
+            return 0.0, 1.0
+        if index == INTERVAL_BUCKETS - 1:
+            return float(INTERVAL_MAX_MS), math.inf
+        return (2 ** ((index - 1) / INTERVAL_BUCKETS_PER_DOUBLING),
+                2 ** (index / INTERVAL_BUCKETS_PER_DOUBLING))
+
+    @property
+    def count(self) -> int:
+        """Number of intervals in the histogram."""
+        return sum(self.counts)
+
+    def add(self, interval_ms: float):
+        """Add an interval."""
+        self.counts[self.bucket(interval_ms)] += 1
+
+    def merge(self, other: 'IntervalHistogram') -> 'IntervalHistogram':
+        """Add another histogram's counts to this one, and return it."""
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        return self
+
+    def percentile(self, p: float) -> Optional[float]:
+        """
+        Estimate an interval percentile.
+
+        Args:
+            p: Percentile as a fraction, e.g. 0.95
+
+        Returns:
+            Interval in milliseconds, or None if the histogram is empty
+        """
+        total = self.count
+        if not total:
+            return None
+
+        rank = max(1, math.ceil(p * total))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank:
+                low, high = self.bucket_bounds(index)
+                if index == 0:
+                    return 0.0
+                if high == math.inf:
+                    return low
+                # Interpolate geometrically, treating the bucket's intervals
+                # as spread evenly over it
+                return low * (high / low) ** ((rank - seen - 0.5) / count)
+            seen += count
+        return None
+
+    def to_dict(self) -> Dict:
+        """
+        Summarize the histogram.
+
+        Returns:
+            Dictionary with the interval count, the median, p95 and p99
+            intervals in milliseconds and the bucket counts (trailing empty
+            buckets left out)
+        """
+        summary = {'count': self.count}
+        for label, p in (('median_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+            value = self.percentile(p)
+            summary[label] = round(value, 1) if value is not None else None
+
+        last = max((index for index, count in enumerate(self.counts) if count), default=-1)
+        summary['counts'] = self.counts[:last + 1]
+        return summary
+
+    @classmethod
+    def from_dict(cls, summary: Dict) -> 'IntervalHistogram':
+        """Rebuild a histogram from to_dict() output."""
+        return cls(summary.get('counts', ()))
+
+
+class IntervalTracker:
+    """
+    Builds each player's action interval histogram.
+
+    Actions must be added in timestamp order. Only the last action time and
+    the fixed-size histogram are kept per player.
+    """
+
+    def __init__(self):
+        self._last: Dict[int, float] = {}
+        self._histograms: Dict[int, IntervalHistogram] = {}
+
+    def add(self, player_number: int, timestamp_ms: float):
+        """Add an action at the given game time."""
+        last = self._last.get(player_number)
+        self._last[player_number] = timestamp_ms
+        if last is None:
+            self._histograms[player_number] = IntervalHistogram()
+            return
+        self._histograms[player_number].add(max(timestamp_ms - last, 0))
+
+    def histogram(self, player_number: int) -> IntervalHistogram:
+        """Get a player's interval histogram (empty if they had no actions)."""
+        return self._histograms.get(player_number) or IntervalHistogram()
+
+    def results(self, player_number: int) -> Dict:
+        """Get a player's interval summary, as IntervalHistogram.to_dict()."""
+        return self.histogram(player_number).to_dict()
+
+
+# Age-up technology ids in order, the age each one starts, and its nominal
+# research time in seconds (civilization bonuses that speed it up are not
+# modeled)
+AGE_TECHNOLOGIES = (
+    (101, 'Feudal Age', 130),
+    (102, 'Castle Age', 160),
+    (103, 'Imperial Age', 190),
+)
+
+# Order id of SPECIAL actions that remove an item from a building's queue
+# ('Unqueue' in mgz's reference constants)
+UNQUEUE_ORDER = 4
+
+# Phase names when no age-ups are seen, and the minutes at which the mid
+# and late windows start
+DEFAULT_PHASE_WINDOWS = (15, 30)
+WINDOW_PHASES = ('Early', 'Mid', 'Late')
+
+
+class _PhaseState:
+    """Age and per-phase action counts for one player."""
+
+    __slots__ = ('ages', 'pending', 'pending_building', 'age_counts', 'window_counts')
+
+    def __init__(self, windows: int):
+        # (start ms, name) of each age reached, starting with the Dark Age
+        self.ages = [(0, 'Dark Age')]
+        # (start ms, name) of an age being researched, and the building
+        # researching it
+        self.pending = None
+        self.pending_building = None
+        self.age_counts = [0]
+        self.window_counts = [0] * windows
+
+
+class PhaseTracker:
+    """
+    Counts each player's actions per game phase.
+
+    Phases are the ages: a player enters an age when their research of it
+    finishes, i.e. the research action's time plus the nominal research
+    time. A research that is unqueued at its building before it finishes is
+    dropped, unless it is researched again. Since the unqueue action
+    doesn't say which queued item it removes, unqueueing anything at that
+    building while the age is researching counts as cancelling it.
+    Age-up times are only known from research payloads, so if no player
+    researched an age (or payloads weren't decoded), fixed early,
+    mid and late windows are used instead. Both are counted as actions are
+    added, in timestamp order, in constant memory per player.
+    """
+
+    def __init__(self, windows_minutes: Sequence[float] = DEFAULT_PHASE_WINDOWS):
+        """
+        Initialize the tracker.
+
+        Args:
+            windows_minutes: Minutes at which the mid and late windows start
+        """
+        self.window_starts_ms = [0] + [minutes * 60000 for minutes in windows_minutes]
+        self._players: Dict[int, _PhaseState] = {}
+
+    def add(self, player_number: int, timestamp_ms: float, action_type: Any = None, payload: Dict = None):
+        """Add an action at the given game time, with its type and payload if decoded."""
+        state = self._players.get(player_number)
+        if state is None:
+            state = self._players[player_number] = _PhaseState(len(self.window_starts_ms))
+
+        if state.pending is not None and timestamp_ms >= state.pending[0]:
+            state.ages.append(state.pending)
+            state.age_counts.append(0)
+            state.pending = None
+        state.age_counts[-1] += 1
+
+        window = len(self.window_starts_ms) - 1
+        while timestamp_ms < self.window_starts_ms[window]:
+            window -= 1
+        state.window_counts[window] += 1
+
+        if action_type is Action.RESEARCH and payload:
+            # Only the next age can be researched; researching it again
+            # (after cancelling) replaces the pending research
+            next_age = len(state.ages) - 1
+            if next_age < len(AGE_TECHNOLOGIES) and payload.get('technology_id') == AGE_TECHNOLOGIES[next_age][0]:
+                _, name, research_seconds = AGE_TECHNOLOGIES[next_age]
+                state.pending = (timestamp_ms + research_seconds * 1000, name)
+                state.pending_building = (payload.get('object_ids') or [None])[0]
+        elif (action_type is Action.SPECIAL and payload and payload.get('order_id') == UNQUEUE_ORDER
+              and state.pending is not None and state.pending_building in payload.get('object_ids', ())):
+            state.pending = None
+
+    @property
+    def ages_seen(self) -> bool:
+        """Whether any player reached an age or is researching one."""
+        return any(len(state.ages) > 1 or state.pending is not None for state in self._players.values())
+
+    @property
+    def basis(self) -> str:
+        """What phases are based on: 'ages' or 'windows'."""
+        return 'ages' if self.ages_seen else 'windows'
+
+    def results(self, player_number: int, duration_ms: float) -> List[Dict]:
+        """
+        Get a player's actions and APM in each phase of the game.
+
+        Args:
+            player_number: Player number
+            duration_ms: Game length, where the last phase ends
+
+        Returns:
+            List of dictionaries with each phase's name, start and end (in
+            seconds), action count and APM. Phases that start after the game
+            ended are left out, and there are none if the player had no
+            actions.
+        """
+        state = self._players.get(player_number)
+        if state is None:
+            return []
+
+        if self.ages_seen:
+            phases = list(zip(state.ages, state.age_counts))
+            # An age finishing after the player's last action still counts
+            if state.pending is not None:
+                phases.append((state.pending, 0))
+        else:
+            phases = list(zip(zip(self.window_starts_ms, WINDOW_PHASES), state.window_counts))
+
+        results = []
+        for index, ((start, name), count) in enumerate(phases):
+            if start >= duration_ms and index:
+                break
+            end = phases[index + 1][0][0] if index + 1 < len(phases) else duration_ms
+            end = min(end, duration_ms)
+            minutes = (end - start) / 60000
+            results.append({
+                'phase': name,
+                'start_seconds': round(start / 1000, 1),
+                'end_seconds': round(end / 1000, 1),
+                'actions': count,
+                'apm': round(count / minutes, 2) if minutes > 0 else 0
+            })
+        return results
+
+
+def team_totals(teams: Iterable[Iterable[int]], players: Iterable[Dict]) -> List[Dict]:
+    """
+    Add up player results per team.
+
+    Args:
+        teams: Player numbers of each team
+        players: Player dictionaries as in APMAnalyzer.get_results()['players']
+
+    Returns:
+        List of dictionaries with each team's number (from 1), player
+        numbers, total actions, combined and average APM and whether it won
+    """
+    by_number = {player['number']: player for player in players}
+    totals = []
+    for team in teams:
+        members = [by_number[number] for number in sorted(team) if number in by_number]
+        if not members:
+            continue
+        apm = sum(player['apm'] for player in members)
+        totals.append({
+            'team': len(totals) + 1,
+            'players': [player['number'] for player in members],
+            'total_actions': sum(player['total_actions'] for player in members),
+            'apm': round(apm, 2),
+            'average_apm': round(apm / len(members), 2),
+            'winner': all(player['winner'] for player in members)
+        })
+    return totals
+
+
+def merge_player_intervals(all_results: Iterable[Dict]) -> Dict[str, IntervalHistogram]:
+    """
+    Merge per-game interval histograms into one histogram per player name.
+
+    Args:
+        all_results: Dictionaries as returned by APMAnalyzer.get_results()
+
+    Returns:
+        Dictionary of player name to merged histogram
+    """
+    merged: Dict[str, IntervalHistogram] = {}
+    for results in all_results:
+        for player in results['players']:
+            intervals = player.get('intervals')
+            if not intervals or not intervals.get('count'):
+                continue
+            histogram = merged.get(player['name'])
+            if histogram is None:
+                histogram = merged[player['name']] = IntervalHistogram()
+            histogram.merge(IntervalHistogram.from_dict(intervals))
+    return merged
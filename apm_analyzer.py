@@ -3,58 +3,369 @@ AOE2 Record APM Analyzer
 Extracts and calculates Actions Per Minute (APM) from .aoe2record files.
 """
 
-from mgz import header, fast
-from mgz.model import parse_match, serialize
+from mgz import fast
+from mgz.common.map import extract_from_instructions, get_modes, lookup_name
+from mgz.fast.header import parse as parse_header
+from mgz.model import get_map_id, parse_match, serialize
 from collections import defaultdict
-from typing import Dict, List, Optional
+from datetime import timedelta
+from typing import Dict, List, Optional, Sequence
+import io
+import logging
 import os
 import json
+import time
+
+from apm_accumulators import (BurstDetector, IntervalTracker, PhaseTracker, team_totals, DEFAULT_BURST_TOP_K,
+                               DEFAULT_BURST_WINDOWS, DEFAULT_PHASE_WINDOWS)
+from apm_decoder import ResilientDecoder
+from apm_metrics import METRICS, MetricsRegistry, logger
+from apm_reference import get_dataset, install as install_reference_cache
+from apm_sampling import DEFAULT_SAMPLE_RATE, SampledDecoder
+from apm_versions import SKIM_VERSIONS, UnsupportedVersionError, decode_path, detect_version
+
+# Load mgz reference tables once per process instead of once per replay
+install_reference_cache()
+
+
+def _to_milliseconds(value) -> float:
+    """Convert a duration (timedelta or milliseconds) to milliseconds."""
+    if isinstance(value, timedelta):
+        return value.total_seconds() * 1000
+    return value or 0
 
 
 class APMAnalyzer:
     """Analyzes .aoe2record files to extract player APM statistics."""
 
-    def __init__(self, record_file_path: str):
+    # Decoder names used in apm_versions.DECODE_PATHS, and the methods that run them
+    _DECODERS = {
+        'match': '_decode_match',
+        'stream': '_recover',
+        'sample': '_estimate',
+    }
+
+    def __init__(self, record_file_path: str, data: Optional[bytes] = None,
+                 burst_windows: Sequence[float] = DEFAULT_BURST_WINDOWS,
+                 burst_top_k: int = DEFAULT_BURST_TOP_K,
+                 sample_rate: Optional[float] = None,
+                 decoders: Optional[Sequence[str]] = None,
+                 phase_windows: Sequence[float] = DEFAULT_PHASE_WINDOWS,
+                 metrics: Optional[MetricsRegistry] = None):
         """
         Initialize the APM analyzer with a record file.
 
         Args:
             record_file_path: Path to the .aoe2record file
+            data: Optional in-memory contents of the record file. When given,
+                the file is parsed from this buffer and never opened from disk.
+            burst_windows: Window lengths in seconds for peak APM detection
+            burst_top_k: Number of peak windows reported per player and length
+            sample_rate: Optional fraction of the body to decode, in (0, 1].
+                When given, APM is estimated from sampled segments of the
+                game, with error bounds, instead of counting every action.
+            decoders: Optional decoder names ('match', 'stream', 'sample')
+                to try in order, instead of the path for the file's version.
+                Mainly for comparing decoders against each other.
+            phase_windows: Minutes at which the mid and late phases start,
+                for games where no age-ups are seen
+            metrics: Optional registry that parse outcomes are counted in
+                (default: apm_metrics.METRICS)
 
         Raises:
             FileNotFoundError: If the record file doesn't exist
-            ValueError: If the file is not a valid .aoe2record file
+            ValueError: If the file is not a valid .aoe2record file, or a
+                decoder name is unknown
         """
-        if not os.path.exists(record_file_path):
+        if data is None and not os.path.exists(record_file_path):
             raise FileNotFoundError(f"Record file not found: {record_file_path}")
 
         if not record_file_path.endswith('.aoe2record'):
             raise ValueError(f"File must be a .aoe2record file: {record_file_path}")
 
         self.record_file_path = record_file_path
+        self.data = data
         self.match = None
+        self.map_name = None
         self.players_info = {}
         self.apm_data = {}
+        self.decode_stats = None
+        self.burst_windows = burst_windows
+        self.burst_top_k = burst_top_k
+        self.bursts = BurstDetector(burst_windows, burst_top_k)
+        self.intervals = IntervalTracker()
+        self.phase_windows = phase_windows
+        self.phases = PhaseTracker(phase_windows)
+        self.teams = []
+        self.duration_ms = 0
+        self.sample_rate = sample_rate
+        self.decoders = tuple(decoders) if decoders is not None else None
+        if self.decoders is not None:
+            unknown = set(self.decoders) - set(self._DECODERS)
+            if unknown:
+                raise ValueError(f"Unknown decoder(s): {', '.join(sorted(unknown))}")
+            if 'sample' in self.decoders and sample_rate is None:
+                self.sample_rate = DEFAULT_SAMPLE_RATE
+        self.sample = None
+        self.version = None
+        self.decoder = None
+        self.error = None
+        self.metrics = metrics if metrics is not None else METRICS
+
+    def _open(self):
+        """Open the record as a binary stream, preferring the in-memory buffer."""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.record_file_path, 'rb')
 
     def parse(self) -> bool:
         """
         Parse the record file and extract game data.
 
+        The game version is read from the start of the file first, so files
+        from unsupported versions are rejected without parsing. The decoders
+        listed for the version in apm_versions.DECODE_PATHS are then tried
+        in order.
+
+        DE replays are decoded with the resilient streaming decoder, taking
+        players, teams and the map from the header. For older versions the
+        full match model is built first; if that fails (e.g. the replay is
+        truncated or corrupt), the streaming decoder is used instead. Either
+        way, results of a damaged replay are marked as partial.
+
+        With a sample rate set, APM is estimated from sampled segments of
+        the body instead.
+
+        Problems are logged to the 'apm' logger (with tracebacks at debug
+        level) and the outcome, size and parse time are counted in the
+        metrics registry.
+
         Returns:
-            True if parsing was successful, False otherwise
+            True if parsing was successful, False otherwise (the reason is
+            kept in the error attribute)
         """
+        start = time.perf_counter()
+        size = 0
         try:
-            with open(self.record_file_path, 'rb') as f:
-                # Use the model API to parse the match
-                self.match = parse_match(f)
-                self._extract_player_info()
-                self._calculate_apm()
-            return True
+            with self._open() as f:
+                size = f.seek(0, io.SEEK_END)
+                f.seek(0)
+                self.version = detect_version(f)
+                path = decode_path(self.version)
+                if self.decoders is not None:
+                    path = self.decoders
+                elif self.sample_rate is not None:
+                    path = ('sample',)
+                self.decoder = self._decode(f, path)
+        except UnsupportedVersionError as e:
+            self.error = str(e)
+            logger.warning("Skipping %s: %s", self.record_file_path, e,
+                           extra={'file': self.record_file_path, 'reason': 'unsupported_version'})
+            self.metrics.files_failed.inc(reason='unsupported_version')
+            return False
         except Exception as e:
-            print(f"Error parsing file: {e}")
-            import traceback
-            traceback.print_exc()
+            self.error = str(e)
+            logger.error("Error parsing %s: %s", self.record_file_path, e,
+                         exc_info=logger.isEnabledFor(logging.DEBUG),
+                         extra={'file': self.record_file_path, 'reason': type(e).__name__})
+            self.metrics.files_failed.inc(reason=type(e).__name__)
             return False
+        finally:
+            self.metrics.bytes_read.inc(self._bytes_read(size))
+            self.metrics.parse_seconds.observe(time.perf_counter() - start)
+
+        self.metrics.files_parsed.inc(decoder=self.decoder)
+        self.metrics.actions.inc(sum(apm_info['total_actions'] for apm_info in self.apm_data.values()))
+        if self.decode_stats is not None and self.decode_stats.partial:
+            self.metrics.files_partial.inc()
+        return True
+
+    def _bytes_read(self, size: int) -> int:
+        """
+        Get how many bytes of the record were read to analyze it.
+
+        That's the whole file, unless it was opened from disk and only a
+        sample of its body was decoded.
+        """
+        if self.data is None and self.sample is not None:
+            return size - self.sample.body_bytes + self.sample.bytes_read
+        return size
+
+    def _decode(self, f, path) -> str:
+        """Run the decoders in a path until one succeeds, and return its name."""
+        for position, name in enumerate(path):
+            f.seek(0)
+            self.match = None
+            self.map_name = None
+            self.players_info = {}
+            self.apm_data = {}
+            self.bursts = BurstDetector(self.burst_windows, self.burst_top_k)
+            self.intervals = IntervalTracker()
+            self.phases = PhaseTracker(self.phase_windows)
+            self.teams = []
+            try:
+                getattr(self, self._DECODERS[name])(f)
+                return name
+            except Exception as e:
+                if position == len(path) - 1:
+                    raise
+                self.metrics.fallbacks.inc(decoder=name)
+                extra = {'file': self.record_file_path, 'decoder': name, 'fallback': path[position + 1]}
+                if path[position + 1] == 'stream':
+                    logger.warning("Full parse of %s failed, recovering partial results: %s",
+                                   self.record_file_path, e, extra=extra)
+                else:
+                    logger.warning("%s decoder failed on %s, trying %s: %s",
+                                   name, self.record_file_path, path[position + 1], e, extra=extra)
+
+    @property
+    def _skim(self) -> bool:
+        """Whether the body layout allows skimming operations (see apm_versions)."""
+        return self.version is not None and self.version.version in SKIM_VERSIONS
+
+    def _decode_match(self, f):
+        """Build the full match model and count actions from it."""
+        self.match = parse_match(f)
+        self.teams = [{player.number for player in team} for team in getattr(self.match, 'teams', None) or []]
+        self._extract_player_info()
+        self._calculate_apm()
+
+    def _recover(self, f):
+        """Extract player info and APM from the header and a streaming decode."""
+        data = parse_header(f)
+        fast.meta(f)
+        self._extract_header_player_info(data)
+        self.teams = self._header_teams(data)
+        self.map_name = self._header_map_name(data)
+
+        action_counts, resigned = self._decode_actions(f)
+        self._assign_winners(data, resigned)
+        self._store_apm(action_counts, self.decode_stats.covered_ms)
+
+    def _estimate(self, f):
+        """Extract player info from the header and estimate APM from a body sample."""
+        data = parse_header(f)
+        fast.meta(f)
+        self._extract_header_player_info(data)
+        self.teams = self._header_teams(data)
+        self.map_name = self._header_map_name(data)
+
+        self.sample = SampledDecoder(f, sample_rate=self.sample_rate, skim=self._skim).estimate()
+        self._assign_winners(data, self.sample.resigned)
+        self.duration_ms = self.sample.duration_ms
+
+        duration_minutes = self.sample.duration_ms / 1000 / 60
+        for player_number in self.players_info:
+            estimate = self.sample.player(player_number)
+            apm_error = estimate['apm_error']
+            self.apm_data[player_number] = {
+                'total_actions': estimate['total_actions'],
+                'apm': round(estimate['apm'], 2),
+                'apm_error': round(apm_error, 2) if apm_error is not None else None,
+                'duration_minutes': round(duration_minutes, 2)
+            }
+
+    def _assign_winners(self, data: Dict, resigned: set):
+        """Mark winners from header teams: a team wins if none of its players resigned."""
+        if not resigned:
+            return
+        for team in self._header_teams(data):
+            winner = not (team & resigned)
+            for player_number in team:
+                if player_number in self.players_info:
+                    self.players_info[player_number]['winner'] = winner
+
+    def _extract_header_player_info(self, data: Dict):
+        """Extract basic player information from a parsed header."""
+        try:
+            _, dataset = get_dataset(data['version'], data['mod'])
+            civilizations = dataset['civilizations']
+        except Exception:
+            civilizations = {}
+
+        # The first header player is gaia
+        for player in data['players'][1:]:
+            civilization = civilizations.get(str(player['civilization_id']), {})
+            self.players_info[player['number']] = {
+                'name': player['name'].decode('utf-8', errors='replace'),
+                'civilization': civilization.get('name', 'Unknown'),
+                'color_id': player['color_id'],
+                'winner': False
+            }
+
+    @staticmethod
+    def _header_map_name(data: Dict) -> Optional[str]:
+        """Look up the map name from a parsed header, as the match model names it."""
+        try:
+            _, dataset = get_dataset(data['version'], data['mod'])
+            _, _, name = extract_from_instructions(data['scenario']['instructions'])
+            name, _ = lookup_name(get_map_id(data), name, data['version'], dataset)
+            name, _ = get_modes(name)
+            return name.strip()
+        except Exception:
+            return None
+
+    @staticmethod
+    def _header_teams(data: Dict) -> List[set]:
+        """Group player numbers into teams using header lobby or diplomacy data."""
+        if data.get('de'):
+            teams = defaultdict(set)
+            for player in data['de']['players']:
+                if player['team_id'] > 1:
+                    teams[player['team_id']].add(player['number'])
+                else:
+                    teams[('solo', player['number'])].add(player['number'])
+            return list(teams.values())
+
+        teams = []
+        for player in data['players'][1:]:
+            allies = {player['number']}
+            for number, stance in enumerate(player['diplomacy']):
+                if stance == 2:
+                    allies.add(number)
+            if allies not in teams:
+                teams.append(allies)
+        return teams
+
+    def _decode_actions(self, f):
+        """
+        Count actions per player with the resilient streaming decoder.
+
+        Args:
+            f: Binary stream positioned at the start of the body
+
+        Returns:
+            Tuple of (action counts by player number, set of resigned players)
+        """
+        action_counts = defaultdict(int)
+        resigned = set()
+
+        decoder = ResilientDecoder(f, skim=self._skim)
+        for timestamp, op_type, op_data in decoder.operations():
+            if op_type is not fast.Operation.ACTION:
+                continue
+
+            action_type, payload = op_data
+            player_number = payload.get('player_id')
+            if player_number is None:
+                continue
+            if self.players_info and player_number not in self.players_info:
+                continue
+
+            action_counts[player_number] += 1
+            self.bursts.add(player_number, timestamp)
+            self.intervals.add(player_number, timestamp)
+            self.phases.add(player_number, timestamp, action_type, payload)
+            if action_type is fast.Action.RESIGN:
+                resigned.add(player_number)
+
+        self.decode_stats = decoder.stats
+        if decoder.stats.partial:
+            logger.warning("Replay %s is damaged, decoded %.2f minutes (%d bytes skipped)",
+                           self.record_file_path, decoder.stats.covered_ms / 60000, decoder.stats.bytes_skipped,
+                           extra={'file': self.record_file_path})
+
+        return action_counts, resigned
 
     def _extract_player_info(self):
         """Extract basic player information from the match."""
@@ -73,7 +384,7 @@ class APMAnalyzer:
                         'winner': getattr(player, 'winner', False)
                     }
         except Exception as e:
-            print(f"Warning: Could not extract player info: {e}")
+            logger.warning("Could not extract player info from %s: %s", self.record_file_path, e)
 
     def _calculate_apm(self):
         """Calculate APM for each player based on their actions."""
@@ -83,22 +394,19 @@ class APMAnalyzer:
         # Get game duration
         try:
             if hasattr(self.match, 'duration'):
-                duration_ms = self.match.duration
+                duration_ms = _to_milliseconds(self.match.duration)
             elif hasattr(self.match, 'completed') and self.match.completed:
                 # Duration might be in completed timestamp
-                duration_ms = getattr(self.match.completed, 'timestamp', 0)
+                duration_ms = _to_milliseconds(getattr(self.match.completed, 'timestamp', 0))
             else:
                 duration_ms = 0
 
-            if not duration_ms or duration_ms == 0:
-                print("Warning: Could not determine game duration")
+            if not duration_ms:
+                logger.warning("Could not determine game duration of %s", self.record_file_path)
                 return
 
-            # Convert to minutes
-            duration_minutes = duration_ms / 1000 / 60
-
         except Exception as e:
-            print(f"Warning: Error getting duration: {e}")
+            logger.warning("Error getting duration of %s: %s", self.record_file_path, e)
             return
 
         # Count actions per player
@@ -112,35 +420,32 @@ class APMAnalyzer:
                         player_number = getattr(action.player, 'number', None)
                         if player_number is not None:
                             action_counts[player_number] += 1
+                            timestamp = _to_milliseconds(action.timestamp)
+                            self.bursts.add(player_number, timestamp)
+                            self.intervals.add(player_number, timestamp)
+                            self.phases.add(player_number, timestamp, action.type, action.payload)
         except Exception as e:
-            print(f"Warning: Could not count actions from match object: {e}")
+            logger.warning("Could not count actions from match object of %s: %s", self.record_file_path, e)
 
         # Fallback: Parse actions directly from file
         if not action_counts:
             try:
-                with open(self.record_file_path, 'rb') as f:
-                    # Skip header
-                    header.parse_stream(f)
-
-                    # Get file size
-                    f.seek(0, 2)
-                    eof = f.tell()
-                    f.seek(0)
-                    header.parse_stream(f)
-
-                    # Count operations
-                    while f.tell() < eof:
-                        try:
-                            op = fast.operation(f)
-                            if op and 'player_number' in op:
-                                action_counts[op['player_number']] += 1
-                        except:
-                            break
+                with self._open() as f:
+                    # Skip header and log meta to reach the body
+                    parse_header(f)
+                    fast.meta(f)
+                    action_counts, _ = self._decode_actions(f)
 
             except Exception as e:
-                print(f"Warning: Could not parse actions directly: {e}")
+                logger.warning("Could not parse actions of %s directly: %s", self.record_file_path, e)
+
+        self._store_apm(action_counts, duration_ms)
+
+    def _store_apm(self, action_counts: Dict[int, int], duration_ms: float):
+        """Calculate and store APM for each player from their action counts."""
+        self.duration_ms = duration_ms
+        duration_minutes = duration_ms / 1000 / 60
 
-        # Calculate APM for each player
         for player_number, action_count in action_counts.items():
             apm = action_count / duration_minutes if duration_minutes > 0 else 0
 
@@ -150,6 +455,19 @@ class APMAnalyzer:
                 'duration_minutes': round(duration_minutes, 2)
             }
 
+    def _map_name(self) -> Optional[str]:
+        """Get the map name, from the match model or the header."""
+        try:
+            return self.match.map.name
+        except AttributeError:
+            return self.map_name
+
+    def _source_path(self) -> Optional[str]:
+        """Get the record file's absolute path, or None for a replay only given as bytes."""
+        if self.data is not None and not os.path.exists(self.record_file_path):
+            return None
+        return os.path.abspath(self.record_file_path)
+
     def get_results(self) -> Dict:
         """
         Get the complete APM analysis results.
@@ -159,9 +477,32 @@ class APMAnalyzer:
         """
         results = {
             'file': os.path.basename(self.record_file_path),
+            'path': self._source_path(),
+            'map': self._map_name(),
+            'version': self.version.name if self.version else None,
+            'partial': bool(self.decode_stats and self.decode_stats.partial),
+            'phase_basis': self.phases.basis,
             'players': []
         }
 
+        # Describe how much of a damaged replay could be recovered
+        if results['partial']:
+            results['recovery'] = {
+                'covered_minutes': round(self.decode_stats.covered_ms / 1000 / 60, 2),
+                'truncated': self.decode_stats.truncated,
+                'corrupt_regions': self.decode_stats.corrupt_regions,
+                'bytes_skipped': self.decode_stats.bytes_skipped
+            }
+
+        # Describe the sample an approximate result was estimated from
+        if self.sample is not None:
+            results['approximate'] = {
+                'sample_rate': self.sample_rate,
+                'sampled_fraction': round(self.sample.sample_fraction, 3),
+                'segments': len(self.sample.segments),
+                'duration_exact': self.sample.duration_exact
+            }
+
         for player_number, player_info in self.players_info.items():
             apm_info = self.apm_data.get(player_number, {})
 
@@ -172,47 +513,93 @@ class APMAnalyzer:
                 'winner': player_info['winner'],
                 'total_actions': apm_info.get('total_actions', 0),
                 'apm': apm_info.get('apm', 0),
-                'duration_minutes': apm_info.get('duration_minutes', 0)
+                'duration_minutes': apm_info.get('duration_minutes', 0),
+                'bursts': self.bursts.results(player_number),
+                'intervals': self.intervals.results(player_number),
+                'phases': self.phases.results(player_number, self.duration_ms)
             }
+            if self.sample is not None:
+                player_result['apm_error'] = apm_info.get('apm_error')
 
             results['players'].append(player_result)
 
         # Sort players by player number
         results['players'].sort(key=lambda x: x['number'])
+        results['teams'] = team_totals(self.teams, results['players'])
 
         return results
 
     def print_results(self):
         """Print APM results in a human-readable format."""
-        results = self.get_results()
+        print_results(self.get_results())
 
-        print(f"\n{'='*70}")
-        print(f"APM Analysis for: {results['file']}")
-        print(f"{'='*70}\n")
 
-        if not results['players']:
-            print("No player data available.")
-            return
-
-        # Print header
-        print(f"{'Player':<20} {'Civ':<15} {'Actions':<10} {'APM':<10} {'Winner':<8}")
-        print(f"{'-'*70}")
+def print_results(results: Dict):
+    """
+    Print APM results in a human-readable format.
 
-        # Print each player
+    Args:
+        results: Dictionary as returned by APMAnalyzer.get_results()
+    """
+    print(f"\n{'='*70}")
+    print(f"APM Analysis for: {results['file']}")
+    print(f"{'='*70}\n")
+
+    if not results['players']:
+        print("No player data available.")
+        return
+
+    # Approximate results show APM with its error bound
+    apm_width = 16 if 'approximate' in results else 10
+
+    # Print header
+    print(f"{'Player':<20} {'Civ':<15} {'Actions':<10} {'APM':<{apm_width}} {'Winner':<8}")
+    print(f"{'-'*70}")
+
+    # Print each player
+    for player in results['players']:
+        winner_mark = '✓' if player['winner'] else ''
+        apm = f"{player['apm']:.2f}"
+        if player.get('apm_error') is not None:
+            apm += f" ±{player['apm_error']:.1f}"
+        print(f"{player['name']:<20} "
+              f"{player['civilization']:<15} "
+              f"{player['total_actions']:<10} "
+              f"{apm:<{apm_width}} "
+              f"{winner_mark:<8}")
+
+    # Team totals, for games with teams of more than one player
+    teams = results.get('teams', [])
+    if any(len(team['players']) > 1 for team in teams):
+        names = {player['number']: player['name'] for player in results['players']}
+        print()
+        for team in teams:
+            winner_mark = ' ✓' if team['winner'] else ''
+            members = ', '.join(names[number] for number in team['players'])
+            print(f"Team {team['team']} ({members}): {team['total_actions']} actions, "
+                  f"{team['apm']:.2f} APM, {team['average_apm']:.2f} average{winner_mark}")
+
+    # APM in each phase of the game
+    if any(player.get('phases') for player in results['players']):
+        basis = 'age' if results.get('phase_basis') == 'ages' else 'game time'
+        print(f"\nAPM by {basis}:")
         for player in results['players']:
-            winner_mark = '✓' if player['winner'] else ''
-            print(f"{player['name']:<20} "
-                  f"{player['civilization']:<15} "
-                  f"{player['total_actions']:<10} "
-                  f"{player['apm']:<10.2f} "
-                  f"{winner_mark:<8}")
-
-        # Print game duration
-        if results['players']:
-            duration = results['players'][0]['duration_minutes']
-            print(f"\nGame Duration: {duration:.2f} minutes")
-
-        print(f"{'='*70}\n")
+            if not player.get('phases'):
+                continue
+            phases = ', '.join(f"{phase['phase']} {phase['apm']:.1f}" for phase in player.get('phases', []))
+            print(f"  {player['name']:<20} {phases}")
+
+    # Print game duration
+    if results['players']:
+        duration = results['players'][0]['duration_minutes']
+        print(f"\nGame Duration: {duration:.2f} minutes")
+
+    if 'approximate' in results:
+        approximate = results['approximate']
+        print(f"Approximate: estimated from {approximate['sampled_fraction']:.0%} of the replay "
+              f"(APM ± 95% bounds)")
+
+    print(f"{'='*70}\n")
 
 
 def analyze_apm(record_file_path: str, print_output: bool = True) -> Optional[Dict]:
@@ -0,0 +1,299 @@
+"""
+Asyncio API for AOE2 Record APM Analyzer.
+Runs analyses on a managed process pool so they never block the event
+loop, for embedding in asyncio web services.
+"""
+
+import asyncio
+import atexit
+import inspect
+import os
+import threading
+from typing import Any, Dict, Optional, Union
+
+from apm_metrics import METRICS
+from apm_scheduler import analyze_file_task, create_process_pool
+from apm_reference import warm_up
+
+
+# Analyses submitted to the pool at once, per worker: enough to keep every
+# worker busy without queueing work that callers may give up on
+DEFAULT_SLOTS_PER_WORKER = 2
+
+# Largest upload read from a byte stream (larger replays are rejected)
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Bytes requested per read() from a stream
+READ_CHUNK_BYTES = 256 * 1024
+
+# Name given to replays passed as bytes or streams
+DEFAULT_UPLOAD_NAME = 'upload.aoe2record'
+
+
+class AnalysisError(Exception):
+    """Raised when a replay could not be analyzed, with the worker's reason."""
+
+
+class AsyncAPMAnalyzer:
+    """
+    Analyzes replays from asyncio code on a process pool.
+
+    A replay can be given as a path, as bytes, or as an upload body: an
+    object with an (async or plain) read() method, such as
+    asyncio.StreamReader, or an async iterable of byte chunks. Bodies are
+    read without blocking and sent to a worker process for parsing.
+
+    At most max_concurrency analyses are submitted to the pool at once;
+    further calls wait for a slot without using a thread each. A call that
+    is cancelled or times out returns right away, but a worker that has
+    already started on its replay can't be interrupted. It finishes in the
+    background and the result is dropped; its slot is only freed then, so
+    abandoned work never piles up in the pool.
+
+    Each analysis's metrics are merged into apm_metrics.METRICS, which a
+    service can export with METRICS.to_prometheus().
+
+    Example:
+        async with AsyncAPMAnalyzer(workers=4) as analyzer:
+            results = await analyzer.analyze(request.content, timeout=30)
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_concurrency: Optional[int] = None,
+                 timeout: Optional[float] = None, sample_rate: Optional[float] = None,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Initialize the analyzer. The process pool is started on first use.
+
+        Args:
+            workers: Number of worker processes (default: number of CPUs)
+            max_concurrency: Analyses submitted to the pool at once
+                (default: DEFAULT_SLOTS_PER_WORKER per worker)
+            timeout: Default timeout in seconds for each call (default: none)
+            sample_rate: Optional fraction of each replay to sample (see APMAnalyzer)
+            max_bytes: Largest replay accepted from bytes or streams
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_concurrency = max_concurrency or self.workers * DEFAULT_SLOTS_PER_WORKER
+        self.timeout = timeout
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = None
+        self._loop = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.close()
+
+    def _ensure_pool(self):
+        """Get the process pool, creating it if needed. Blocks: call from a thread."""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = create_process_pool(self.workers)
+            return self._pool
+
+    def _submit(self, loop: asyncio.AbstractEventLoop, slots: asyncio.Semaphore, path: str,
+                data: Optional[bytes]):
+        """
+        Submit an analysis that holds a slot. Blocks: call from a thread.
+
+        Submitting can start the fork server and worker processes, so it
+        never runs on the event loop. The slot is freed when the worker is
+        done, even if the caller gave up in the meantime.
+        """
+        try:
+            future = self._ensure_pool().submit(analyze_file_task, path, self.sample_rate, data)
+        except BaseException:
+            _call_soon(loop, slots.release)
+            raise
+        future.add_done_callback(lambda done: _finished(done, loop, slots))
+        return future
+
+    def _ensure_slots(self) -> asyncio.Semaphore:
+        """Get the semaphore limiting submitted analyses, for the running loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Semaphores belong to one event loop
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        return self._slots
+
+    async def start(self):
+        """Start the worker processes ahead of the first analysis."""
+        loop = asyncio.get_running_loop()
+        # Starting processes blocks, so submit the warm-up tasks from a thread
+        futures = await loop.run_in_executor(
+            None, lambda: [self._ensure_pool().submit(warm_up) for _ in range(self.workers)]
+        )
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+
+    async def close(self):
+        """Shut down the worker processes, waiting for running analyses."""
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+
+    async def analyze(self, source: Any, name: Optional[str] = None,
+                      timeout: Optional[float] = None) -> Dict:
+        """
+        Analyze a replay.
+
+        Args:
+            source: Path of a record file, its contents as bytes, an object
+                with an async or plain read() method, or an async iterable
+                of byte chunks
+            name: File name reported in the results for bytes and streams
+                (default: DEFAULT_UPLOAD_NAME)
+            timeout: Seconds to wait for the result, including reading the
+                source and waiting for a slot (default: the analyzer's timeout)
+
+        Returns:
+            Dictionary with APM results
+
+        Raises:
+            AnalysisError: If the replay could not be analyzed
+            asyncio.TimeoutError: If the timeout expired
+            ValueError: If a byte source is larger than max_bytes
+            TypeError: If the source is of an unsupported type
+        """
+        timeout = self.timeout if timeout is None else timeout
+        return await asyncio.wait_for(self._analyze(source, name), timeout)
+
+    async def _analyze(self, source: Any, name: Optional[str]) -> Dict:
+        if isinstance(source, (str, os.PathLike)):
+            path, data = os.fspath(source), None
+        else:
+            path, data = name or DEFAULT_UPLOAD_NAME, await read_source(source, self.max_bytes)
+
+        loop = asyncio.get_running_loop()
+        slots = self._ensure_slots()
+        await slots.acquire()
+        # Once submitted from the thread, the slot is released by the pool
+        # future, even if this call is cancelled while waiting for the thread
+        future = await loop.run_in_executor(None, self._submit, loop, slots, path, data)
+
+        results, error, _, _ = await asyncio.wrap_future(future)
+        if results is None:
+            raise AnalysisError(f"{path}: {error}")
+        return results
+
+
+def _finished(future, loop: asyncio.AbstractEventLoop, slots: asyncio.Semaphore):
+    """Record a finished analysis's metrics and free its slot."""
+    if future.cancelled():
+        pass
+    elif future.exception() is not None:
+        METRICS.files_failed.inc(reason='worker_error')
+    else:
+        METRICS.merge(future.result()[3])
+    _call_soon(loop, slots.release)
+
+
+def _call_soon(loop: asyncio.AbstractEventLoop, callback):
+    """Schedule a callback on a loop from another thread, unless it has closed."""
+    try:
+        loop.call_soon_threadsafe(callback)
+    except RuntimeError:
+        pass
+
+
+async def read_source(source: Any, max_bytes: int = DEFAULT_MAX_BYTES) -> bytes:
+    """
+    Read a replay from bytes, a stream or an async iterable of chunks.
+
+    A plain (synchronous) read() is called on a thread, so slow files or
+    sockets don't block the event loop.
+
+    Args:
+        source: Bytes-like object, object with an async or plain read()
+            method, or async iterable of byte chunks
+        max_bytes: Largest accepted size
+
+    Returns:
+        The replay contents
+
+    Raises:
+        ValueError: If the source is larger than max_bytes
+        TypeError: If the source is of an unsupported type
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = bytes(source)
+        if len(data) > max_bytes:
+            raise ValueError(f"Replay is larger than {max_bytes} bytes")
+        return data
+
+    chunks = []
+    size = 0
+
+    def add(chunk):
+        nonlocal size
+        size += len(chunk)
+        if size > max_bytes:
+            raise ValueError(f"Replay is larger than {max_bytes} bytes")
+        chunks.append(bytes(chunk))
+
+    if hasattr(source, 'read'):
+        loop = asyncio.get_running_loop()
+        while True:
+            if inspect.iscoroutinefunction(source.read):
+                chunk = await source.read(READ_CHUNK_BYTES)
+            else:
+                # A plain read() may block on a file or socket
+                chunk = await loop.run_in_executor(None, source.read, READ_CHUNK_BYTES)
+                if inspect.isawaitable(chunk):
+                    chunk = await chunk
+            if not chunk:
+                break
+            add(chunk)
+    elif hasattr(source, '__aiter__'):
+        async for chunk in source:
+            add(chunk)
+    else:
+        raise TypeError(f"Cannot read a replay from {type(source).__name__}")
+
+    return b''.join(chunks)
+
+
+_default_analyzer: Optional[AsyncAPMAnalyzer] = None
+
+
+async def analyze_apm_async(source: Union[str, os.PathLike, bytes, Any], name: Optional[str] = None,
+                            timeout: Optional[float] = None) -> Dict:
+    """
+    Analyze a replay without blocking the event loop.
+
+    Uses a process-wide AsyncAPMAnalyzer with default settings, created on
+    first use; its worker processes are shut down when the interpreter
+    exits. Create an AsyncAPMAnalyzer to choose the number of workers or the
+    concurrency limit, or to shut the workers down earlier.
+
+    Args:
+        source: Path, bytes, stream or async iterable of chunks (see
+            AsyncAPMAnalyzer.analyze)
+        name: File name reported in the results for bytes and streams
+        timeout: Optional seconds to wait for the result
+
+    Returns:
+        Dictionary with APM results
+
+    Raises:
+        AnalysisError: If the replay could not be analyzed
+        asyncio.TimeoutError: If the timeout expired
+    """
+    global _default_analyzer
+    if _default_analyzer is None:
+        _default_analyzer = AsyncAPMAnalyzer()
+        atexit.register(_shutdown_default_analyzer)
+    return await _default_analyzer.analyze(source, name=name, timeout=timeout)
+
+
+def _shutdown_default_analyzer():
+    """Shut down the default analyzer's worker processes at exit, when no event loop may be running."""
+    pool, _default_analyzer._pool = _default_analyzer._pool, None
+    if pool is not None:
+        pool.shutdown()
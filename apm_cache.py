@@ -0,0 +1,207 @@
+"""
+In-process LRU cache of APM analysis results.
+Lets interactive sessions revisit files without re-parsing them.
+"""
+
+import copy
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from apm_analyzer import APMAnalyzer
+
+
+# Default memory budget for cached results
+DEFAULT_CACHE_BYTES = 32 * 1024 * 1024
+
+
+def _estimate_size(obj) -> int:
+    """Roughly estimate the memory footprint of a results structure in bytes."""
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _estimate_size(key) + _estimate_size(value)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += _estimate_size(item)
+
+    return size
+
+
+class AnalysisCache:
+    """
+    Caches analysis results keyed by file path, modification time and size.
+
+    A file that is modified or replaced gets a new key, so stale results are
+    never returned. When the estimated size of all cached results exceeds
+    ``max_bytes``, the least recently used entries are evicted. Results are
+    copied on the way in and out, so callers may modify what they get.
+
+    Example:
+        cache = AnalysisCache()
+        results = cache.analyze('game.aoe2record')  # parses the file
+        results = cache.analyze('game.aoe2record')  # served from memory
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        """
+        Initialize the cache.
+
+        Args:
+            max_bytes: Maximum estimated size of all cached results
+
+        Raises:
+            ValueError: If max_bytes is not positive
+        """
+        if max_bytes <= 0:
+            raise ValueError(f"max_bytes must be positive: {max_bytes}")
+
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(record_file_path: str, stat: Optional[os.stat_result] = None) -> Tuple[str, int, int]:
+        """
+        Build the cache key for a record file.
+
+        Args:
+            record_file_path: Path to the record file
+            stat: Optional status of the file as it was read (default: its
+                current status)
+
+        Raises:
+            OSError: If the file cannot be accessed
+        """
+        if stat is None:
+            stat = os.stat(record_file_path)
+        return os.path.abspath(record_file_path), stat.st_mtime_ns, stat.st_size
+
+    def get(self, record_file_path: str) -> Optional[Dict]:
+        """
+        Look up cached results for a record file.
+
+        Returns:
+            The cached results, or None if the file is not cached or has changed
+        """
+        try:
+            key = self.make_key(record_file_path)
+        except OSError:
+            return None
+        return self._lookup(key)
+
+    def _lookup(self, key: Tuple[str, int, int]) -> Optional[Dict]:
+        """Get a copy of the results cached under a key."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            results = entry[0]
+        return copy.deepcopy(results)
+
+    def durations(self, record_file_paths: Iterable[str]) -> Dict[str, float]:
+        """
+        Look up the game durations of cached record files.
+
+        Useful as CostModel duration hints. Lookups don't count as hits or
+        misses and don't change the eviction order.
+
+        Returns:
+            Dictionary of game duration in minutes by path, for files that
+            are cached and unchanged
+        """
+        durations = {}
+        for path in record_file_paths:
+            try:
+                key = self.make_key(path)
+            except OSError:
+                continue
+            with self._lock:
+                entry = self._entries.get(key)
+            players = entry[0].get('players') if entry is not None else None
+            if players and players[0].get('duration_minutes'):
+                durations[path] = players[0]['duration_minutes']
+        return durations
+
+    def put(self, record_file_path: str, results: Dict, stat: Optional[os.stat_result] = None):
+        """
+        Store results for a record file, evicting old entries as needed.
+
+        Args:
+            record_file_path: Path to the record file
+            results: Results of analyzing the file
+            stat: Optional status of the file as it was analyzed, so results
+                of a file that changed since are not stored under its new key
+        """
+        try:
+            key = self.make_key(record_file_path, stat)
+        except OSError:
+            return
+
+        size = _estimate_size(results)
+        if size > self.max_bytes:
+            return
+        results = copy.deepcopy(results)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+
+            self._entries[key] = (results, size)
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def analyze(self, record_file_path: str) -> Optional[Dict]:
+        """
+        Get results for a record file, parsing it only if not already cached.
+
+        Args:
+            record_file_path: Path to the .aoe2record file
+
+        Returns:
+            Dictionary with APM results, or None if parsing failed
+
+        Raises:
+            FileNotFoundError: If the record file doesn't exist
+            ValueError: If the file is not a valid .aoe2record file
+        """
+        # Key and parse come from the same open file, so results are never
+        # stored under the key of a file that changed while it was parsed
+        with open(record_file_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            results = self._lookup(self.make_key(record_file_path, stat))
+            if results is not None:
+                return results
+            data = f.read()
+
+        analyzer = APMAnalyzer(record_file_path, data=data)
+        if not analyzer.parse():
+            return None
+
+        results = analyzer.get_results()
+        self.put(record_file_path, results, stat)
+        return results
+
+    def clear(self):
+        """Remove all cached results."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
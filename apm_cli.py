@@ -5,12 +5,21 @@ Command-line interface for AOE2 Record APM Analyzer
 
 import argparse
 import json
+import multiprocessing
 import os
 import sys
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
-from apm_analyzer import APMAnalyzer, analyze_apm
+from apm_accumulators import merge_player_intervals
+from apm_analyzer import APMAnalyzer, analyze_apm, print_results
+from apm_metrics import METRICS, configure_logging
+from apm_output import detect_format, write_results
+from apm_prefetch import ReplayPrefetcher, DEFAULT_PREFETCH_BYTES
+from apm_scheduler import BatchScheduler, CostModel
+from apm_stats import StoreMatchups
+from apm_store import ResultStore, GROUP_BY_COLUMNS
+from apm_watch import ReplayWatcher, default_record_directory, find_savegame_directories
 
 
 def find_record_files(directory: str) -> List[str]:
@@ -35,16 +44,20 @@ def find_record_files(directory: str) -> List[str]:
     return sorted(record_files)
 
 
-def process_single_file(file_path: str, output_format: str = 'text', output_file: str = None):
+def process_single_file(file_path: str, output_format: str = 'text', output_file: str = None,
+                        store: str = None, sample_rate: float = None, compact: bool = False):
     """
     Process a single .aoe2record file.
 
     Args:
         file_path: Path to the record file
-        output_format: Output format ('text' or 'json')
-        output_file: Optional output file path
+        output_format: Output format ('text', 'json', 'jsonl' or 'csv')
+        output_file: Optional output file path (compressed if it ends in .gz or .zst)
+        store: Optional SQLite database the results are added to
+        sample_rate: Optional fraction of the replay to sample for approximate APM
+        compact: Whether to write JSON without indentation
     """
-    analyzer = APMAnalyzer(file_path)
+    analyzer = APMAnalyzer(file_path, sample_rate=sample_rate)
 
     if not analyzer.parse():
         print(f"Failed to parse: {file_path}", file=sys.stderr)
@@ -52,59 +65,354 @@ def process_single_file(file_path: str, output_format: str = 'text', output_file
 
     results = analyzer.get_results()
 
-    if output_format == 'json':
-        output = json.dumps(results, indent=2)
+    if store:
+        store_results([results], store)
+
+    if output_format == 'text':
+        analyzer.print_results()
+    else:
+        write_results(results, output_file, output_format, indent=None if compact else 2)
         if output_file:
-            with open(output_file, 'w') as f:
-                f.write(output)
             print(f"Results written to: {output_file}")
-        else:
-            print(output)
-    else:
-        analyzer.print_results()
 
     return True
 
 
-def process_batch(files: List[str], output_format: str = 'text', output_file: str = None):
+def process_batch(files: List[str], output_format: str = 'text', output_file: str = None,
+                  prefetch_bytes: int = DEFAULT_PREFETCH_BYTES, jobs: int = 1,
+                  store: str = None, sample_rate: float = None, intervals: bool = False,
+                  metrics_file: str = None, compact: bool = False):
     """
     Process multiple .aoe2record files.
 
+    With a single job, upcoming files are read into memory on a background
+    thread while the current one is parsed, so disk reads overlap with
+    parsing. With several jobs, files are analyzed in worker processes,
+    largest first, and each worker reads its own files, so nothing is
+    prefetched. Game durations already in the store refine the predicted
+    time per file.
+
     Args:
         files: List of file paths
-        output_format: Output format ('text' or 'json')
-        output_file: Optional output file path
+        output_format: Output format ('text', 'json', 'jsonl' or 'csv')
+        output_file: Optional output file path (compressed if it ends in .gz or .zst)
+        prefetch_bytes: Maximum number of bytes read ahead of the parser (single job only)
+        jobs: Number of worker processes
+        store: Optional SQLite database the results are added to
+        sample_rate: Optional fraction of each replay to sample for approximate APM
+        intervals: Whether to print each player's action intervals over all games
+        metrics_file: Optional file the batch's metrics are written to
+            (Prometheus text, or JSON if it ends in .json)
+        compact: Whether to write JSON with one unindented result per line
+    """
+    if jobs > 1:
+        all_results, successful, failed = _process_parallel(files, output_format, jobs, sample_rate, store)
+    else:
+        all_results, successful, failed = _process_sequential(files, output_format, prefetch_bytes,
+                                                              sample_rate)
+
+    print(f"\nProcessed {successful + failed} files: {successful} successful, {failed} failed")
+
+    if store:
+        store_results(all_results, store)
+
+    if intervals and output_format == 'text':
+        print_interval_distributions(merge_player_intervals(all_results))
+
+    if output_format != 'text':
+        write_results(all_results, output_file, output_format, indent=None if compact else 2)
+        if output_file:
+            print(f"Results written to: {output_file}")
+
+    if metrics_file:
+        METRICS.write(metrics_file)
+        print(f"Metrics written to: {metrics_file}")
+
+
+def store_results(all_results: List, store: str):
+    """
+    Add results to a SQLite results database.
+
+    Args:
+        all_results: List of result dictionaries
+        store: Path to the SQLite database
+    """
+    with ResultStore(store) as result_store:
+        written = result_store.add_results(all_results)
+    print(f"Stored {written} game(s) in: {store}")
+
+
+def print_interval_distributions(histograms: Dict, limit: int = None):
+    """
+    Print per-player action interval distributions, most intervals first.
+
+    Args:
+        histograms: Dictionary of player name to IntervalHistogram
+        limit: Optional maximum number of players shown
+    """
+    if not histograms:
+        print("No action intervals available.")
+        return
+
+    ranked = sorted(histograms.items(), key=lambda item: (-item[1].count, item[0]))[:limit]
+    print(f"\n{'Player':<25} {'Intervals':<10} {'Median ms':<10} {'p95 ms':<10} {'p99 ms':<10}")
+    print(f"{'-'*70}")
+    for name, histogram in ranked:
+        summary = histogram.to_dict()
+        print(f"{name:<25} {summary['count']:<10} {summary['median_ms']:<10.1f} "
+              f"{summary['p95_ms']:<10.1f} {summary['p99_ms']:<10.1f}")
+
+
+def print_pair_result(result: Dict, label: str):
     """
+    Print a head-to-head or civilization matchup record.
+
+    Args:
+        result: Dictionary from StoreMatchups.head_to_head() or civ_matchup()
+        label: 'player' or 'civ'
+    """
+    side1, side2 = result[f'{label}1'], result[f'{label}2']
+    print(f"\n{side1} vs {side2}: {result['games']} game(s)")
+    if not result['games']:
+        return
+
+    if result[f'{label}1_wins'] is not None:
+        win_rate = result[f'{label}1_win_rate']
+        win_rate = f" ({win_rate:.1%} for {side1})" if win_rate is not None else ''
+        print(f"Wins: {side1} {result[f'{label}1_wins']}, {side2} {result[f'{label}2_wins']}{win_rate}")
+    print(f"Average APM: {side1} {result[f'{label}1_avg_apm']:.2f}, {side2} {result[f'{label}2_avg_apm']:.2f}")
+    delta = result['apm_delta']
+    print(f"APM delta: mean {delta['mean']:+.2f}, median {delta['median']:+.2f}")
+
+    buckets = result.get('win_rate_by_apm_delta')
+    if buckets:
+        print(f"\n{'APM delta':<20} {'Games':<8} {'Win rate':<8}")
+        print(f"{'-'*40}")
+        for bucket in buckets:
+            span = f"{bucket['apm_delta_from']:+d} to {bucket['apm_delta_to']:+d}"
+            print(f"{span:<20} {bucket['games']:<8} {bucket['win_rate']:<8.1%}")
+
+
+def _process_sequential(files: List[str], output_format: str, prefetch_bytes: int,
+                        sample_rate: float = None):
+    """Analyze files one at a time, prefetching upcoming files."""
     all_results = []
     successful = 0
     failed = 0
 
-    for file_path in files:
-        print(f"Processing: {file_path}")
-        analyzer = APMAnalyzer(file_path)
+    with ReplayPrefetcher(files, max_bytes=prefetch_bytes) as prefetcher:
+        for file_path, data, error in prefetcher:
+            print(f"Processing: {file_path}")
 
-        if analyzer.parse():
-            results = analyzer.get_results()
-            all_results.append(results)
+            if error is not None:
+                print(f"Failed to read: {file_path} ({error})", file=sys.stderr)
+                METRICS.files_failed.inc(reason='read_error')
+                failed += 1
+                continue
+
+            analyzer = APMAnalyzer(file_path, data=data, sample_rate=sample_rate)
+
+            if analyzer.parse():
+                results = analyzer.get_results()
+                all_results.append(results)
+
+                if output_format == 'text':
+                    analyzer.print_results()
+
+                successful += 1
+            else:
+                print(f"Failed to parse: {file_path}", file=sys.stderr)
+                failed += 1
+
+    return all_results, successful, failed
 
-            if output_format == 'text':
-                analyzer.print_results()
 
+def _process_parallel(files: List[str], output_format: str, jobs: int, sample_rate: float = None,
+                      store: str = None):
+    """Analyze files in worker processes, reporting predicted vs actual time."""
+    duration_hints = None
+    if store and os.path.exists(store):
+        with ResultStore(store) as result_store:
+            duration_hints = result_store.durations(files)
+    scheduler = BatchScheduler(files, workers=jobs, cost_model=CostModel(duration_hints=duration_hints),
+                               sample_rate=sample_rate)
+    successful = 0
+    failed = 0
+
+    for item in scheduler.run():
+        print(f"Processed: {item.path} "
+              f"(predicted {item.predicted_seconds:.2f}s, actual {item.actual_seconds or 0:.2f}s)")
+
+        if item.results is not None:
+            if output_format == 'text':
+                print_results(item.results)
             successful += 1
         else:
-            print(f"Failed to parse: {file_path}", file=sys.stderr)
+            print(f"Failed to parse: {item.path} ({item.error})", file=sys.stderr)
             failed += 1
 
-    print(f"\nProcessed {successful + failed} files: {successful} successful, {failed} failed")
+    summary = scheduler.summary()
+    print(f"\nWall time: {summary['wall_seconds']:.2f}s, "
+          f"worker time: {summary['cpu_seconds']:.2f}s, "
+          f"ideal: {summary['ideal_seconds']:.2f}s on {summary['workers']} workers")
 
-    if output_format == 'json':
-        output = json.dumps(all_results, indent=2)
-        if output_file:
-            with open(output_file, 'w') as f:
-                f.write(output)
-            print(f"Results written to: {output_file}")
+    # Keep output in the original file order regardless of completion order
+    all_results = [item.results for item in scheduler.items if item.results is not None]
+    return all_results, successful, failed
+
+
+def watch_directories(directories: List[str], output_format: str = 'text', output_file: str = None,
+                      store: str = None, metrics_file: str = None, profile_root: str = None):
+    """
+    Analyze new .aoe2record files as they appear, until interrupted.
+
+    Args:
+        directories: Directories to watch
+        output_format: Output format ('text' or 'json')
+        output_file: Optional JSON Lines file each result is appended to
+        store: Optional SQLite database each result is added to
+        metrics_file: Optional file the metrics are rewritten to after each
+            analysis (Prometheus text, or JSON if it ends in .json)
+        profile_root: Optional directory whose <profile ID>/savegame folders
+            are watched, including ones created while watching
+    """
+    def on_result(file_path, results, error):
+        if metrics_file:
+            METRICS.write(metrics_file)
+
+        if results is None:
+            print(f"Failed to parse: {file_path} ({error})", file=sys.stderr)
+            return
+
+        if store:
+            store_results([results], store)
+
+        if output_format in ('json', 'jsonl') and not output_file:
+            print(json.dumps(results), flush=True)
+        elif output_format == 'text':
+            print_results(results)
+        else:
+            print(f"Analyzed: {file_path}", flush=True)
+
+    watcher = ReplayWatcher(directories, on_result=on_result, output_file=output_file,
+                            profile_root=profile_root)
+    mode = "inotify" if watcher.use_inotify else "polling"
+    for directory in directories:
+        print(f"Watching ({mode}): {directory}", file=sys.stderr)
+    watcher.run()
+
+
+def query_store(argv: List[str]):
+    """
+    Query a SQLite results database created with --store.
+
+    Args:
+        argv: Command-line arguments following 'query'
+    """
+    parser = argparse.ArgumentParser(
+        prog='apm_cli.py query',
+        description='Query a results database created with --store.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # Games where TheViper had more than 150 APM on Arabia
+  aoe2-apm.exe query results.db --player TheViper --min-apm 150 --map Arabia
+
+  # Average APM and win rate per civilization
+  aoe2-apm.exe query results.db --group-by civilization
+
+  # Time between actions for each player, over all their stored games
+  aoe2-apm.exe query results.db --intervals
+
+  # Record between two players, and between two civilizations on Arabia
+  aoe2-apm.exe query results.db --head-to-head TheViper Hera
+  aoe2-apm.exe query results.db --matchup Aztecs Mayans --map Arabia
+        """
+    )
+    parser.add_argument('database', help='Path to the SQLite results database')
+    parser.add_argument('--player', help='Only rows for this player name')
+    parser.add_argument('--civ', help='Only rows for this civilization')
+    parser.add_argument('--map', help='Only games on this map')
+    parser.add_argument('--min-apm', type=float, help='Minimum APM')
+    parser.add_argument('--max-apm', type=float, help='Maximum APM')
+    result_group = parser.add_mutually_exclusive_group()
+    result_group.add_argument('--winner', dest='winner', action='store_const', const=True,
+                              help='Only winning players')
+    result_group.add_argument('--loser', dest='winner', action='store_const', const=False,
+                              help='Only losing players')
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument('--group-by', choices=list(GROUP_BY_COLUMNS),
+                            help='Aggregate matching rows by this column')
+    mode_group.add_argument('--intervals', action='store_true',
+                            help='Show action interval distributions per player instead of rows')
+    mode_group.add_argument('--head-to-head', nargs=2, metavar=('PLAYER1', 'PLAYER2'),
+                            help='Show the record between two players')
+    mode_group.add_argument('--matchup', nargs=2, metavar=('CIV1', 'CIV2'),
+                            help='Show the record between two civilizations (same civ twice for mirrors)')
+    parser.add_argument('--limit', type=int, default=100,
+                        help='Maximum number of rows to show (default: 100)')
+    parser.add_argument('-f', '--format', choices=['text', 'json'], default='text',
+                        help='Output format (default: text)')
+
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.database):
+        print(f"Error: Database not found: {args.database}", file=sys.stderr)
+        sys.exit(1)
+
+    filters = dict(player=args.player, civilization=args.civ, map_name=args.map,
+                   min_apm=args.min_apm, max_apm=args.max_apm, winner=args.winner)
+
+    if args.head_to_head or args.matchup:
+        with ResultStore(args.database) as result_store:
+            matchups = StoreMatchups(result_store)
+            if args.head_to_head:
+                result, label = matchups.head_to_head(*args.head_to_head, **filters), 'player'
+            else:
+                result, label = matchups.civ_matchup(*args.matchup, **filters), 'civ'
+        if args.format == 'json':
+            print(json.dumps(result, indent=2))
         else:
-            print(output)
+            print_pair_result(result, label)
+        return
+
+    if args.intervals:
+        with ResultStore(args.database) as result_store:
+            histograms = result_store.interval_distributions(**filters)
+        if args.format == 'json':
+            print(json.dumps({name: histogram.to_dict() for name, histogram in histograms.items()}, indent=2))
+        else:
+            print_interval_distributions(histograms, args.limit)
+        return
+
+    with ResultStore(args.database) as result_store:
+        if args.group_by:
+            rows = result_store.aggregate(args.group_by, **filters)[:args.limit]
+        else:
+            rows = result_store.query(limit=args.limit, **filters)
+
+    if args.format == 'json':
+        print(json.dumps(rows, indent=2))
+        return
+
+    if not rows:
+        print("No matching rows.")
+        return
+
+    if args.group_by:
+        print(f"{args.group_by.capitalize():<25} {'Games':<8} {'Avg APM':<10} {'Max APM':<10} {'Win rate':<8}")
+        print(f"{'-'*70}")
+        for row in rows:
+            win_rate = f"{row['win_rate']:.1%}" if row['win_rate'] is not None else ''
+            print(f"{str(row[args.group_by]):<25} {row['games']:<8} "
+                  f"{row['avg_apm']:<10.2f} {row['max_apm']:<10.2f} {win_rate:<8}")
+    else:
+        print(f"{'Player':<20} {'Civ':<15} {'Map':<15} {'APM':<10} {'Winner':<8} File")
+        print(f"{'-'*90}")
+        for row in rows:
+            winner_mark = '✓' if row['winner'] else ''
+            print(f"{row['name']:<20} {str(row['civilization']):<15} {str(row['map'] or ''):<15} "
+                  f"{row['apm']:<10.2f} {winner_mark:<8} {row['file']}")
 
 
 def main():
@@ -120,6 +428,10 @@ def main():
             print("Run with --help for usage information.", file=sys.stderr)
             sys.exit(1)
 
+    if sys.argv[1] == 'query':
+        query_store(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(
         description='Extract player APM (Actions Per Minute) from AOE2 record files.',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -142,11 +454,31 @@ Examples:
 
   # Batch process and save to JSON
   aoe2-apm.exe /path/to/records/ --batch --format json --output all_results.json
+
+  # Batch process to gzip-compressed CSV (one row per player)
+  aoe2-apm.exe /path/to/records/ --batch --output all_results.csv.gz
+
+  # Batch process with 4 worker processes
+  aoe2-apm.exe /path/to/records/ --batch --jobs 4
+
+  # Analyze new games as they are saved, appending JSON lines to a file
+  aoe2-apm.exe --watch --format json --output new_games.jsonl
+
+  # Batch process into a SQLite database, then query it
+  aoe2-apm.exe /path/to/records/ --batch --store results.db
+  aoe2-apm.exe query results.db --player TheViper --min-apm 150 --map Arabia
+
+  # Fast approximate APM (with error bounds) from 20% of each replay
+  aoe2-apm.exe /path/to/records/ --batch --jobs 4 --sample 0.2 --store trends.db
+
+  # Batch process with Prometheus metrics and JSON log lines for failures
+  aoe2-apm.exe /path/to/records/ --batch --jobs 8 --metrics apm.prom --log-format json
         """
     )
 
     parser.add_argument(
         'input',
+        nargs='?',
         help='Path to .aoe2record file or directory containing record files'
     )
 
@@ -156,16 +488,86 @@ Examples:
         help='Process all .aoe2record files in the specified directory'
     )
 
+    parser.add_argument(
+        '-w', '--watch',
+        action='store_true',
+        help='Watch a directory (default: the AOE2 DE savegame folders) and '
+             'analyze new record files as they are written (on Linux, install '
+             'inotify_simple to use file events instead of polling)'
+    )
+
     parser.add_argument(
         '-f', '--format',
-        choices=['text', 'json'],
+        choices=['text', 'json', 'jsonl', 'csv'],
         default='text',
-        help='Output format (default: text)'
+        help='Output format (default: text, or from the output file extension)'
     )
 
     parser.add_argument(
         '-o', '--output',
-        help='Output file path (default: stdout)'
+        help='Output file path (default: stdout); a .gz or .zst extension compresses it'
+    )
+
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='Write JSON output without indentation, one result per line (much faster for large batches)'
+    )
+
+    parser.add_argument(
+        '--store',
+        metavar='DATABASE',
+        help='Also add results to this SQLite database (see: query --help)'
+    )
+
+    parser.add_argument(
+        '--sample',
+        type=float,
+        metavar='RATE',
+        help='Estimate APM from this fraction of each replay, e.g. 0.2 '
+             '(approximate, with 95%% error bounds)'
+    )
+
+    parser.add_argument(
+        '--intervals',
+        action='store_true',
+        help='In batch mode, also print each player\'s time between actions over all games'
+    )
+
+    parser.add_argument(
+        '--metrics',
+        metavar='FILE',
+        help='In batch and watch mode, write file counts, failures by reason, fallbacks, bytes read '
+             'and parse times to FILE: Prometheus text, or JSON if it ends in .json'
+    )
+
+    parser.add_argument(
+        '--log-level',
+        choices=['debug', 'info', 'warning', 'error'],
+        default='warning',
+        help='Lowest level of problems reported on stderr; debug includes tracebacks (default: warning)'
+    )
+
+    parser.add_argument(
+        '--log-format',
+        choices=['text', 'json'],
+        default='text',
+        help='Format of problems reported on stderr: text lines or one JSON object per line (default: text)'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes for batch processing (default: 1)'
+    )
+
+    parser.add_argument(
+        '--prefetch-mb',
+        type=int,
+        default=DEFAULT_PREFETCH_BYTES // (1024 * 1024),
+        help='Megabytes of replay data to read ahead during batch processing with a single job '
+             f'(default: {DEFAULT_PREFETCH_BYTES // (1024 * 1024)})'
     )
 
     parser.add_argument(
@@ -176,6 +578,34 @@ Examples:
 
     args = parser.parse_args()
 
+    if args.sample is not None and not 0 < args.sample <= 1:
+        parser.error("--sample must be greater than 0 and at most 1")
+
+    if args.metrics and not (args.batch or args.watch):
+        parser.error("--metrics requires --batch or --watch")
+
+    configure_logging(args.log_level, args.log_format)
+
+    if args.watch and args.format == 'csv':
+        parser.error("--watch writes JSON lines; use --format text, json or jsonl")
+
+    if args.output and args.format == 'text' and not args.watch:
+        # e.g. --output results.csv.gz writes compressed CSV
+        args.format = detect_format(args.output, default='text')[0]
+
+    if args.watch:
+        profile_root = None if args.input else default_record_directory()
+        directories = [args.input] if args.input else find_savegame_directories(profile_root)
+        try:
+            watch_directories(directories, args.format, args.output, store=args.store,
+                              metrics_file=args.metrics, profile_root=profile_root)
+        except KeyboardInterrupt:
+            print("\nStopped watching", file=sys.stderr)
+        return
+
+    if not args.input:
+        parser.error("the following arguments are required: input")
+
     # Validate input path
     if not os.path.exists(args.input):
         print(f"Error: Path not found: {args.input}", file=sys.stderr)
@@ -190,7 +620,14 @@ Examples:
                 sys.exit(1)
 
             print(f"Found {len(files)} .aoe2record file(s)\n")
-            process_batch(files, args.format, args.output)
+            process_batch(files, args.format, args.output,
+                          prefetch_bytes=max(args.prefetch_mb, 1) * 1024 * 1024,
+                          jobs=max(args.jobs, 1),
+                          store=args.store,
+                          sample_rate=args.sample,
+                          intervals=args.intervals,
+                          metrics_file=args.metrics,
+                          compact=args.compact)
 
         else:
             # Single file processing
@@ -203,7 +640,8 @@ Examples:
                 print(f"Error: File must have .aoe2record extension", file=sys.stderr)
                 sys.exit(1)
 
-            success = process_single_file(args.input, args.format, args.output)
+            success = process_single_file(args.input, args.format, args.output, store=args.store,
+                                          sample_rate=args.sample, compact=args.compact)
             sys.exit(0 if success else 1)
 
     except KeyboardInterrupt:
@@ -215,4 +653,6 @@ Examples:
 
 
 if __name__ == '__main__':
+    # Required for worker processes in the frozen Windows executable
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,343 @@
+"""
+Resilient streaming decoder for .aoe2record bodies.
+Keeps decoding past truncated or corrupt data by resynchronizing on the next
+valid operation boundary, and reports how much of the game was covered.
+"""
+
+import struct
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Iterator, Optional, Tuple
+
+from mgz import fast
+from mgz.fast import Action, Operation
+
+
+# Bytes scanned for a valid operation boundary after corrupt data
+DEFAULT_RESYNC_WINDOW = 1024 * 1024
+
+# Consecutive operations that must decode cleanly to accept a resync point
+DEFAULT_CONFIRM_OPERATIONS = 3
+
+# Sanity limits used to reject garbage that happens to decode
+MAX_ACTION_LENGTH = 64 * 1024
+MAX_CHAT_LENGTH = 64 * 1024
+MAX_SYNC_INCREMENT_MS = 10 * 60 * 1000
+
+# Little-endian ids of the operations a resync point may start with
+_RESYNC_MARKERS = tuple(struct.pack('<I', op.value) for op in (
+    Operation.ACTION, Operation.SYNC, Operation.VIEWLOCK, Operation.CHAT
+))
+
+_ACTION_IDS = frozenset(action.value for action in Action)
+
+# Actions whose payloads are still decoded when skimming: research and
+# special orders (which include unqueueing) give age-up times. Both are rare.
+_SKIM_DECODED_ACTIONS = frozenset({Action.RESEARCH, Action.SPECIAL})
+
+# Bytes of a DE checksum sync after its first 8 bytes: 8 players x 11 values,
+# then the absolute game time
+_DE_SYNC_VALUES_LENGTH = 4 * 8 * 11
+
+
+class CorruptOperation(Exception):
+    """Raised when the data at the current position is not a valid operation."""
+
+
+@dataclass
+class DecodeStats:
+    """Summary of what a decoder managed to read."""
+
+    operations: int = 0
+    covered_ms: int = 0
+    corrupt_regions: int = 0
+    bytes_skipped: int = 0
+    truncated: bool = False
+
+    @property
+    def partial(self) -> bool:
+        """Whether any part of the body could not be decoded."""
+        return self.truncated or self.corrupt_regions > 0
+
+
+class ResilientDecoder:
+    """
+    Iterates over body operations, skipping over corrupt or truncated data.
+
+    Each operation is validated before it is accepted. When the data at the
+    current position is not a valid operation, the decoder scans forward for
+    the next offset where several operations in a row decode cleanly and
+    resumes from there. If no such offset is found, the rest of the file is
+    treated as truncated.
+
+    The timestamp of each operation is the sum of sync increments decoded so
+    far, so time lost in corrupt regions is excluded from ``covered_ms``.
+
+    With ``skim`` set, operations are only decoded as far as APM counting
+    needs: syncs yield their increment (and the absolute game time on DE),
+    viewlocks are skipped without unpacking, and DE actions yield only the
+    player id. This avoids most of the per-operation parsing work.
+
+    Example:
+        decoder = ResilientDecoder(handle)
+        for timestamp, op_type, op_data in decoder.operations():
+            ...
+        print(decoder.stats.partial, decoder.stats.covered_ms)
+    """
+
+    def __init__(self, handle: BinaryIO, eof: Optional[int] = None,
+                 resync_window: int = DEFAULT_RESYNC_WINDOW,
+                 confirm_operations: int = DEFAULT_CONFIRM_OPERATIONS,
+                 skim: bool = False):
+        """
+        Initialize the decoder.
+
+        Args:
+            handle: Seekable binary stream positioned at the first body operation
+            eof: Offset of the end of the data (default: end of the stream)
+            resync_window: Maximum number of bytes scanned per resync attempt
+            confirm_operations: Operations that must decode to accept a resync
+            skim: Whether to decode only what APM counting needs
+        """
+        self.handle = handle
+        if eof is None:
+            start = handle.tell()
+            eof = handle.seek(0, 2)
+            handle.seek(start)
+        self.eof = eof
+        self.resync_window = resync_window
+        self.confirm_operations = confirm_operations
+        self.skim = skim
+        self.stats = DecodeStats()
+
+    def operations(self, resync_until: Optional[int] = None) -> Iterator[Tuple[int, Operation, Any]]:
+        """
+        Decode operations until the end of the data.
+
+        Args:
+            resync_until: Optional offset that corrupt data is not scanned
+                past: if the data doesn't decode again before it, decoding
+                stops with the stream left at the corrupt operation
+                (default: scan to the end of the data)
+
+        Yields:
+            Tuples of (timestamp in milliseconds, operation type, operation data)
+        """
+        timestamp = 0
+        limit = self.eof if resync_until is None else min(resync_until, self.eof)
+
+        while self.handle.tell() < self.eof:
+            start = self.handle.tell()
+            try:
+                op_type, op_data = self._read_operation()
+            except CorruptOperation:
+                # Scan window by window until the data decodes again
+                offset, found = start + 1, False
+                while offset < limit and not found:
+                    found = self._resync(offset)
+                    offset += self.resync_window
+                if not found and limit < self.eof:
+                    self.handle.seek(start)
+                    break
+                if not found:
+                    self.stats.truncated = True
+                    self.stats.bytes_skipped += self.eof - start
+                    break
+                self.stats.corrupt_regions += 1
+                self.stats.bytes_skipped += self.handle.tell() - start
+                continue
+
+            self.stats.operations += 1
+            if op_type is Operation.SYNC:
+                timestamp += op_data[0]
+                self.stats.covered_ms = timestamp
+
+            yield timestamp, op_type, op_data
+
+            if op_type is Operation.POSTGAME:
+                break
+
+    def seek_operation(self, offset: int) -> bool:
+        """
+        Move to the first valid operation in the resync window starting at an offset.
+
+        Returns:
+            True if one was found, False if there is none within
+            resync_window bytes (the stream is then left at the offset)
+        """
+        return self._resync(offset)
+
+    def _read_operation(self) -> Tuple[Operation, Any]:
+        """
+        Read and validate the operation at the current position.
+
+        Raises:
+            CorruptOperation: If the data is not a valid, complete operation
+        """
+        handle = self.handle
+        start = handle.tell()
+        remaining = self.eof - start
+
+        try:
+            op_id, = struct.unpack('<I', handle.read(4))
+
+            if op_id == Operation.ACTION.value:
+                length, = struct.unpack('<I', handle.read(4))
+                if not 0 < length <= MAX_ACTION_LENGTH or length + 12 > remaining:
+                    raise CorruptOperation(f"bad action length {length} at {start}")
+                action_id = handle.read(1)[0]
+                if action_id not in _ACTION_IDS:
+                    # Well-framed but unknown to this mgz version; skip it
+                    handle.seek(length - 1 + 4, 1)
+                    return Operation.ACTION, (Action.ERROR, {})
+                if self.skim and action_id != Action.POSTGAME.value:
+                    return Operation.ACTION, self._skim_action(action_id, length)
+                handle.seek(-5, 1)
+                action_type, payload = fast.action(handle)
+                return Operation.ACTION, (action_type, payload)
+
+            if op_id == Operation.SYNC.value:
+                if remaining == 8:
+                    # A plain time increment as the very last operation
+                    increment, = struct.unpack('<I', handle.read(4))
+                    return Operation.SYNC, (increment, None, {})
+                if self.skim:
+                    increment, checksum, payload = self._skim_sync()
+                else:
+                    increment, checksum, payload = fast.sync(handle)
+                if not 0 <= increment <= MAX_SYNC_INCREMENT_MS or handle.tell() > self.eof:
+                    raise CorruptOperation(f"bad sync increment {increment} at {start}")
+                return Operation.SYNC, (increment, checksum, payload)
+
+            if op_id == Operation.VIEWLOCK.value:
+                if remaining < 16:
+                    raise CorruptOperation(f"truncated viewlock at {start}")
+                if self.skim:
+                    handle.seek(12, 1)
+                    return Operation.VIEWLOCK, None
+                return Operation.VIEWLOCK, fast.viewlock(handle)
+
+            if op_id == Operation.CHAT.value:
+                _, length = struct.unpack('<II', handle.read(8))
+                if length > MAX_CHAT_LENGTH or length + 12 > remaining:
+                    raise CorruptOperation(f"bad chat length {length} at {start}")
+                return Operation.CHAT, handle.read(length)
+
+            if op_id == Operation.POSTGAME.value:
+                try:
+                    return Operation.POSTGAME, fast.postgame(handle)
+                except Exception:
+                    # Trailing postgame data is optional; treat the body as complete
+                    return Operation.POSTGAME, {}
+
+            # Any other id is the length prefix of a saved chapter
+            if not start < op_id <= self.eof:
+                raise CorruptOperation(f"unknown operation {op_id} at {start}")
+            fast.save(handle)
+            if handle.tell() < self.eof:
+                marker = handle.read(4)
+                handle.seek(-len(marker), 1)
+                if marker not in _RESYNC_MARKERS:
+                    raise CorruptOperation(f"bad saved chapter length {op_id} at {start}")
+            return Operation.SAVE, None
+
+        except CorruptOperation:
+            raise
+        except Exception as e:
+            # struct.error on short reads, ValueError on unknown action ids
+            raise CorruptOperation(f"{type(e).__name__} at {start}: {e}")
+
+    def _skim_action(self, action_id: int, length: int) -> Tuple[Action, Any]:
+        """Read an action's player id, skipping the rest of its payload."""
+        action_type = Action(action_id)
+        action_bytes = self.handle.read(length - 1)
+        self.handle.seek(4, 1)  # sequence
+
+        # DE actions start with the player id and their own payload length
+        if len(action_bytes) >= 3 and struct.unpack_from('<h', action_bytes, 1)[0] == len(action_bytes) - 3:
+            if action_type not in _SKIM_DECODED_ACTIONS:
+                return action_type, {'player_id': action_bytes[0]}
+        try:
+            return action_type, fast.parse_action(action_type, action_bytes)
+        except struct.error:
+            return Action.ERROR, {}
+
+    def _skim_sync(self) -> Tuple[int, None, Any]:
+        """Read a sync's time increment, skipping its checksum values."""
+        handle = self.handle
+        increment, marker = struct.unpack('<II', handle.read(8))
+        if marker:
+            handle.seek(-4, 1)
+            return increment, None, {}
+        is_de, = struct.unpack('<12xI', handle.read(16))
+        if not is_de:
+            handle.seek(8, 1)
+            return increment, None, {}
+        handle.seek(_DE_SYNC_VALUES_LENGTH - 16, 1)
+        current_time, = struct.unpack('<I', handle.read(4))
+        return increment, None, {'current_time': current_time}
+
+    def _resync(self, offset: int) -> bool:
+        """
+        Find the first offset in the resync window where several operations decode cleanly.
+
+        Only points within resync_window bytes of the offset are tried, so
+        the cost of a failed attempt is bounded. Leaves the stream
+        positioned at the point found, or at the offset if there is none.
+
+        Returns:
+            True if a resync point was found, False otherwise
+        """
+        handle = self.handle
+        length = min(self.resync_window, self.eof - offset)
+        if length <= 0:
+            return False
+
+        handle.seek(offset)
+        # A few bytes more, so markers that start at the end of the window are found
+        window = handle.read(length + 3)
+        candidates = sorted(
+            index
+            for marker in _RESYNC_MARKERS
+            for index in _find_all(window, marker)
+            if index < length
+        )
+
+        for index in candidates:
+            if self._confirm(offset + index):
+                handle.seek(offset + index)
+                return True
+
+        handle.seek(offset)
+        return False
+
+    def _confirm(self, offset: int) -> bool:
+        """Check that several operations in a row decode from an offset."""
+        self.handle.seek(offset)
+        synced = False
+        for _ in range(self.confirm_operations):
+            if self.handle.tell() >= self.eof:
+                # Too few operations are left to confirm the point; only
+                # accept it if one of them was a sync, which random bytes
+                # rarely decode as
+                return synced
+            try:
+                op_type, op_data = self._read_operation()
+            except CorruptOperation:
+                return False
+            if op_type is Operation.ACTION and op_data[0] is Action.ERROR:
+                return False
+            if op_type is Operation.SYNC:
+                synced = True
+            # A false saved chapter length or postgame block can jump far
+            # ahead in the body, possibly to its end
+            if op_type is Operation.SAVE or (op_type is Operation.POSTGAME and not op_data):
+                return False
+        return True
+
+
+def _find_all(data: bytes, marker: bytes) -> Iterator[int]:
+    """Yield every index at which a marker occurs in data."""
+    index = data.find(marker)
+    while index != -1:
+        yield index
+        index = data.find(marker, index + 1)
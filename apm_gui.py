@@ -6,9 +6,302 @@ Provides a user-friendly graphical interface for analyzing .aoe2record files
 import tkinter as tk
 from tkinter import filedialog, messagebox, scrolledtext, ttk
 import os
-import json
 from pathlib import Path
-from apm_analyzer import APMAnalyzer
+from typing import Dict, List, Optional
+from apm_cache import AnalysisCache
+from apm_output import write_results
+from apm_watch import default_record_directory
+
+
+# Batch results table columns: (key, heading, width, anchor)
+BATCH_COLUMNS = (
+    ('file', 'File', 220, tk.W),
+    ('map', 'Map', 90, tk.W),
+    ('player', 'Player', 150, tk.W),
+    ('civilization', 'Civilization', 100, tk.W),
+    ('apm', 'APM', 70, tk.E),
+    ('actions', 'Actions', 70, tk.E),
+    ('duration', 'Minutes', 70, tk.E),
+    ('winner', 'Winner', 60, tk.CENTER),
+)
+
+# Milliseconds to wait after the last filter keystroke before filtering
+FILTER_DELAY_MS = 200
+
+
+class BatchResultRows:
+    """
+    Per-player rows of batch results, with sorting and filtering.
+
+    Rows are built once from the analysis results; sorting and filtering only
+    rearrange a list of row indices. Each column's sort order is computed
+    once and cached, so switching between columns doesn't re-sort.
+    """
+
+    def __init__(self, all_results: List[Dict]):
+        """
+        Build the rows.
+
+        Args:
+            all_results: Dictionaries as returned by APMAnalyzer.get_results()
+        """
+        self.rows = []
+        for results in all_results:
+            for player in results['players']:
+                self.rows.append((
+                    results['file'],
+                    results.get('map') or '',
+                    player['name'],
+                    player['civilization'] or '',
+                    player['apm'],
+                    player['total_actions'],
+                    player.get('duration_minutes') or 0,
+                    bool(player['winner']),
+                ))
+
+        # Lower-case player and civilization text for filtering
+        self._search = [f"{row[2]}\n{row[3]}".lower() for row in self.rows]
+        self._orders: Dict[int, List[int]] = {}
+        self._order = list(range(len(self.rows)))
+        self._filters = ('', None, None)
+        self.view = self._order
+        self.sort_column: Optional[str] = None
+        self.descending = False
+
+    def __len__(self):
+        return len(self.view)
+
+    @property
+    def total(self) -> int:
+        """Number of rows before filtering."""
+        return len(self.rows)
+
+    def values(self, position: int) -> tuple:
+        """Get the display values of the row at a position in the view."""
+        file, map_name, name, civilization, apm, actions, duration, winner = self.rows[self.view[position]]
+        return (file, map_name, name, civilization, f"{apm:.2f}", actions,
+                f"{duration:.2f}", '👑' if winner else '')
+
+    def sort(self, column: str, descending: bool = False):
+        """
+        Sort the rows by a column, keeping the current filters.
+
+        Args:
+            column: Column key from BATCH_COLUMNS
+            descending: Whether to sort highest first
+        """
+        index = [key for key, _, _, _ in BATCH_COLUMNS].index(column)
+        if index not in self._orders:
+            rows = self.rows
+            if isinstance(rows[0][index], str) if rows else False:
+                key = lambda i: rows[i][index].lower()
+            else:
+                key = lambda i: rows[i][index]
+            self._orders[index] = sorted(range(len(rows)), key=key)
+
+        order = self._orders[index]
+        self._order = order[::-1] if descending else order
+        self.sort_column = column
+        self.descending = descending
+        self.filter(*self._filters)
+
+    def filter(self, text: str = '', min_apm: Optional[float] = None,
+               max_apm: Optional[float] = None):
+        """
+        Show only rows matching all of the given filters.
+
+        Args:
+            text: Text that the player name or civilization must contain
+            min_apm: Lowest APM shown
+            max_apm: Highest APM shown
+        """
+        self._filters = (text, min_apm, max_apm)
+        text = text.strip().lower()
+        if not text and min_apm is None and max_apm is None:
+            self.view = self._order
+            return
+
+        rows, search = self.rows, self._search
+        low = float('-inf') if min_apm is None else min_apm
+        high = float('inf') if max_apm is None else max_apm
+        self.view = [
+            i for i in self._order
+            if low <= rows[i][4] <= high and (not text or text in search[i])
+        ]
+
+
+class BatchResultsTable(ttk.Frame):
+    """
+    Sortable, filterable table of batch results.
+
+    The Treeview only ever holds the rows that fit on screen: scrolling
+    rewrites the values of those items instead of moving through one item
+    per row, so the table stays responsive with hundreds of thousands of
+    rows. Click a column heading to sort by it; click again to reverse.
+    """
+
+    def __init__(self, parent):
+        """Create the table widgets."""
+        super().__init__(parent)
+        self.rows = BatchResultRows([])
+        self._offset = 0
+        self._visible = 1
+        self._render_pending = None
+        self._filter_pending = None
+
+        # Filter bar
+        filter_frame = ttk.Frame(self)
+        filter_frame.grid(row=0, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(0, 5))
+
+        self.text_var = tk.StringVar()
+        self.min_apm_var = tk.StringVar()
+        self.max_apm_var = tk.StringVar()
+        ttk.Label(filter_frame, text="Player/civ:").grid(row=0, column=0, padx=(0, 5))
+        ttk.Entry(filter_frame, textvariable=self.text_var, width=20).grid(row=0, column=1, padx=(0, 15))
+        ttk.Label(filter_frame, text="APM from").grid(row=0, column=2, padx=(0, 5))
+        ttk.Entry(filter_frame, textvariable=self.min_apm_var, width=7).grid(row=0, column=3, padx=(0, 5))
+        ttk.Label(filter_frame, text="to").grid(row=0, column=4, padx=(0, 5))
+        ttk.Entry(filter_frame, textvariable=self.max_apm_var, width=7).grid(row=0, column=5, padx=(0, 15))
+        for var in (self.text_var, self.min_apm_var, self.max_apm_var):
+            var.trace_add('write', self._schedule_filter)
+
+        self.count_var = tk.StringVar()
+        ttk.Label(filter_frame, textvariable=self.count_var).grid(row=0, column=6, sticky=tk.E)
+        filter_frame.columnconfigure(6, weight=1)
+
+        # Table
+        columns = [key for key, _, _, _ in BATCH_COLUMNS]
+        self.tree = ttk.Treeview(self, columns=columns, show='headings', selectmode='browse')
+        for key, heading, width, anchor in BATCH_COLUMNS:
+            self.tree.heading(key, text=heading, command=lambda c=key: self._sort_by(c))
+            self.tree.column(key, width=width, anchor=anchor, stretch=(key == 'file'))
+        self.tree.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self._on_scrollbar)
+        self.scrollbar.grid(row=1, column=1, sticky=(tk.N, tk.S))
+        self.rowconfigure(1, weight=1)
+        self.columnconfigure(0, weight=1)
+
+        style = ttk.Style()
+        self._row_height = int(style.lookup('Treeview', 'rowheight') or 20)
+
+        self.tree.bind('<Configure>', self._on_resize)
+        self.tree.bind('<MouseWheel>', self._on_mousewheel)
+        self.tree.bind('<Button-4>', lambda event: self._scroll_to(self._offset - 3))
+        self.tree.bind('<Button-5>', lambda event: self._scroll_to(self._offset + 3))
+        self.tree.bind('<Prior>', lambda event: self._scroll_to(self._offset - self._visible))
+        self.tree.bind('<Next>', lambda event: self._scroll_to(self._offset + self._visible))
+        self.tree.bind('<Home>', lambda event: self._scroll_to(0))
+        self.tree.bind('<End>', lambda event: self._scroll_to(len(self.rows)))
+
+    def set_results(self, all_results: List[Dict]):
+        """
+        Show a new set of batch results, keeping the sort column and filters.
+
+        Args:
+            all_results: Dictionaries as returned by APMAnalyzer.get_results()
+        """
+        previous = self.rows
+        self.rows = BatchResultRows(all_results)
+        self._apply_filter(render=False)
+        if previous.sort_column is not None:
+            self.rows.sort(previous.sort_column, previous.descending)
+        self._scroll_to(0)
+
+    def _sort_by(self, column: str):
+        """Sort by a column, reversing the order if it is already sorted by it."""
+        descending = self.rows.sort_column == column and not self.rows.descending
+        if self.rows.sort_column != column and column in ('apm', 'actions', 'duration', 'winner'):
+            # Numbers read best highest first
+            descending = True
+        self.rows.sort(column, descending)
+
+        for key, heading, _, _ in BATCH_COLUMNS:
+            arrow = (' ▼' if descending else ' ▲') if key == column else ''
+            self.tree.heading(key, text=heading + arrow)
+        self._scroll_to(0)
+
+    def _schedule_filter(self, *args):
+        """Filter once typing pauses."""
+        if self._filter_pending is not None:
+            self.after_cancel(self._filter_pending)
+        self._filter_pending = self.after(FILTER_DELAY_MS, self._apply_filter)
+
+    def _apply_filter(self, render: bool = True):
+        """Apply the filter bar's values to the rows."""
+        self._filter_pending = None
+        self.rows.filter(
+            self.text_var.get(),
+            self._parse_apm(self.min_apm_var.get()),
+            self._parse_apm(self.max_apm_var.get())
+        )
+        if render:
+            self._scroll_to(0)
+
+    @staticmethod
+    def _parse_apm(text: str) -> Optional[float]:
+        """Parse an APM filter value, ignoring empty or invalid input."""
+        try:
+            return float(text)
+        except ValueError:
+            return None
+
+    def _on_resize(self, event):
+        """Fit the number of rendered rows to the table's height."""
+        # The heading takes about one row plus its border
+        visible = max(1, (event.height - self._row_height - 6) // self._row_height)
+        if visible != self._visible:
+            self._visible = visible
+            self._scroll_to(self._offset)
+
+    def _on_mousewheel(self, event):
+        """Scroll three rows per wheel notch (Windows and macOS)."""
+        notches = event.delta // 120 if abs(event.delta) >= 120 else (1 if event.delta > 0 else -1)
+        self._scroll_to(self._offset - notches * 3)
+        return 'break'
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        """Handle scrollbar drags, arrow clicks and trough clicks."""
+        if action == 'moveto':
+            self._scroll_to(round(float(amount) * len(self.rows)))
+        elif action == 'scroll':
+            step = self._visible if unit == 'pages' else 1
+            self._scroll_to(self._offset + int(amount) * step)
+
+    def _scroll_to(self, offset: int):
+        """Move the first rendered row to a position, and schedule a redraw."""
+        self._offset = max(0, min(offset, len(self.rows) - self._visible))
+        if self._render_pending is None:
+            # Coalesce bursts of scroll events into one redraw
+            self._render_pending = self.after_idle(self._render)
+
+    def _render(self):
+        """Write the rows in view into the Treeview's items."""
+        self._render_pending = None
+        rows = self.rows
+        count = max(0, min(self._visible, len(rows) - self._offset))
+
+        items = self.tree.get_children()
+        if len(items) > count:
+            self.tree.delete(*items[count:])
+        for _ in range(len(items), count):
+            self.tree.insert('', tk.END)
+        items = self.tree.get_children()
+
+        # Items are reused for other rows, so a selection would jump rows
+        self.tree.selection_remove(self.tree.selection())
+        for position, item in enumerate(items, start=self._offset):
+            self.tree.item(item, values=rows.values(position))
+
+        total = len(rows)
+        if total:
+            self.scrollbar.set(self._offset / total, (self._offset + count) / total)
+        else:
+            self.scrollbar.set(0, 1)
+        if total == rows.total:
+            self.count_var.set(f"{total} players")
+        else:
+            self.count_var.set(f"Showing {total} of {rows.total} players")
 
 
 class APMAnalyzerGUI:
@@ -30,6 +323,7 @@ class APMAnalyzerGUI:
         # Variables
         self.current_file = None
         self.current_results = None
+        self.cache = AnalysisCache()
 
         # Create UI
         self.create_widgets()
@@ -94,8 +388,8 @@ class APMAnalyzerGUI:
 
         export_btn = ttk.Button(
             button_frame,
-            text="💾 Export JSON",
-            command=self.export_json,
+            text="💾 Export Results",
+            command=self.export_results,
             width=20
         )
         export_btn.grid(row=0, column=2, padx=5)
@@ -115,6 +409,11 @@ class APMAnalyzerGUI:
             font=("Consolas", 9)
         )
         self.results_text.grid(row=4, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S))
+
+        # Table for batch results, shown in place of the text
+        self.batch_table = BatchResultsTable(main_frame)
+        self.batch_table.grid(row=4, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.batch_table.grid_remove()
         main_frame.rowconfigure(4, weight=1)
         main_frame.columnconfigure(0, weight=1)
 
@@ -142,7 +441,7 @@ Get started:
   1. Click "Select File" to analyze a single .aoe2record file
   2. Click "Select Folder" to analyze all .aoe2record files in a directory
   3. View APM statistics for all players in the game
-  4. Export results to JSON for further analysis
+  4. Export results to JSON or CSV for further analysis
 
 Where to find your recorded games:
   Windows: C:\\Users\\YourName\\Games\\Age of Empires 2 DE\\<ID>\\savegame\\
@@ -185,14 +484,7 @@ Ready to analyze your games!
 
     def get_default_directory(self):
         """Get the default directory for AOE2 saved games."""
-        # Try to find AOE2 save directory
-        user_home = Path.home()
-        aoe2_dir = user_home / "Games" / "Age of Empires 2 DE"
-
-        if aoe2_dir.exists():
-            return str(aoe2_dir)
-
-        return str(user_home)
+        return default_record_directory()
 
     def analyze_file(self, filename):
         """Analyze a single .aoe2record file."""
@@ -200,10 +492,9 @@ Ready to analyze your games!
         self.root.update()
 
         try:
-            analyzer = APMAnalyzer(filename)
+            results = self.cache.analyze(filename)
 
-            if analyzer.parse():
-                results = analyzer.get_results()
+            if results is not None:
                 self.current_file = filename
                 self.current_results = results
                 self.display_results(results)
@@ -238,9 +529,8 @@ Ready to analyze your games!
 
         for file_path in files:
             try:
-                analyzer = APMAnalyzer(str(file_path))
-                if analyzer.parse():
-                    results = analyzer.get_results()
+                results = self.cache.analyze(str(file_path))
+                if results is not None:
                     all_results.append(results)
                     successful += 1
                 else:
@@ -253,8 +543,14 @@ Ready to analyze your games!
         self.export_btn.state(['!disabled'])
         self.status_var.set(f"✓ Analyzed {successful} files ({failed} failed)")
 
+    def show_text(self):
+        """Show the text results area instead of the batch table."""
+        self.batch_table.grid_remove()
+        self.results_text.grid()
+
     def display_results(self, results):
         """Display analysis results for a single file."""
+        self.show_text()
         self.results_text.delete(1.0, tk.END)
 
         output = f"""
@@ -290,55 +586,40 @@ APM Analysis for: {results['file']}
         self.results_text.insert(1.0, output)
 
     def display_batch_results(self, all_results, successful, failed):
-        """Display results for batch analysis."""
-        self.results_text.delete(1.0, tk.END)
+        """Display results for batch analysis in the sortable table."""
+        self.results_text.grid_remove()
+        self.batch_table.grid()
+        self.batch_table.set_results(all_results)
 
-        output = f"""
-{'='*78}
-Batch Analysis Results
-{'='*78}
-
-Processed: {successful + failed} files
-Successful: {successful}
-Failed: {failed}
-
-"""
-
-        for results in all_results:
-            output += f"\n{'─'*78}\n"
-            output += f"File: {results['file']}\n"
-            output += f"{'─'*78}\n"
-
-            for player in results['players']:
-                winner_mark = '👑' if player['winner'] else '  '
-                output += f"{winner_mark} {player['name']:<20} ({player['civilization']:<12}) - {player['apm']:.2f} APM\n"
-
-        output += f"\n{'='*78}\n"
-
-        self.results_text.insert(1.0, output)
-
-    def export_json(self):
-        """Export current results to JSON file."""
+    def export_results(self):
+        """Export current results to a JSON or CSV file, optionally compressed."""
         if not self.current_results:
             messagebox.showwarning("No Results", "No results to export. Analyze a file first.")
             return
 
         filename = filedialog.asksaveasfilename(
-            title="Save Results as JSON",
+            title="Save Results",
             defaultextension=".json",
-            filetypes=[("JSON Files", "*.json"), ("All Files", "*.*")]
+            filetypes=[
+                ("JSON Files", "*.json"),
+                ("Compressed JSON Files", "*.json.gz"),
+                ("CSV Files", "*.csv"),
+                ("Compressed CSV Files", "*.csv.gz"),
+                ("All Files", "*.*")
+            ]
         )
 
         if filename:
             try:
-                with open(filename, 'w') as f:
-                    json.dump(self.current_results, f, indent=2)
+                self.status_var.set(f"Exporting to: {os.path.basename(filename)}...")
+                self.root.update()
+                write_results(self.current_results, filename)
 
                 messagebox.showinfo("Success", f"Results exported to:\n{filename}")
                 self.status_var.set(f"✓ Exported to: {os.path.basename(filename)}")
 
             except Exception as e:
-                self.show_error(f"Failed to export JSON:\n{str(e)}")
+                self.show_error(f"Failed to export results:\n{str(e)}")
 
     def show_error(self, message):
         """Show error message dialog."""
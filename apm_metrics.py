@@ -0,0 +1,304 @@
+"""
+Logging and metrics for AOE2 Record APM Analyzer.
+Problems are reported through the 'apm' logger instead of print(), and
+per-file counters and histograms can be exported as Prometheus text or JSON.
+"""
+
+import json
+import logging
+import math
+import sys
+import threading
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from apm_output import atomic_output
+
+
+# Logger that analysis problems are reported to
+logger = logging.getLogger('apm')
+
+# Upper bounds in seconds of the parse latency histogram buckets
+PARSE_SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Metrics export formats by file extension
+METRICS_EXTENSIONS = {
+    '.prom': 'prometheus',
+    '.txt': 'prometheus',
+    '.json': 'json',
+}
+
+# LogRecord attributes that aren't structured fields passed with extra=
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats log records as one JSON object per line, with their extra= fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['traceback'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Settings of configure_logging(), passed on to worker processes
+_logging_config: Optional[Tuple[str, str]] = None
+
+
+def configure_logging(level: str = 'warning', log_format: str = 'text'):
+    """
+    Send analysis log messages to stderr.
+
+    Tracebacks of failed parses are only included at the 'debug' level.
+
+    Args:
+        level: Lowest level shown: 'debug', 'info', 'warning' or 'error'
+        log_format: 'text' for 'LEVEL: message' lines, or 'json' for one
+            JSON object per line
+    """
+    global _logging_config
+    _logging_config = (level, log_format)
+
+    handler = logging.StreamHandler(sys.stderr)
+    if log_format == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+
+    logger.handlers[:] = [handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+
+def logging_config() -> Optional[Tuple[str, str]]:
+    """Get the (level, format) set with configure_logging(), if it was called."""
+    return _logging_config
+
+
+class Counter:
+    """A count that only goes up, optionally split by label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        # Counters without labels start at zero, so they're always exported
+        self.values: Dict[Tuple[str, ...], float] = {} if self.labels else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        """Add to the count for the given label values."""
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """Get the count for the given label values."""
+        return self.values.get(tuple(str(labels.get(label, '')) for label in self.labels), 0)
+
+    def to_dict(self) -> Dict:
+        return {
+            'type': self.kind,
+            'help': self.help,
+            'values': [{'labels': dict(zip(self.labels, key)), 'value': value}
+                       for key, value in sorted(self.values.items())]
+        }
+
+    def merge(self, data: Dict):
+        """Add counts exported by to_dict()."""
+        for entry in data.get('values', ()):
+            self.inc(entry['value'], **entry['labels'])
+
+    def prometheus_lines(self) -> Iterable[str]:
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_label_text(zip(self.labels, key))} {_number(value)}"
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets.
+
+    Like Prometheus histograms, each bucket is defined by its upper bound
+    and an overflow bucket holds anything larger.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """Add an observation."""
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @property
+    def count(self) -> int:
+        """Number of observations."""
+        return sum(self.counts)
+
+    def to_dict(self) -> Dict:
+        return {
+            'type': self.kind,
+            'help': self.help,
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count
+        }
+
+    def merge(self, data: Dict):
+        """
+        Add observations exported by to_dict().
+
+        Raises:
+            ValueError: If the buckets differ
+        """
+        if tuple(data['buckets']) != self.buckets:
+            raise ValueError(f"Cannot merge {self.name}: buckets differ")
+        with self._lock:
+            for index, count in enumerate(data['counts']):
+                self.counts[index] += count
+            self.sum += data['sum']
+
+    def prometheus_lines(self) -> Iterable[str]:
+        # Prometheus buckets are cumulative
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            yield f"{self.name}_bucket{_label_text([('le', _number(bound))])} {cumulative}"
+        yield f"{self.name}_sum {_number(self.sum)}"
+        yield f"{self.name}_count {cumulative}"
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _label_text(pairs: Iterable[Tuple[str, str]]) -> str:
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class MetricsRegistry:
+    """
+    The analysis metrics of a process, or of a single task.
+
+    Metrics are updated once per file, never per action, so they add no
+    measurable cost to parsing. Registries of worker processes are combined
+    by sending to_dict() output to the parent and merging it there.
+    """
+
+    def __init__(self):
+        self.files_parsed = Counter(
+            'apm_files_parsed_total', 'Record files parsed, by the decoder that succeeded', ('decoder',))
+        self.files_failed = Counter(
+            'apm_files_failed_total', 'Record files that could not be analyzed, by reason', ('reason',))
+        self.fallbacks = Counter(
+            'apm_decoder_fallbacks_total', 'Decoders that failed on a file before the next one was tried',
+            ('decoder',))
+        self.files_partial = Counter(
+            'apm_files_partial_total', 'Damaged record files with partially recovered results')
+        self.bytes_read = Counter(
+            'apm_bytes_read_total', 'Bytes of record files read for analysis')
+        self.actions = Counter(
+            'apm_actions_total', 'Player actions counted')
+        self.parse_seconds = Histogram(
+            'apm_parse_seconds', 'Time to parse and analyze a record file', PARSE_SECONDS_BUCKETS)
+
+    @property
+    def metrics(self) -> Tuple:
+        """All metrics, in export order."""
+        return (self.files_parsed, self.files_failed, self.fallbacks, self.files_partial,
+                self.bytes_read, self.actions, self.parse_seconds)
+
+    def to_dict(self) -> Dict:
+        """Export all metrics as a JSON-serializable dictionary."""
+        return {metric.name: metric.to_dict() for metric in self.metrics}
+
+    def merge(self, data: Optional[Dict]):
+        """
+        Add metrics exported by another registry's to_dict().
+
+        Args:
+            data: to_dict() output; metrics this registry doesn't have are ignored
+        """
+        if not data:
+            return
+        for metric in self.metrics:
+            if metric.name in data:
+                metric.merge(data[metric.name])
+
+    def to_prometheus(self) -> str:
+        """Export all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.prometheus_lines())
+        return '\n'.join(lines) + '\n'
+
+    def export(self, metrics_format: str = 'prometheus') -> str:
+        """
+        Export all metrics as text.
+
+        Args:
+            metrics_format: 'prometheus' or 'json'
+
+        Raises:
+            ValueError: If the format is unknown
+        """
+        if metrics_format == 'prometheus':
+            return self.to_prometheus()
+        if metrics_format == 'json':
+            return json.dumps(self.to_dict(), indent=2) + '\n'
+        raise ValueError(f"Unknown metrics format: {metrics_format}")
+
+    def write(self, path: str, metrics_format: Optional[str] = None):
+        """
+        Write all metrics to a file, atomically.
+
+        Since the file is replaced in one step, it can be read at any time,
+        e.g. by the node_exporter textfile collector.
+
+        Args:
+            path: File to write
+            metrics_format: 'prometheus' or 'json' (default: from the file
+                extension, or 'prometheus')
+        """
+        if metrics_format is None:
+            extension = path[path.rfind('.'):].lower() if '.' in path else ''
+            metrics_format = METRICS_EXTENSIONS.get(extension, 'prometheus')
+        text = self.export(metrics_format)
+        with atomic_output(path) as stream:
+            stream.write(text)
+
+
+# Metrics of this process
+METRICS = MetricsRegistry()
@@ -0,0 +1,402 @@
+"""
+Result output for AOE2 Record APM Analyzer.
+Streams analysis results to JSON, JSON Lines or CSV files, optionally
+compressed, with atomic writes so readers never see a partial file.
+"""
+
+import contextlib
+import csv
+import gzip
+import io
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+from typing import Dict, Iterable, Iterator, Optional, TextIO, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Size of the file's write buffer, and of the chunks of text handed to the
+# writer thread
+BUFFER_BYTES = 1024 * 1024
+
+# Chunks queued for the writer thread before the encoder waits for it
+WRITE_QUEUE_CHUNKS = 4
+
+# Compression levels: fast levels keep compressed writes close to disk speed
+GZIP_LEVEL = 3
+ZSTD_LEVEL = 3
+
+# File extensions that select a compression
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+}
+
+# Columns of CSV output, one row per player
+CSV_COLUMNS = (
+    'file', 'map', 'version', 'partial', 'number', 'name', 'civilization', 'winner',
+    'total_actions', 'apm', 'duration_minutes',
+)
+
+
+def _compact_encoder():
+    """Get a function that encodes a result as compact single-line JSON."""
+    if orjson is not None:
+        # About six times faster than the json module's C encoder
+        return lambda result: orjson.dumps(result, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.JSONEncoder().encode
+
+
+class ResultWriter:
+    """
+    Writes results to a text stream one at a time.
+
+    Subclasses implement write() and, if the format needs one, close() to
+    write a trailer. Writers don't close the stream.
+    """
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, result: Dict):
+        """Write one result."""
+        raise NotImplementedError
+
+    def write_all(self, results: Iterable[Dict]) -> int:
+        """
+        Write results and finish the output.
+
+        Returns:
+            Number of results written
+        """
+        for result in results:
+            self.write(result)
+        self.close()
+        return self.count
+
+    def close(self):
+        """Finish the output."""
+
+
+class JSONWriter(ResultWriter):
+    """
+    Writes a JSON array of results.
+
+    Each result is encoded on its own, so the whole list is never held as
+    one string. With an indent, the output is the same as
+    json.dump(results, indent=indent). Without one, each result is written
+    compactly on its own line, which is several times faster: the json
+    module only uses its C encoder without indentation, and the optional
+    orjson package is faster still. Either way encoding, not the disk, takes
+    most of the time.
+    """
+
+    def __init__(self, stream: TextIO, indent: Optional[int] = 2):
+        super().__init__(stream)
+        self.indent = indent
+        if indent is None:
+            self._encode = _compact_encoder()
+        else:
+            self._encode = json.JSONEncoder(indent=indent).encode
+            self._nested = '\n' + ' ' * indent
+
+    def write(self, result: Dict):
+        encoded = self._encode(result)
+        if self.indent is not None:
+            # Nest the object one level into the array (JSON strings never
+            # contain raw newlines, so this only touches the layout)
+            encoded = encoded.replace('\n', self._nested)
+            prefix = ' ' * self.indent
+        else:
+            prefix = ''
+        self.stream.write(('[\n' if not self.count else ',\n') + prefix + encoded)
+        self.count += 1
+
+    def close(self):
+        self.stream.write('\n]\n' if self.count else '[]\n')
+
+
+class JSONLinesWriter(ResultWriter):
+    """Writes one compact JSON result per line."""
+
+    def __init__(self, stream: TextIO):
+        super().__init__(stream)
+        self._encode = _compact_encoder()
+
+    def write(self, result: Dict):
+        self.stream.write(self._encode(result) + '\n')
+        self.count += 1
+
+
+class CSVWriter(ResultWriter):
+    """Writes one CSV row per player, with the game's fields repeated."""
+
+    def __init__(self, stream: TextIO):
+        super().__init__(stream)
+        self._writer = csv.writer(stream)
+        self._writer.writerow(CSV_COLUMNS)
+
+    def write(self, result: Dict):
+        game = (result.get('file'), result.get('map'), result.get('version'),
+                int(bool(result.get('partial'))))
+        self._writer.writerows(
+            game + (player['number'], player['name'], player['civilization'],
+                    int(bool(player['winner'])), player['total_actions'], player['apm'],
+                    player.get('duration_minutes'))
+            for player in result['players']
+        )
+        self.count += 1
+
+
+# Output formats and their writers
+WRITERS = {
+    'json': JSONWriter,
+    'jsonl': JSONLinesWriter,
+    'csv': CSVWriter,
+}
+
+
+def detect_format(path: str, default: str = 'json') -> Tuple[str, Optional[str]]:
+    """
+    Guess the output format and compression from a file name.
+
+    For example 'results.csv.gz' is gzip-compressed CSV.
+
+    Args:
+        path: Output file path
+        default: Format used if the extension doesn't name one
+
+    Returns:
+        Tuple of (format, compression or None)
+    """
+    root, extension = os.path.splitext(path.lower())
+    compression = COMPRESSION_EXTENSIONS.get(extension)
+    if compression is not None:
+        root, extension = os.path.splitext(root)
+
+    output_format = extension[1:]
+    if output_format not in WRITERS:
+        output_format = default
+    return output_format, compression
+
+
+class _BackgroundWriter:
+    """
+    Text stream that writes to another stream on a separate thread.
+
+    Written text is collected into chunks of about BUFFER_BYTES characters
+    and handed to the thread, which encodes, compresses and writes them.
+    Compression and file writes release the GIL, so they overlap with
+    encoding the next results instead of adding to it. Encoding results to
+    JSON holds the GIL, so it stays on the calling thread: running it on
+    another thread would not make it any faster.
+    """
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self._pending = []
+        self._pending_size = 0
+        self._queue = queue.Queue(WRITE_QUEUE_CHUNKS)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, text: str) -> int:
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= BUFFER_BYTES:
+            self._hand_off()
+        return len(text)
+
+    def flush(self):
+        """Nothing to do; finish() writes everything out."""
+
+    def _hand_off(self):
+        """Queue the collected text for the writer thread."""
+        if self._error is not None:
+            raise self._error
+        self._queue.put(''.join(self._pending))
+        self._pending = []
+        self._pending_size = 0
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if self._error is None:
+                try:
+                    self.stream.write(chunk)
+                except BaseException as e:
+                    # Reported to the encoding thread on its next hand-off
+                    self._error = e
+
+    def finish(self):
+        """
+        Write out all text and stop the thread.
+
+        Raises:
+            Exception: Any error the writer thread ran into
+        """
+        if self._pending:
+            self._hand_off()
+        self.stop()
+        if self._error is not None:
+            raise self._error
+
+    def stop(self):
+        """Stop the thread after the queued chunks, dropping collected text."""
+        self._pending = []
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _default_file_mode() -> int:
+    """Get the permissions a newly created file gets under the process umask."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# os.umask() can only be read by setting it, for the whole process, so it
+# is read once at import rather than while other threads may create files
+_DEFAULT_FILE_MODE = _default_file_mode()
+
+
+def _file_mode(path: str) -> int:
+    """Get the permissions to give a file replacing path: those of path, if it exists."""
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        return _DEFAULT_FILE_MODE
+
+
+@contextlib.contextmanager
+def atomic_output(path: str, compression: Optional[str] = None) -> Iterator[TextIO]:
+    """
+    Open a text stream that replaces a file once it is closed successfully.
+
+    Output goes to a temporary file in the same directory, which is renamed
+    over the target at the end. If writing fails, the temporary file is
+    removed and the target is left untouched. The new file keeps the
+    target's permissions, or gets the usual ones for a new file. Compression
+    and writing run on a background thread.
+
+    Args:
+        path: File to write
+        compression: Optional compression, 'gzip' or 'zstd'
+
+    Yields:
+        Text stream to write to
+
+    Raises:
+        ValueError: If the compression is unknown or zstd is not installed
+    """
+    if compression not in (None, 'gzip', 'zstd'):
+        raise ValueError(f"Unknown compression: {compression}")
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with open(fd, 'wb', buffering=BUFFER_BYTES) as raw:
+            if compression == 'gzip':
+                binary = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=GZIP_LEVEL)
+            elif compression == 'zstd':
+                binary = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw, closefd=False)
+            else:
+                binary = raw
+
+            text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+            writer = _BackgroundWriter(text)
+            try:
+                yield writer
+            except BaseException:
+                writer.stop()
+                raise
+            writer.finish()
+
+            # Finish the compressed stream without closing the file
+            text.flush()
+            text.detach()
+            if binary is not raw:
+                binary.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+
+        os.chmod(temp_path, _file_mode(path))
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+def write_results(results: Union[Dict, Iterable[Dict]], path: Optional[str] = None,
+                  output_format: Optional[str] = None, compression: Optional[str] = None,
+                  indent: Optional[int] = 2) -> int:
+    """
+    Write results to a file (atomically) or to stdout.
+
+    A single result dictionary is written as one JSON object in the 'json'
+    format, and like a list of one result in the others.
+
+    Args:
+        results: A result dictionary, or an iterable of them (consumed lazily)
+        path: Output file path, or None for stdout
+        output_format: 'json', 'jsonl' or 'csv' (default: from the file extension)
+        compression: 'gzip' or 'zstd' (default: from the file extension)
+        indent: Indentation for JSON output, or None to write each result
+            compactly on one line (several times faster for large outputs)
+
+    Returns:
+        Number of results written
+
+    Raises:
+        ValueError: If the format or compression is unknown
+    """
+    if path is not None:
+        detected_format, detected_compression = detect_format(path)
+        output_format = output_format or detected_format
+        compression = compression or detected_compression
+    output_format = output_format or 'json'
+    if output_format not in WRITERS:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    if path is None:
+        if compression is not None:
+            raise ValueError("Compressed output needs an output file")
+        return _write(sys.stdout, results, output_format, indent)
+
+    with atomic_output(path, compression) as stream:
+        return _write(stream, results, output_format, indent)
+
+
+def _write(stream: TextIO, results: Union[Dict, Iterable[Dict]], output_format: str,
+           indent: Optional[int]) -> int:
+    """Write results to an open stream in a format."""
+    if isinstance(results, dict):
+        if output_format == 'json':
+            stream.write(json.dumps(results, indent=indent) + '\n')
+            return 1
+        results = [results]
+
+    if output_format == 'json':
+        writer = JSONWriter(stream, indent=indent)
+    else:
+        writer = WRITERS[output_format](stream)
+    return writer.write_all(results)
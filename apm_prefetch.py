@@ -0,0 +1,156 @@
+"""
+Background prefetching of .aoe2record files for batch processing.
+Reads upcoming replays into memory while the current one is being parsed,
+so disk (or network) reads overlap with CPU-bound parsing.
+"""
+
+import os
+import threading
+from collections import deque
+from typing import Iterator, List, Optional, Tuple
+
+
+# Default amount of replay data held in memory ahead of the parser
+DEFAULT_PREFETCH_BYTES = 64 * 1024 * 1024
+
+
+class ReplayPrefetcher:
+    """
+    Iterates over record files, reading them ahead on a background thread.
+
+    Files are yielded in their original order as ``(path, data, error)``
+    tuples. ``data`` holds the complete file contents, or ``None`` when the
+    read failed, in which case ``error`` holds the exception. If the reader
+    thread itself fails, iteration raises its exception once the files read
+    before the failure have been yielded.
+
+    The reader never buffers more than ``max_bytes`` of file data at once.
+    A single file larger than the budget is still read, but only once the
+    buffer is otherwise empty.
+
+    Example:
+        with ReplayPrefetcher(files, max_bytes=32 * 1024 * 1024) as prefetcher:
+            for path, data, error in prefetcher:
+                analyzer = APMAnalyzer(path, data=data)
+    """
+
+    def __init__(self, files: List[str], max_bytes: int = DEFAULT_PREFETCH_BYTES):
+        """
+        Initialize the prefetcher.
+
+        Args:
+            files: Paths of the record files, in processing order
+            max_bytes: Maximum number of bytes buffered ahead of the consumer
+
+        Raises:
+            ValueError: If max_bytes is not positive
+        """
+        if max_bytes <= 0:
+            raise ValueError(f"max_bytes must be positive: {max_bytes}")
+
+        self.files = list(files)
+        self.max_bytes = max_bytes
+
+        self._buffer = deque()
+        self._buffered_bytes = 0
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """Start the background reader thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._reader,
+                name="replay-prefetcher",
+                daemon=True
+            )
+            self._thread.start()
+
+    def close(self):
+        """Stop the reader thread and release any buffered data."""
+        with self._condition:
+            self._closed = True
+            self._buffer.clear()
+            self._buffered_bytes = 0
+            self._condition.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __iter__(self) -> Iterator[Tuple[str, Optional[bytes], Optional[Exception]]]:
+        self.start()
+
+        while True:
+            with self._condition:
+                while not self._buffer and not self._done and not self._closed:
+                    self._condition.wait()
+
+                if self._closed:
+                    return
+                if not self._buffer:
+                    if self._error is not None:
+                        raise self._error
+                    return
+
+                item = self._buffer.popleft()
+                if item[1] is not None:
+                    self._buffered_bytes -= len(item[1])
+                self._condition.notify_all()
+
+            yield item
+
+    def _reader(self):
+        """Read files, and always wake the consumer when finished or failed."""
+        try:
+            self._read_files()
+        except BaseException as e:
+            self._error = e
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+    def _read_files(self):
+        """Read files in order, blocking while the byte budget is exhausted."""
+        for path in self.files:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+
+            # Wait for room before reading, so memory stays within the budget
+            with self._condition:
+                while (not self._closed and self._buffer
+                       and self._buffered_bytes + size > self.max_bytes):
+                    self._condition.wait()
+
+                if self._closed:
+                    return
+
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                item = (path, data, None)
+            except Exception as e:
+                # e.g. OSError, or MemoryError for a huge file
+                item = (path, None, e)
+
+            with self._condition:
+                if self._closed:
+                    return
+
+                self._buffer.append(item)
+                if item[1] is not None:
+                    self._buffered_bytes += len(item[1])
+                self._condition.notify_all()
@@ -0,0 +1,10 @@
+"""
+Fork-server preload module for AOE2 Record APM Analyzer.
+Importing this module loads the parser and its reference data, so worker
+processes forked from the fork server start warm and share those pages.
+"""
+
+import apm_analyzer  # noqa: F401  (imports mgz and builds its parser structures)
+from apm_reference import warm_up
+
+warm_up()
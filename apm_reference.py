@@ -0,0 +1,92 @@
+"""
+Process-wide cache of mgz reference data.
+mgz loads constants and datasets (civilizations, units, techs) from JSON on
+every parse; this module loads each table once and shares it afterwards.
+"""
+
+import threading
+from typing import Dict, Tuple
+
+import mgz.model
+import mgz.reference
+from mgz.util import Version
+
+
+# Datasets loaded up front by warm_up(): DE, DE with the Return of Rome DLC, HD
+PRELOAD_DATASETS = (
+    (Version.DE, None),
+    (Version.DE, [11]),
+    (Version.HD, None),
+)
+
+_load_consts = mgz.reference.get_consts
+_load_dataset = mgz.reference.get_dataset
+
+_consts = None
+_datasets: Dict[int, Tuple[int, Dict]] = {}
+_lock = threading.Lock()
+_installed = False
+
+
+def _dataset_id(version, mod) -> int:
+    """Mirror mgz.reference.get_dataset's choice of dataset for a game."""
+    if version is Version.DE:
+        return 101 if isinstance(mod, list) and 11 in mod else 100
+    if version is Version.HD:
+        return 300
+    if mod:
+        return mod[0]
+    return 0
+
+
+def get_consts() -> Dict:
+    """Get the mgz constants, loading them on first use."""
+    global _consts
+    if _consts is None:
+        with _lock:
+            if _consts is None:
+                _consts = _load_consts()
+    return _consts
+
+
+def get_dataset(version, mod) -> Tuple[int, Dict]:
+    """
+    Get the reference dataset for a game, loading it on first use.
+
+    Same signature and return value as mgz.reference.get_dataset. The
+    returned tables are shared and must not be modified.
+    """
+    dataset_id = _dataset_id(version, mod)
+    dataset = _datasets.get(dataset_id)
+    if dataset is None:
+        with _lock:
+            dataset = _datasets.get(dataset_id)
+            if dataset is None:
+                dataset = _datasets[dataset_id] = _load_dataset(version, mod)
+    return dataset
+
+
+def install():
+    """Make parse_match use the cached reference data."""
+    global _installed
+    if not _installed:
+        mgz.model.get_consts = get_consts
+        mgz.model.get_dataset = get_dataset
+        _installed = True
+
+
+def warm_up():
+    """
+    Prepare this process for parsing: install the cache and load common tables.
+
+    Safe to call more than once. Run it in a parent before forking workers
+    (or in a fork server) so the tables are shared copy-on-write.
+    """
+    install()
+    get_consts()
+    for version, mod in PRELOAD_DATASETS:
+        try:
+            get_dataset(version, mod)
+        except Exception:
+            # A dataset missing from an older aocref release isn't fatal
+            continue
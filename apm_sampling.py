@@ -0,0 +1,311 @@
+"""
+Approximate APM from sampled segments of .aoe2record bodies.
+Decodes only a fraction of each replay and extrapolates per-player APM, with
+error bounds, for trend analysis over large archives.
+"""
+
+import math
+import random
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, List, Optional, Set
+
+from mgz.fast import Action, Operation
+
+from apm_decoder import ResilientDecoder
+
+
+# Fraction of body segments decoded by default
+DEFAULT_SAMPLE_RATE = 0.2
+
+# Length of a body segment in bytes
+DEFAULT_SEGMENT_BYTES = 2 * 1024
+
+# z-score of the reported error bounds (95% confidence)
+CONFIDENCE_Z = 1.96
+
+
+@dataclass
+class SegmentSample:
+    """Actions and game time decoded from one body segment."""
+
+    index: int
+    # Number of segments this sample stands for
+    weight: int = 1
+    bytes: int = 0
+    ms: int = 0
+    actions: Dict[int, int] = field(default_factory=lambda: defaultdict(int))
+    # Absolute game time at the end of the segment, from DE syncs
+    absolute_ms: Optional[int] = None
+
+
+class SampleEstimate:
+    """
+    Per-player APM extrapolated from sampled body segments.
+
+    Each sampled segment stands for the stride of segments it was drawn
+    from. APM is estimated as the weighted sum of sampled actions over the
+    weighted sum of sampled game time (a ratio estimator). Error bounds come
+    from the spread of the per-segment action rates, with a finite-population
+    correction for the fraction of segments decoded. Since one segment is
+    drawn from every stride, the sample follows the early/mid/late game
+    trend and the bounds are usually conservative.
+
+    The error of a single game is limited by the number of actions sampled
+    (roughly 1 / sqrt(sampled actions)); averages over many games converge
+    much faster.
+    """
+
+    def __init__(self, segments: List[SegmentSample], total_segments: int, body_bytes: int,
+                 duration_ms: float, duration_exact: bool, resigned: Set[int],
+                 bytes_read: Optional[int] = None):
+        self.segments = segments
+        self.total_segments = total_segments
+        self.body_bytes = body_bytes
+        # Bytes of the body read from the stream, including the last segment
+        # and the data scanned to find each segment's first operation
+        self.bytes_read = body_bytes if bytes_read is None else bytes_read
+        self.duration_ms = duration_ms
+        self.duration_exact = duration_exact
+        self.resigned = resigned
+        self.sampled_bytes = sum(segment.bytes for segment in segments)
+        self._weighted_ms = sum(segment.weight * segment.ms for segment in segments)
+
+    @property
+    def sample_fraction(self) -> float:
+        """Fraction of the body's bytes that were decoded for the estimate."""
+        return self.sampled_bytes / self.body_bytes if self.body_bytes else 0.0
+
+    def players(self) -> List[int]:
+        """Get the numbers of all players seen in the sampled segments."""
+        return sorted({number for segment in self.segments for number in segment.actions})
+
+    def player(self, player_number: int) -> Dict:
+        """
+        Estimate a player's APM and action count.
+
+        Returns:
+            Dictionary with the estimated APM, the half-width of its 95%
+            confidence interval (None if fewer than two segments were
+            decoded), the estimated total actions and the actions sampled
+        """
+        sampled_actions = sum(segment.actions.get(player_number, 0) for segment in self.segments)
+        if not self._weighted_ms:
+            return {'apm': 0, 'apm_error': None, 'total_actions': 0, 'sampled_actions': sampled_actions}
+
+        rate = sum(
+            segment.weight * segment.actions.get(player_number, 0) for segment in self.segments
+        ) / self._weighted_ms
+        return {
+            'apm': rate * 60000,
+            'apm_error': self._error(player_number, rate),
+            'total_actions': round(rate * self.duration_ms),
+            'sampled_actions': sampled_actions
+        }
+
+    def _error(self, player_number: int, rate: float) -> Optional[float]:
+        """Half-width of the APM confidence interval for a player."""
+        n = len(self.segments)
+        if n < 2:
+            return None
+
+        coverage = min(n / self.total_segments, 1.0)
+        residuals = sum(
+            (segment.weight * (segment.actions.get(player_number, 0) - rate * segment.ms)) ** 2
+            for segment in self.segments
+        )
+        variance = (1 - coverage) * n / (n - 1) * residuals / self._weighted_ms ** 2
+        return CONFIDENCE_Z * math.sqrt(variance) * 60000
+
+
+class SampledDecoder:
+    """
+    Decodes a stratified sample of body segments.
+
+    The body is split into fixed-size byte segments, and those are grouped
+    into strides of k = round(1 / sample_rate) segments. One segment at a
+    random position in each stride is decoded, so the sample covers the
+    whole game without lining up with periodic activity. The random choice
+    is seeded from the body length, so results are reproducible.
+
+    A segment's decoding starts at the first valid operation in it (found
+    the same way the resilient decoder recovers from corrupt data) and runs
+    from sync to sync, so each segment covers whole time steps. Operations
+    are skimmed by default: heavy DE sync checksums and viewlocks are
+    skipped without being unpacked.
+
+    The last segment is always decoded, since it holds any resignations and,
+    on DE, the absolute game time at the end. If it wasn't drawn, it isn't
+    used for the APM estimate. Without DE game times, the duration is
+    extrapolated from the sampled time per byte.
+
+    Example:
+        sampler = SampledDecoder(handle, sample_rate=0.2)
+        estimate = sampler.estimate()
+        print(estimate.player(1)['apm'], estimate.player(1)['apm_error'])
+    """
+
+    def __init__(self, handle: BinaryIO, eof: Optional[int] = None,
+                 sample_rate: float = DEFAULT_SAMPLE_RATE,
+                 segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+                 skim: bool = True, seed: Optional[int] = None):
+        """
+        Initialize the sampler.
+
+        Args:
+            handle: Seekable binary stream positioned at the first body operation
+            eof: Offset of the end of the data (default: end of the stream)
+            sample_rate: Fraction of segments to decode, in (0, 1]
+            segment_bytes: Length of a segment in bytes
+            skim: Whether to skip heavy operations without unpacking them
+            seed: Seed for choosing segments (default: the body length)
+
+        Raises:
+            ValueError: If sample_rate is not in (0, 1]
+        """
+        if not 0 < sample_rate <= 1:
+            raise ValueError(f"Sample rate must be in (0, 1], got {sample_rate}")
+
+        # A segment-sized resync window keeps finding the first operation of
+        # a segment proportional to the segment rather than the whole body
+        self.decoder = ResilientDecoder(handle, eof=eof, resync_window=segment_bytes, skim=skim)
+        self.handle = handle
+        self.start = handle.tell()
+        self.eof = self.decoder.eof
+        self.sample_rate = sample_rate
+        self.segment_bytes = segment_bytes
+        self.seed = self.eof - self.start if seed is None else seed
+
+    @property
+    def total_segments(self) -> int:
+        """Number of segments the body is split into."""
+        return max((self.eof - self.start) // self.segment_bytes, 1)
+
+    def segment_weights(self) -> Dict[int, int]:
+        """
+        Choose the segments to decode.
+
+        Returns:
+            Dictionary of segment index to the number of segments it stands for
+        """
+        total = self.total_segments
+        stride = max(round(1 / self.sample_rate), 1)
+        rng = random.Random(self.seed)
+
+        weights = {}
+        for block in range(0, total, stride):
+            size = min(stride, total - block)
+            weights[block + rng.randrange(size)] = size
+        return weights
+
+    def estimate(self) -> SampleEstimate:
+        """
+        Decode the sampled segments and extrapolate.
+
+        Returns:
+            SampleEstimate with per-player results
+        """
+        weights = self.segment_weights()
+        last = self.total_segments - 1
+        segments = []
+        resigned = set()
+        absolute_ms = None
+        bytes_read = 0
+
+        for index in sorted(set(weights) | {last}):
+            start = self.start + index * self.segment_bytes
+            # The last segment also takes the remainder of the body
+            end = self.eof if index == last else start + self.segment_bytes
+
+            # Continue straight on if the previous segment ran into this one;
+            # otherwise find the first operation in the segment
+            aligned = self.handle.tell() >= start and index > 0
+            begin = self.handle.tell() if aligned else start
+            if index == 0:
+                self.handle.seek(start)
+            elif not aligned:
+                # Game time skipped over is unknown until the next DE sync
+                absolute_ms = None
+                if not self.decoder.seek_operation(start):
+                    # Nothing decodes in this segment
+                    bytes_read += min(self.decoder.resync_window, self.eof - start)
+                    continue
+            if self.handle.tell() >= end:
+                bytes_read += self.handle.tell() - begin
+                continue
+
+            segment = self._decode_segment(index, end, aligned, resigned)
+            # Decoding stops short of the end only after scanning corrupt data up to it
+            bytes_read += max(self.handle.tell(), end) - begin
+            if segment is None:
+                continue
+            if segment.absolute_ms is not None:
+                absolute_ms = segment.absolute_ms
+            elif absolute_ms is not None:
+                absolute_ms += segment.ms
+
+            if index in weights:
+                segment.weight = weights[index]
+                segments.append(segment)
+
+        weighted_ms = sum(segment.weight * segment.ms for segment in segments)
+        weighted_bytes = sum(segment.weight * segment.bytes for segment in segments)
+        if absolute_ms is not None:
+            duration_ms, duration_exact = absolute_ms, True
+        elif weighted_bytes:
+            duration_ms, duration_exact = weighted_ms * (self.eof - self.start) / weighted_bytes, False
+        else:
+            duration_ms, duration_exact = 0, False
+
+        return SampleEstimate(segments, self.total_segments, self.eof - self.start,
+                              duration_ms, duration_exact, resigned, bytes_read)
+
+    def _decode_segment(self, index: int, end: int, aligned: bool,
+                        resigned: Set[int]) -> Optional[SegmentSample]:
+        """
+        Decode one segment from sync to sync.
+
+        Counting starts after the first sync in the segment (or right away
+        if the stream is already at a sync boundary) and stops after the
+        first sync past the end of the segment. This also drops operations
+        decoded from a false resync point, which could otherwise add bogus
+        time increments.
+
+        Returns:
+            SegmentSample, or None if no sync was found in the segment
+        """
+        segment = SegmentSample(index)
+        position = self.handle.tell()
+
+        # Corrupt data is only scanned up to the end of the segment
+        for _, op_type, op_data in self.decoder.operations(resync_until=end):
+            if op_type is Operation.SYNC:
+                if not aligned:
+                    aligned = True
+                    position = self.handle.tell()
+                    continue
+                increment, _, payload = op_data
+                segment.ms += increment
+                if 'current_time' in payload:
+                    segment.absolute_ms = payload['current_time']
+                elif segment.absolute_ms is not None:
+                    segment.absolute_ms += increment
+                if self.handle.tell() >= end:
+                    break
+                continue
+
+            if not aligned or op_type is not Operation.ACTION:
+                continue
+
+            action_type, payload = op_data
+            player_number = payload.get('player_id')
+            if player_number is None:
+                continue
+            segment.actions[player_number] += 1
+            if action_type is Action.RESIGN:
+                resigned.add(player_number)
+
+        if not aligned:
+            return None
+        segment.bytes = self.handle.tell() - position
+        return segment
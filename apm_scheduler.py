@@ -0,0 +1,293 @@
+"""
+Size-aware parallel scheduling for batch APM analysis.
+Dispatches the most expensive replays first so a long game at the end of
+the list doesn't leave one worker running while the others sit idle.
+"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from apm_analyzer import APMAnalyzer
+from apm_metrics import METRICS, MetricsRegistry, configure_logging, logging_config, logger
+from apm_reference import warm_up
+
+
+# Initial parse throughput guess, refined as files complete
+DEFAULT_SECONDS_PER_MB = 1.0
+
+# Weight of the newest observation in the throughput estimate
+CALIBRATION_WEIGHT = 0.2
+
+# Worker crashes a file may be in flight for before it is given up on
+MAX_WORKER_CRASHES = 2
+
+
+@dataclass
+class ScheduledFile:
+    """A record file with its predicted and measured processing time."""
+
+    path: str
+    size: int
+    predicted_seconds: float = 0.0
+    actual_seconds: Optional[float] = None
+    results: Optional[Dict] = None
+    error: Optional[str] = None
+
+
+class CostModel:
+    """
+    Predicts parse time from file size and, when known, game duration.
+
+    Starts from a fixed throughput guess and recalibrates from every
+    completed file, so predictions improve over the course of a batch.
+    """
+
+    def __init__(self, seconds_per_mb: float = DEFAULT_SECONDS_PER_MB,
+                 duration_hints: Optional[Dict[str, float]] = None):
+        """
+        Initialize the cost model.
+
+        Args:
+            seconds_per_mb: Initial estimate of parse time per megabyte
+            duration_hints: Optional game durations in minutes by file path,
+                e.g. from ResultStore.durations() or AnalysisCache.durations()
+                for files analyzed before
+        """
+        self.seconds_per_mb = seconds_per_mb
+        self.seconds_per_minute = None
+        self.duration_hints = duration_hints or {}
+
+    def predict(self, item: ScheduledFile) -> float:
+        """Predict the processing time of a file in seconds."""
+        duration = self.duration_hints.get(item.path)
+        if duration and self.seconds_per_minute is not None:
+            return duration * self.seconds_per_minute
+        return item.size / (1024 * 1024) * self.seconds_per_mb
+
+    def observe(self, item: ScheduledFile):
+        """Update the model with a completed file's measured time."""
+        if item.actual_seconds is None or item.size <= 0:
+            return
+
+        measured = item.actual_seconds / (item.size / (1024 * 1024))
+        self.seconds_per_mb += CALIBRATION_WEIGHT * (measured - self.seconds_per_mb)
+
+        duration = self.duration_hints.get(item.path)
+        if duration:
+            measured = item.actual_seconds / duration
+            if self.seconds_per_minute is None:
+                self.seconds_per_minute = measured
+            else:
+                self.seconds_per_minute += CALIBRATION_WEIGHT * (measured - self.seconds_per_minute)
+
+
+def create_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """
+    Create a process pool whose workers start with the parser already loaded.
+
+    Where available (Linux, macOS), workers are forked from a fork server
+    that has preloaded mgz and its reference data, so each worker starts
+    without re-importing anything and shares those pages copy-on-write.
+    Elsewhere (Windows), each worker warms up once when it starts rather
+    than on every file. Workers log the way the parent process was set up
+    with apm_metrics.configure_logging().
+
+    Args:
+        max_workers: Number of worker processes
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['apm_preload'])
+    else:
+        context = multiprocessing.get_context()
+
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker,
+                               initargs=(logging_config(),))
+
+
+def _init_worker(log_config: Optional[Tuple[str, str]]):
+    """Worker initializer: load the parser and set up logging."""
+    warm_up()
+    if log_config is not None:
+        configure_logging(*log_config)
+
+
+def analyze_file_task(path: str, sample_rate: Optional[float] = None, data: Optional[bytes] = None):
+    """
+    Worker entry point: analyze one file and time it.
+
+    Args:
+        path: Path of the record file (only used as its name if data is given)
+        sample_rate: Optional fraction of the body to sample (see APMAnalyzer)
+        data: Optional contents of the record file
+
+    Returns:
+        Tuple of (results or None, error message or None, elapsed seconds,
+        metrics of this file as MetricsRegistry.to_dict(), to be merged into
+        the parent process's registry)
+    """
+    start = time.perf_counter()
+    metrics = MetricsRegistry()
+    try:
+        analyzer = APMAnalyzer(path, data=data, sample_rate=sample_rate, metrics=metrics)
+        results = analyzer.get_results() if analyzer.parse() else None
+        error = None if results is not None else analyzer.error or "failed to parse"
+    except Exception as e:
+        results = None
+        error = str(e)
+        metrics.files_failed.inc(reason=type(e).__name__)
+    return results, error, time.perf_counter() - start, metrics.to_dict()
+
+
+class BatchScheduler:
+    """
+    Runs batch analysis on a process pool, largest files first.
+
+    Workers pull the next file from a shared queue as soon as they finish,
+    so a slow file never holds up work that is waiting behind it. Only a
+    couple of files per worker are in flight at once, which lets later
+    predictions use the throughput measured so far.
+
+    If a worker process dies (e.g. killed or out of memory), the pool is
+    replaced and the files that were in flight are submitted again. Which
+    of them crashed the worker isn't known, so a file is only recorded as
+    failed once it has been in flight for MAX_WORKER_CRASHES crashes.
+
+    Example:
+        scheduler = BatchScheduler(files, workers=4)
+        for item in scheduler.run():
+            print(item.path, item.predicted_seconds, item.actual_seconds)
+
+    The workers' metrics are merged into apm_metrics.METRICS as files
+    complete.
+    """
+
+    def __init__(self, files: List[str], workers: Optional[int] = None,
+                 cost_model: Optional[CostModel] = None,
+                 sample_rate: Optional[float] = None):
+        """
+        Initialize the scheduler.
+
+        Args:
+            files: Paths of the record files to analyze
+            workers: Number of worker processes (default: CPU count)
+            cost_model: Optional cost model used to order and predict files
+            sample_rate: Optional fraction of each body to sample (see APMAnalyzer)
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.cost_model = cost_model or CostModel()
+        self.sample_rate = sample_rate
+        self.items = [ScheduledFile(path, self._size(path)) for path in files]
+        self.wall_seconds = 0.0
+
+    @staticmethod
+    def _size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def run(self) -> Iterator[ScheduledFile]:
+        """
+        Analyze all files, yielding each one as it completes.
+
+        Yields:
+            ScheduledFile entries with results (or an error) and timings
+        """
+        for item in self.items:
+            item.predicted_seconds = self.cost_model.predict(item)
+        pending = sorted(self.items, key=lambda item: item.predicted_seconds)
+        crashes: Dict[str, int] = {}
+
+        start = time.perf_counter()
+        executor = create_process_pool(self.workers)
+        try:
+            in_flight = {}
+
+            while pending or in_flight:
+                crash = None
+                while pending and len(in_flight) < self.workers * 2:
+                    item = pending.pop()
+                    item.predicted_seconds = self.cost_model.predict(item)
+                    try:
+                        in_flight[executor.submit(analyze_file_task, item.path, self.sample_rate)] = item
+                    except BrokenProcessPool as e:
+                        # The pool broke since the last wait
+                        pending.append(item)
+                        crash = e
+                        break
+
+                done = set()
+                if crash is None:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = in_flight[future]
+                    try:
+                        item.results, item.error, item.actual_seconds, metrics = future.result()
+                        METRICS.merge(metrics)
+                    except BrokenProcessPool as e:
+                        crash = e
+                        continue
+                    except Exception as e:
+                        item.error = str(e)
+                        METRICS.files_failed.inc(reason='worker_error')
+                    del in_flight[future]
+                    self.cost_model.observe(item)
+                    yield item
+
+                if crash is not None:
+                    # Every file in flight is lost with the pool
+                    logger.error("Worker process crashed with %d file(s) in flight, starting a new pool: %s",
+                                 len(in_flight), crash)
+                    executor.shutdown(wait=False)
+                    executor = create_process_pool(self.workers)
+                    for item in in_flight.values():
+                        crashes[item.path] = crashes.get(item.path, 0) + 1
+                        if crashes[item.path] < MAX_WORKER_CRASHES:
+                            pending.append(item)
+                            continue
+                        item.error = f"worker process crashed: {crash}"
+                        METRICS.files_failed.inc(reason='worker_error')
+                        yield item
+                    in_flight.clear()
+                elif done and self.cost_model.duration_hints:
+                    self._resort(pending)
+        finally:
+            executor.shutdown()
+
+        self.wall_seconds = time.perf_counter() - start
+
+    def _resort(self, pending: List[ScheduledFile]):
+        """
+        Re-predict and re-order files waiting to be submitted after the cost model recalibrated.
+
+        Only needed with duration hints: predictions from size alone all
+        scale together, so their order never changes.
+        """
+        for item in pending:
+            item.predicted_seconds = self.cost_model.predict(item)
+        pending.sort(key=lambda item: item.predicted_seconds)
+
+    def summary(self) -> Dict:
+        """
+        Summarize scheduling efficiency after a run.
+
+        Returns:
+            Dictionary with wall time, total worker time and the ideal wall
+            time (total worker time divided by the number of workers)
+        """
+        cpu_seconds = sum(item.actual_seconds or 0 for item in self.items)
+        ideal_seconds = cpu_seconds / self.workers
+        return {
+            'workers': self.workers,
+            'files': len(self.items),
+            'wall_seconds': round(self.wall_seconds, 2),
+            'cpu_seconds': round(cpu_seconds, 2),
+            'ideal_seconds': round(ideal_seconds, 2),
+            'efficiency': round(ideal_seconds / self.wall_seconds, 3) if self.wall_seconds else None
+        }
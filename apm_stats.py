@@ -0,0 +1,389 @@
+"""
+Head-to-head and matchup statistics across analyzed games.
+Answers queries from the indexes of a SQLite results store, or from an
+in-memory index built once over batch results, so repeated queries don't
+rescan the results.
+"""
+
+import json
+import math
+import statistics
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from apm_store import ResultStore
+
+
+# Width of the APM-difference buckets used for win rates against APM
+DEFAULT_DELTA_BUCKET = 10
+
+
+def _opponent_pairs(players: List[Dict], teams: Optional[List[Dict]] = None) -> Iterable[Tuple[Dict, Dict]]:
+    """
+    Yield pairs of players that faced each other in a game.
+
+    Players on different teams (from the results' 'teams') are opponents.
+    Results from older versions have no teams: then both players of a 1v1
+    are opponents, and in larger games only pairs with a different winner
+    status are known to be on opposite sides.
+    """
+    team_of = {number: team['team'] for team in teams or () for number in team['players']}
+    for i, player1 in enumerate(players):
+        for player2 in players[i + 1:]:
+            team1, team2 = team_of.get(player1['number']), team_of.get(player2['number'])
+            if team1 is not None and team2 is not None:
+                opponents = team1 != team2
+            else:
+                opponents = len(players) == 2 or player1['winner'] != player2['winner']
+            if opponents:
+                yield player1, player2
+
+
+def _civ_order(player1: Dict, player2: Dict) -> Tuple[Dict, Dict]:
+    """
+    Order two opponents by civilization.
+
+    In a mirror (same civilization on both sides) the order by name would
+    be arbitrary, so the winner comes first.
+    """
+    if player1['civilization'] == player2['civilization']:
+        if player2['winner'] and not player1['winner']:
+            return player2, player1
+        return player1, player2
+    return tuple(sorted((player1, player2), key=lambda p: p['civilization']))
+
+
+def _summarize(values: List[float]) -> Dict:
+    """Summarize a list of values as a distribution."""
+    if not values:
+        return {'count': 0}
+
+    ordered = sorted(values)
+
+    def percentile(p):
+        index = min(len(ordered) - 1, max(0, int(math.ceil(p * len(ordered))) - 1))
+        return round(ordered[index], 2)
+
+    return {
+        'count': len(ordered),
+        'mean': round(statistics.mean(ordered), 2),
+        'median': round(statistics.median(ordered), 2),
+        'stdev': round(statistics.pstdev(ordered), 2),
+        'min': round(ordered[0], 2),
+        'p10': percentile(0.10),
+        'p90': percentile(0.90),
+        'max': round(ordered[-1], 2)
+    }
+
+
+class _PairRecord:
+    """Accumulated results between two sides, stored in key order."""
+
+    __slots__ = ('games', 'wins', 'apm_deltas', 'apm_totals')
+
+    def __init__(self):
+        self.games = 0
+        self.wins = [0, 0]
+        self.apm_deltas = []
+        self.apm_totals = [0.0, 0.0]
+
+    def add(self, first: Dict, second: Dict):
+        self.games += 1
+        if first['winner'] and not second['winner']:
+            self.wins[0] += 1
+        elif second['winner'] and not first['winner']:
+            self.wins[1] += 1
+        self.apm_deltas.append(first['apm'] - second['apm'])
+        self.apm_totals[0] += first['apm']
+        self.apm_totals[1] += second['apm']
+
+
+def _delta_bucket(delta: float, width: int) -> int:
+    """Get the lower bound of the APM-difference bucket holding delta."""
+    return int(math.floor(delta / width)) * width
+
+
+def _pair_result(record: Optional[_PairRecord], swapped: bool, a: str, b: str, label: str) -> Dict:
+    """
+    Build the result for a pair query, oriented as a vs b.
+
+    In a mirror (a == b) the record is stored with the winner first, so
+    per-side wins and win rates don't mean anything and are None; the APM
+    delta is then the winner's APM minus the loser's.
+    """
+    result = {f'{label}1': a, f'{label}2': b, 'games': 0}
+
+    if record is None or not record.games:
+        return result
+
+    wins = record.wins[::-1] if swapped else record.wins
+    totals = record.apm_totals[::-1] if swapped else record.apm_totals
+    deltas = [-d for d in record.apm_deltas] if swapped else record.apm_deltas
+    decided = wins[0] + wins[1]
+    mirror = a == b
+
+    result.update({
+        'games': record.games,
+        f'{label}1_wins': None if mirror else wins[0],
+        f'{label}2_wins': None if mirror else wins[1],
+        f'{label}1_win_rate': round(wins[0] / decided, 3) if decided and not mirror else None,
+        f'{label}1_avg_apm': round(totals[0] / record.games, 2),
+        f'{label}2_avg_apm': round(totals[1] / record.games, 2),
+        'apm_delta': _summarize(deltas)
+    })
+    return result
+
+
+def _bucket_results(buckets: Dict[int, List[int]], width: int) -> List[Dict]:
+    """Format {bucket: [games, wins]} counts, ordered by APM difference."""
+    return [
+        {
+            'apm_delta_from': bucket,
+            'apm_delta_to': bucket + width,
+            'games': games,
+            'wins': wins,
+            'win_rate': round(wins / games, 3)
+        }
+        for bucket, (games, wins) in sorted(buckets.items())
+    ]
+
+
+class MatchupIndex:
+    """
+    Indexes batch results for player-vs-player and civ-vs-civ queries.
+
+    The index is built once in a single pass over the games. Queries then
+    look up pre-aggregated records instead of scanning every game. For
+    results kept in a ResultStore, use StoreMatchups instead.
+
+    Example:
+        index = MatchupIndex.from_json_file('all_results.json')
+        print(index.head_to_head('TheViper', 'Hera'))
+        print(index.civ_matchup('Aztecs', 'Mayans'))
+    """
+
+    def __init__(self, games: Optional[Iterable[Dict]] = None,
+                 delta_bucket: int = DEFAULT_DELTA_BUCKET):
+        """
+        Initialize the index.
+
+        Args:
+            games: Optional results (as returned by get_results()) to index
+            delta_bucket: Width of the APM-difference buckets, in APM
+        """
+        self.delta_bucket = delta_bucket
+        self.game_count = 0
+
+        self._players = defaultdict(list)
+        self._player_pairs = defaultdict(_PairRecord)
+        self._civ_pairs = defaultdict(_PairRecord)
+        self._civ_delta_buckets = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+
+        if games is not None:
+            self.add_games(games)
+
+    @classmethod
+    def from_json_file(cls, path: str, **kwargs) -> 'MatchupIndex':
+        """Build an index from a JSON file written by batch processing."""
+        with open(path, 'r') as f:
+            games = json.load(f)
+
+        if isinstance(games, dict):
+            games = [games]
+
+        return cls(games, **kwargs)
+
+    def add_games(self, games: Iterable[Dict]):
+        """Add several games to the index."""
+        for game in games:
+            self.add_game(game)
+
+    def add_game(self, game: Dict):
+        """Add a single game's results to the index."""
+        players = game.get('players', [])
+        self.game_count += 1
+
+        for player in players:
+            self._players[player['name']].append(player['apm'])
+
+        for player1, player2 in _opponent_pairs(players, game.get('teams')):
+            first, second = sorted((player1, player2), key=lambda p: p['name'])
+            self._player_pairs[(first['name'], second['name'])].add(first, second)
+
+            first, second = _civ_order(player1, player2)
+            self._civ_pairs[(first['civilization'], second['civilization'])].add(first, second)
+
+            # Win counts bucketed by the APM advantage, from each side's view
+            if player1['winner'] != player2['winner']:
+                for side, other in ((player1, player2), (player2, player1)):
+                    bucket = _delta_bucket(side['apm'] - other['apm'], self.delta_bucket)
+                    counts = self._civ_delta_buckets[(side['civilization'], other['civilization'])][bucket]
+                    counts[0] += 1
+                    counts[1] += 1 if side['winner'] else 0
+
+    @staticmethod
+    def _oriented(records: Dict, a: str, b: str) -> Tuple[Optional[_PairRecord], bool]:
+        """Find the record for (a, b) and whether it is stored as (b, a)."""
+        if (a, b) in records:
+            return records[(a, b)], False
+        if (b, a) in records:
+            return records[(b, a)], True
+        return None, False
+
+    def players(self) -> List[str]:
+        """Get the names of all indexed players."""
+        return sorted(self._players)
+
+    def player_summary(self, name: str) -> Dict:
+        """
+        Get a player's APM distribution over all indexed games.
+
+        Args:
+            name: Player name
+
+        Returns:
+            Dictionary with the game count and APM distribution
+        """
+        apms = self._players.get(name, [])
+        return {'name': name, 'games': len(apms), 'apm': _summarize(apms)}
+
+    def head_to_head(self, player1: str, player2: str) -> Dict:
+        """
+        Get the record between two players.
+
+        APM deltas are reported as player1's APM minus player2's APM.
+
+        Args:
+            player1: First player's name
+            player2: Second player's name
+
+        Returns:
+            Dictionary with games played, wins per player and APM deltas
+        """
+        return _pair_result(*self._oriented(self._player_pairs, player1, player2), player1, player2, 'player')
+
+    def civ_matchup(self, civ1: str, civ2: str) -> Dict:
+        """
+        Get the record between two civilizations.
+
+        The same civilization may be given twice for mirror matches; the
+        per-civilization wins and win rate are then None, and the APM delta
+        is the winner's APM minus the loser's.
+
+        Args:
+            civ1: First civilization
+            civ2: Second civilization
+
+        Returns:
+            Dictionary with games played, win rates and APM deltas
+        """
+        result = _pair_result(*self._oriented(self._civ_pairs, civ1, civ2), civ1, civ2, 'civ')
+        result['win_rate_by_apm_delta'] = self.civ_win_rate_by_apm_delta(civ1, civ2)
+        return result
+
+    def civ_win_rate_by_apm_delta(self, civ1: str, civ2: str) -> List[Dict]:
+        """
+        Get civ1's win rate against civ2, bucketed by civ1's APM advantage.
+
+        Returns:
+            List of buckets, ordered by APM difference
+        """
+        buckets = self._civ_delta_buckets.get((civ1, civ2), {})
+        return _bucket_results(buckets, self.delta_bucket)
+
+
+class StoreMatchups:
+    """
+    Answers the same queries as MatchupIndex from a SQLite results store.
+
+    Nothing is loaded up front: each query is a lookup on the store's
+    player and civilization indexes, so it stays fast on databases too
+    large to index in memory. Filters (same as ResultStore.query()) apply
+    to the first player or civilization of each query.
+
+    Example:
+        with ResultStore('results.db') as store:
+            matchups = StoreMatchups(store)
+            print(matchups.head_to_head('TheViper', 'Hera'))
+            print(matchups.civ_matchup('Aztecs', 'Mayans', map_name='Arabia'))
+    """
+
+    def __init__(self, store: ResultStore, delta_bucket: int = DEFAULT_DELTA_BUCKET):
+        """
+        Initialize the queries.
+
+        Args:
+            store: Results store to query
+            delta_bucket: Width of the APM-difference buckets, in APM
+        """
+        self.store = store
+        self.delta_bucket = delta_bucket
+
+    def _record(self, by: str, a: str, b: str, **filters) -> _PairRecord:
+        record = _PairRecord()
+        for winner1, winner2, apm1, apm2 in self.store.opponents(by, a, b, **filters):
+            record.add({'winner': winner1, 'apm': apm1}, {'winner': winner2, 'apm': apm2})
+        return record
+
+    def player_summary(self, name: str, **filters) -> Dict:
+        """
+        Get a player's APM distribution over all stored games.
+
+        Args:
+            name: Player name
+            **filters: Same filters as ResultStore.query()
+
+        Returns:
+            Dictionary with the game count and APM distribution
+        """
+        filters['player'] = name
+        apms = [row['apm'] for row in self.store.query(limit=None, **filters)]
+        return {'name': name, 'games': len(apms), 'apm': _summarize(apms)}
+
+    def head_to_head(self, player1: str, player2: str, **filters) -> Dict:
+        """
+        Get the record between two players.
+
+        Args:
+            player1: First player's name
+            player2: Second player's name
+            **filters: Same filters as ResultStore.query(), applied to player1
+
+        Returns:
+            Same dictionary as MatchupIndex.head_to_head()
+        """
+        record = self._record('player', player1, player2, **filters)
+        return _pair_result(record, False, player1, player2, 'player')
+
+    def civ_matchup(self, civ1: str, civ2: str, **filters) -> Dict:
+        """
+        Get the record between two civilizations.
+
+        Args:
+            civ1: First civilization
+            civ2: Second civilization, which may be civ1 for mirror matches
+            **filters: Same filters as ResultStore.query(), applied to civ1
+
+        Returns:
+            Same dictionary as MatchupIndex.civ_matchup()
+        """
+        record = self._record('civilization', civ1, civ2, **filters)
+        result = _pair_result(record, False, civ1, civ2, 'civ')
+        result['win_rate_by_apm_delta'] = self.civ_win_rate_by_apm_delta(civ1, civ2, **filters)
+        return result
+
+    def civ_win_rate_by_apm_delta(self, civ1: str, civ2: str, **filters) -> List[Dict]:
+        """
+        Get civ1's win rate against civ2, bucketed by civ1's APM advantage.
+
+        Returns:
+            List of buckets, ordered by APM difference
+        """
+        buckets = defaultdict(lambda: [0, 0])
+        for winner1, winner2, apm1, apm2 in self.store.opponents(
+                'civilization', civ1, civ2, each_view=True, **filters):
+            if winner1 != winner2:
+                counts = buckets[_delta_bucket(apm1 - apm2, self.delta_bucket)]
+                counts[0] += 1
+                counts[1] += 1 if winner1 else 0
+        return _bucket_results(buckets, self.delta_bucket)
@@ -0,0 +1,449 @@
+"""
+SQLite results store for AOE2 Record APM Analyzer.
+Keeps analyzed games and per-player rows in an indexed database, so large
+result sets can be filtered and aggregated without loading them into Python.
+"""
+
+import json
+import os
+import re
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from apm_accumulators import IntervalHistogram
+
+
+# Games written per transaction during bulk loads
+DEFAULT_BATCH_SIZE = 5000
+
+# Loads of at least this many games rebuild the indexes afterwards instead
+# of updating them row by row, which is several times faster
+BULK_LOAD_THRESHOLD = 10000
+
+GAMES_TABLE = """
+CREATE TABLE IF NOT EXISTS {name} (
+    id INTEGER PRIMARY KEY,
+    -- Absolute path of the record file, or its name if the path is unknown
+    path TEXT NOT NULL UNIQUE,
+    file TEXT NOT NULL,
+    map TEXT,
+    duration_minutes REAL,
+    partial INTEGER NOT NULL DEFAULT 0
+)"""
+
+TABLES = GAMES_TABLE.format(name='games') + """;
+
+CREATE TABLE IF NOT EXISTS players (
+    game_id INTEGER NOT NULL REFERENCES games(id) ON DELETE CASCADE,
+    number INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    civilization TEXT,
+    winner INTEGER NOT NULL,
+    total_actions INTEGER NOT NULL,
+    apm REAL NOT NULL,
+    -- JSON list of action interval histogram bucket counts
+    intervals TEXT,
+    -- Team number from the results, if known
+    team INTEGER,
+    PRIMARY KEY (game_id, number)
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS games_map ON games (map);
+CREATE INDEX IF NOT EXISTS players_name_apm ON players (name, apm);
+CREATE INDEX IF NOT EXISTS players_civilization_apm ON players (civilization, apm);
+CREATE INDEX IF NOT EXISTS players_apm ON players (apm);
+-- Covers both sides of civilization matchups (opponents() self-joins players)
+CREATE INDEX IF NOT EXISTS players_civilization_game ON players (civilization, game_id, team, winner, apm, number);
+"""
+
+# Names of the indexes above, the only ones dropped for bulk loads
+INDEX_NAMES = tuple(re.findall(r'CREATE INDEX IF NOT EXISTS (\w+)', INDEXES))
+
+# Columns that query results can be grouped by
+GROUP_BY_COLUMNS = {
+    'player': 'p.name',
+    'civilization': 'p.civilization',
+    'map': 'g.map',
+}
+
+# Columns that opponents can be matched on
+OPPONENT_COLUMNS = {
+    'player': 'name',
+    'civilization': 'civilization',
+}
+
+
+class ResultStore:
+    """
+    Stores batch results in a SQLite database.
+
+    Games are keyed by the record file's absolute path, so re-analyzing a
+    file replaces its rows instead of duplicating them, while replays with
+    the same name in different folders are kept apart. Results without a
+    path (replays analyzed from bytes) are keyed by file name.
+
+    Example:
+        with ResultStore('results.db') as store:
+            store.add_results(all_results)
+            rows = store.query(player='TheViper', min_apm=150, map_name='Arabia')
+    """
+
+    def __init__(self, path: str):
+        """
+        Open (or create) a results database.
+
+        Args:
+            path: Path to the SQLite database file
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(TABLES)
+        self._migrate()
+        self.connection.executescript(INDEXES)
+
+    def _migrate(self):
+        """Add columns that databases created by older versions lack."""
+        columns = {row['name'] for row in self.connection.execute("PRAGMA table_info(players)")}
+        if 'intervals' not in columns:
+            with self.connection:
+                self.connection.execute("ALTER TABLE players ADD COLUMN intervals TEXT")
+        if 'team' not in columns:
+            with self.connection:
+                self.connection.execute("ALTER TABLE players ADD COLUMN team INTEGER")
+
+        columns = {row['name'] for row in self.connection.execute("PRAGMA table_info(games)")}
+        if 'path' not in columns:
+            self._rebuild_games()
+
+    def _rebuild_games(self):
+        """
+        Rebuild a games table keyed by file name into one keyed by path.
+
+        SQLite can't drop the old UNIQUE constraint in place. The folders of
+        the stored games are unknown, so they keep their file name as key
+        and are replaced when the same file is stored with its path.
+        """
+        # Dropping the old table must not cascade to the player rows
+        self.connection.execute("PRAGMA foreign_keys = OFF")
+        try:
+            with self.connection:
+                self.connection.execute(GAMES_TABLE.format(name='games_new'))
+                self.connection.execute(
+                    "INSERT INTO games_new (id, path, file, map, duration_minutes, partial) "
+                    "SELECT id, file, file, map, duration_minutes, partial FROM games"
+                )
+                self.connection.execute("DROP TABLE games")
+                self.connection.execute("ALTER TABLE games_new RENAME TO games")
+        finally:
+            self.connection.execute("PRAGMA foreign_keys = ON")
+
+    def close(self):
+        """Close the database."""
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def add_results(self, results: Iterable[Dict], batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        """
+        Write game results, in one transaction per batch of games.
+
+        When given a list of at least BULK_LOAD_THRESHOLD games, indexes are
+        dropped for the load and rebuilt once at the end.
+
+        Args:
+            results: Dictionaries as returned by APMAnalyzer.get_results()
+            batch_size: Number of games written per transaction
+
+        Returns:
+            Number of games written
+        """
+        bulk = hasattr(results, '__len__') and len(results) >= BULK_LOAD_THRESHOLD
+        if bulk:
+            self._drop_indexes()
+
+        try:
+            return self._write_batches(results, batch_size)
+        finally:
+            if bulk:
+                self.connection.executescript(INDEXES)
+
+    def _drop_indexes(self):
+        """
+        Drop the store's secondary indexes ahead of a bulk load.
+
+        Indexes that users added to the database themselves are left alone,
+        since only the store's own are rebuilt afterwards.
+        """
+        with self.connection:
+            for name in INDEX_NAMES:
+                self.connection.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+    def _write_batches(self, results: Iterable[Dict], batch_size: int) -> int:
+        """Write games in transactions of batch_size games."""
+        written = 0
+        batch = []
+
+        for game in results:
+            batch.append(game)
+            if len(batch) >= batch_size:
+                written += self._write_batch(batch)
+                batch = []
+
+        if batch:
+            written += self._write_batch(batch)
+
+        return written
+
+    def _write_batch(self, games: List[Dict]) -> int:
+        """Write a batch of games and their players in a single transaction."""
+        # The last result for a file wins, also within a batch
+        games = list({self._key(game): game for game in games}.values())
+
+        with self.connection:
+            cursor = self.connection.cursor()
+            player_rows = []
+            for game in games:
+                players = game.get('players', [])
+                duration = players[0].get('duration_minutes') if players else None
+                # Replace earlier results for the file, including any stored
+                # under its name only (rows cascade)
+                key = self._key(game)
+                cursor.execute("DELETE FROM games WHERE path IN (?, ?)", (key, game['file']))
+                cursor.execute(
+                    "INSERT INTO games (path, file, map, duration_minutes, partial) VALUES (?, ?, ?, ?, ?)",
+                    (key, game['file'], game.get('map'), duration, int(bool(game.get('partial'))))
+                )
+                game_id = cursor.lastrowid
+                teams = {number: team['team'] for team in game.get('teams', []) for number in team['players']}
+                player_rows.extend(
+                    (game_id, player['number'], player['name'], player['civilization'],
+                     int(bool(player['winner'])), player['total_actions'], player['apm'],
+                     self._interval_counts(player), teams.get(player['number']))
+                    for player in players
+                )
+
+            cursor.executemany(
+                "INSERT INTO players (game_id, number, name, civilization, winner, total_actions, apm, "
+                "intervals, team) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                player_rows
+            )
+
+        return len(games)
+
+    @staticmethod
+    def _key(game: Dict) -> str:
+        """Get the key a game is stored under: its path, or its file name."""
+        return game.get('path') or game['file']
+
+    @staticmethod
+    def _interval_counts(player: Dict) -> Optional[str]:
+        """Serialize a player's interval histogram counts, if there are any."""
+        intervals = player.get('intervals')
+        if not intervals or not intervals.get('count'):
+            return None
+        return json.dumps(intervals['counts'], separators=(',', ':'))
+
+    @staticmethod
+    def _where(player: Optional[str] = None, civilization: Optional[str] = None,
+               map_name: Optional[str] = None, min_apm: Optional[float] = None,
+               max_apm: Optional[float] = None, winner: Optional[bool] = None):
+        """Build a WHERE clause and its parameters from query filters."""
+        clauses = []
+        params = []
+
+        if player is not None:
+            clauses.append("p.name = ?")
+            params.append(player)
+        if civilization is not None:
+            clauses.append("p.civilization = ?")
+            params.append(civilization)
+        if map_name is not None:
+            clauses.append("g.map = ?")
+            params.append(map_name)
+        if min_apm is not None:
+            clauses.append("p.apm >= ?")
+            params.append(min_apm)
+        if max_apm is not None:
+            clauses.append("p.apm <= ?")
+            params.append(max_apm)
+        if winner is not None:
+            clauses.append("p.winner = ?")
+            params.append(int(winner))
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def query(self, limit: Optional[int] = 100, **filters) -> List[Dict]:
+        """
+        Find player rows matching the given filters, highest APM first.
+
+        Args:
+            limit: Maximum number of rows returned (None for no limit)
+            **filters: Any of player, civilization, map_name, min_apm,
+                max_apm and winner
+
+        Returns:
+            List of dictionaries with game and player fields
+        """
+        where, params = self._where(**filters)
+        sql = (
+            "SELECT g.file, g.path, g.map, g.duration_minutes, g.partial, p.number, p.name, "
+            "p.civilization, p.winner, p.total_actions, p.apm "
+            f"FROM players p JOIN games g ON g.id = p.game_id {where} "
+            "ORDER BY p.apm DESC"
+        )
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        rows = []
+        for row in self.connection.execute(sql, params):
+            row = dict(row)
+            row['winner'] = bool(row['winner'])
+            row['partial'] = bool(row['partial'])
+            rows.append(row)
+        return rows
+
+    def aggregate(self, group_by: str, **filters) -> List[Dict]:
+        """
+        Aggregate player rows matching the given filters.
+
+        Args:
+            group_by: One of 'player', 'civilization' or 'map'
+            **filters: Same filters as query()
+
+        Returns:
+            List of dictionaries with the group key, number of games, average
+            and maximum APM and win rate, largest groups first
+
+        Raises:
+            ValueError: If group_by is not a supported column
+        """
+        if group_by not in GROUP_BY_COLUMNS:
+            raise ValueError(f"Cannot group by {group_by!r}, expected one of: {', '.join(GROUP_BY_COLUMNS)}")
+
+        column = GROUP_BY_COLUMNS[group_by]
+        where, params = self._where(**filters)
+        sql = (
+            f"SELECT {column} AS key, COUNT(DISTINCT p.game_id) AS games, ROUND(AVG(p.apm), 2) AS avg_apm, "
+            "ROUND(MAX(p.apm), 2) AS max_apm, ROUND(AVG(p.winner), 3) AS win_rate "
+            f"FROM players p JOIN games g ON g.id = p.game_id {where} "
+            f"GROUP BY {column} ORDER BY games DESC, key"
+        )
+
+        return [
+            {group_by: row['key'], 'games': row['games'], 'avg_apm': row['avg_apm'],
+             'max_apm': row['max_apm'], 'win_rate': row['win_rate']}
+            for row in self.connection.execute(sql, params)
+        ]
+
+    def opponents(self, by: str, side1: str, side2: str, each_view: bool = False,
+                  **filters) -> List[Tuple[bool, bool, float, float]]:
+        """
+        Find games where a player of side1 faced a player of side2.
+
+        Players on different teams are opponents. Rows stored without a
+        team fall back to the rule used for older results: both players of
+        a 1v1 are opponents, and in larger games only pairs with a different
+        winner status are.
+
+        Args:
+            by: 'player' or 'civilization'
+            side1: Player name or civilization of the first side
+            side2: Player name or civilization of the second side
+            each_view: If side1 and side2 are the same, return each pair once
+                from each player's view instead of once with the winner first
+            **filters: Same filters as query(), applied to side1's players
+
+        Returns:
+            List of (side1 won, side2 won, side1 APM, side2 APM) per pair
+
+        Raises:
+            ValueError: If by is not a supported column
+        """
+        if by not in OPPONENT_COLUMNS:
+            raise ValueError(f"Cannot match opponents by {by!r}, expected one of: {', '.join(OPPONENT_COLUMNS)}")
+
+        column = OPPONENT_COLUMNS[by]
+        where, params = self._where(**filters)
+        clauses = [
+            f"p.{column} = ?",
+            f"o.{column} = ?",
+            "CASE WHEN p.team IS NOT NULL AND o.team IS NOT NULL THEN p.team != o.team "
+            "ELSE p.winner != o.winner OR (SELECT COUNT(*) FROM players x WHERE x.game_id = p.game_id) = 2 END",
+        ]
+        if side1 == side2 and not each_view:
+            clauses.append("(p.winner > o.winner OR (p.winner = o.winner AND p.number < o.number))")
+        if where:
+            clauses.append(where[len("WHERE "):])
+
+        sql = (
+            "SELECT p.winner, o.winner, p.apm, o.apm FROM players p "
+            "JOIN players o ON o.game_id = p.game_id AND o.number != p.number "
+            f"JOIN games g ON g.id = p.game_id WHERE {' AND '.join(clauses)}"
+        )
+        return [
+            (bool(winner1), bool(winner2), apm1, apm2)
+            for winner1, winner2, apm1, apm2 in self.connection.execute(sql, [side1, side2] + params)
+        ]
+
+    def durations(self, paths: Iterable[str]) -> Dict[str, float]:
+        """
+        Look up the stored game durations of record files.
+
+        Useful as CostModel duration hints when a batch is re-analyzed.
+
+        Args:
+            paths: Record file paths, matched by absolute path
+
+        Returns:
+            Dictionary of game duration in minutes by the given path, for
+            files that are stored with a duration
+        """
+        by_key = {os.path.abspath(path): path for path in paths}
+        keys = list(by_key)
+        durations = {}
+        # Stay below SQLite's default limit of 999 parameters per statement
+        for start in range(0, len(keys), 900):
+            chunk = keys[start:start + 900]
+            sql = (f"SELECT path, duration_minutes FROM games WHERE path IN ({', '.join('?' * len(chunk))}) "
+                   "AND duration_minutes > 0")
+            for path, duration in self.connection.execute(sql, chunk):
+                durations[by_key[path]] = duration
+        return durations
+
+    def interval_distributions(self, **filters) -> Dict[str, IntervalHistogram]:
+        """
+        Merge the action interval histograms of player rows matching the filters.
+
+        Args:
+            **filters: Same filters as query()
+
+        Returns:
+            Dictionary of player name to merged histogram
+        """
+        where, params = self._where(**filters)
+        where = f"{where} AND p.intervals IS NOT NULL" if where else "WHERE p.intervals IS NOT NULL"
+        sql = f"SELECT p.name, p.intervals FROM players p JOIN games g ON g.id = p.game_id {where}"
+
+        merged: Dict[str, IntervalHistogram] = {}
+        for name, counts in self.connection.execute(sql, params):
+            histogram = merged.get(name)
+            if histogram is None:
+                histogram = merged[name] = IntervalHistogram()
+            histogram.merge(IntervalHistogram(json.loads(counts)))
+        return merged
+
+    def game_count(self) -> int:
+        """Get the number of stored games."""
+        return self.connection.execute("SELECT COUNT(*) FROM games").fetchone()[0]
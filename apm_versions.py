@@ -0,0 +1,154 @@
+"""
+Replay format version detection for AOE2 Record APM Analyzer.
+Reads the game version from the first bytes of a record file, so files from
+unsupported versions are rejected before any real parsing.
+"""
+
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Tuple
+
+from mgz.util import Version, get_version
+
+
+# Decoders tried in order for each supported version:
+#   'match'  - full match model (mgz.model.parse_match)
+#   'stream' - fast header parse and resilient streaming body decode
+# mgz's header parser only handles these versions, so every other version is
+# rejected up front.
+#
+# DE headers hold everything the results need (UTF-8 player names, lobby
+# teams and the map id, looked up without building the map), and DE bodies
+# can be skimmed, so the match model would only add cost: the stream decoder
+# alone is used. HD and UserPatch headers store player names in the game's
+# legacy code page, which only the match model decodes (from the map
+# instructions' language), and their bodies can't be skimmed anyway, so the
+# match model is built first and the stream decoder recovers damaged files.
+DECODE_PATHS: Dict[Version, Tuple[str, ...]] = {
+    Version.DE: ('stream',),
+    Version.HD: ('match', 'stream'),
+    Version.USERPATCH15: ('match', 'stream'),
+}
+
+# Versions whose body layout the decoders' skim mode understands (DE actions
+# carry the player id in a fixed place; older payloads need the full parser)
+SKIM_VERSIONS = frozenset({Version.DE})
+
+# Compressed header bytes read at a time while looking for the version
+_INFLATE_CHUNK = 1024
+
+# Decompressed bytes needed: version string, padding, save version and the
+# fixed-point save version that newer games store after it
+_VERSION_PREFIX = 16
+
+
+class UnsupportedVersionError(ValueError):
+    """Raised for record files from game versions that can't be analyzed."""
+
+
+@dataclass(frozen=True)
+class ReplayVersion:
+    """Version fields of a record file."""
+
+    version: Version
+    game_version: str
+    save_version: float
+    log_version: int
+
+    @property
+    def name(self) -> str:
+        """Short name of the game version, e.g. 'DE'."""
+        return self.version.name
+
+    def __str__(self):
+        return f"{self.name} ({self.game_version}, save {self.save_version:g})"
+
+
+def detect_version(handle: BinaryIO) -> ReplayVersion:
+    """
+    Detect the game version of a record file without parsing its header.
+
+    Only the start of the compressed header is inflated. The stream is left
+    at the position it had on entry.
+
+    Args:
+        handle: Seekable binary stream positioned at the start of the file
+
+    Returns:
+        ReplayVersion of the file
+
+    Raises:
+        ValueError: If the data is not a recognizable record file
+        UnsupportedVersionError: If the version fields name an unknown version
+    """
+    start = handle.tell()
+    try:
+        prefix = handle.read(8)
+        if len(prefix) < 8:
+            raise ValueError("file too short to be a record")
+        header_length, _ = struct.unpack('<II', prefix)
+
+        header = _inflate_prefix(handle, header_length - 8, _VERSION_PREFIX)
+
+        handle.seek(start + header_length)
+        log_data = handle.read(4)
+        if len(log_data) < 4:
+            raise ValueError("file ends after the record header")
+        log_version, = struct.unpack('<I', log_data)
+    finally:
+        handle.seek(start)
+
+    game_version = header[:7].decode('ascii', errors='replace')
+    save_version, = struct.unpack_from('<f', header, 8)
+    if save_version == -1:
+        # Newer saves follow it with the save version as a 16.16 fixed-point integer
+        save, = struct.unpack_from('<I', header, 12)
+        save_version = 37.0 if save == 37 else save / (1 << 16)
+    save_version = round(save_version, 2)
+
+    try:
+        version = get_version(game_version, save_version, log_version)
+    except ValueError as e:
+        raise UnsupportedVersionError(str(e))
+    if version is None:
+        raise UnsupportedVersionError(f"unsupported version: {game_version}")
+
+    return ReplayVersion(version, game_version, save_version, log_version)
+
+
+def _inflate_prefix(handle: BinaryIO, compressed_length: int, size: int) -> bytes:
+    """
+    Inflate the first bytes of the compressed header.
+
+    Raises:
+        ValueError: If the data is not a valid compressed header
+    """
+    inflater = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+    header = b''
+    try:
+        while len(header) < size and compressed_length > 0:
+            chunk = handle.read(min(_INFLATE_CHUNK, compressed_length))
+            if not chunk:
+                break
+            compressed_length -= len(chunk)
+            header += inflater.decompress(chunk, size - len(header))
+    except zlib.error as e:
+        raise ValueError(f"invalid record header: {e}")
+
+    if len(header) < size:
+        raise ValueError("invalid record header: too short")
+    return header
+
+
+def decode_path(replay_version: ReplayVersion) -> Tuple[str, ...]:
+    """
+    Get the decoders to try, in order, for a record file's version.
+
+    Raises:
+        UnsupportedVersionError: If no decoder supports the version
+    """
+    path = DECODE_PATHS.get(replay_version.version)
+    if path is None:
+        raise UnsupportedVersionError(f"unsupported game version: {replay_version}")
+    return path
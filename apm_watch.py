@@ -0,0 +1,377 @@
+"""
+Watch-folder mode for AOE2 Record APM Analyzer.
+Analyzes new .aoe2record files as soon as the game finishes writing them.
+"""
+
+import json
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from apm_metrics import METRICS, logger
+from apm_output import atomic_output
+from apm_scheduler import analyze_file_task, create_process_pool
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+
+# Seconds a file's size must stay unchanged before it is analyzed
+DEFAULT_SETTLE_SECONDS = 3.0
+
+# Seconds between directory scans (or size checks, with inotify)
+DEFAULT_POLL_INTERVAL = 1.0
+
+# Seconds between full listings of directories that look unchanged when
+# polling, to catch files rewritten in place
+FULL_SCAN_INTERVAL = 60.0
+
+
+def default_record_directory() -> str:
+    """Get the default directory for AOE2 saved games."""
+    # Try to find AOE2 save directory
+    user_home = Path.home()
+    aoe2_dir = user_home / "Games" / "Age of Empires 2 DE"
+
+    if aoe2_dir.exists():
+        return str(aoe2_dir)
+
+    return str(user_home)
+
+
+def find_savegame_directories(base: Optional[str] = None) -> List[str]:
+    """
+    Find the savegame directories of all local AOE2 DE profiles.
+
+    Args:
+        base: Directory to search (default: the AOE2 DE games directory)
+
+    Returns:
+        List of <profile ID>/savegame directories, or [base] if there are none
+    """
+    base = base or default_record_directory()
+    directories = sorted(str(path) for path in Path(base).glob('*/savegame') if path.is_dir())
+    return directories or [base]
+
+
+class ReplayWatcher:
+    """
+    Watches directories and analyzes .aoe2record files once they are complete.
+
+    New and modified files are detected with inotify when the optional
+    ``inotify_simple`` package is available on Linux, and by polling the
+    directories otherwise. Polling only lists a directory again when its
+    modification time changed (or every ``FULL_SCAN_INTERVAL`` seconds), and
+    only files whose modification time changed are checked further. A file
+    is analyzed once its size has stopped changing for ``settle_seconds``,
+    in a single long-lived worker process that keeps the parser loaded
+    between games; if that process crashes, the file is reported as failed
+    and a new worker is started. Files present when watching starts are
+    skipped unless ``process_existing`` is set.
+
+    A game paused for longer than ``settle_seconds`` is analyzed before it
+    ends, and again once the file has grown and settled. The later result
+    replaces the earlier one: its line in ``output_file`` is rewritten (the
+    cache and ResultStore replace results by path already), and
+    ``on_result`` is called again for the file.
+
+    With ``profile_root``, ``<profile ID>/savegame`` folders created under it
+    after watching starts (e.g. when a new profile first plays) are watched
+    too, and the files already in them are analyzed. The root is only
+    searched again when its modification time (or that of a profile folder
+    without a savegame folder yet) changes.
+
+    Example:
+        watcher = ReplayWatcher(find_savegame_directories(), output_file='new_games.jsonl',
+                                profile_root=default_record_directory())
+        watcher.run()
+    """
+
+    def __init__(self, directories: List[str],
+                 on_result: Optional[Callable[[str, Optional[Dict], Optional[str]], None]] = None,
+                 output_file: Optional[str] = None,
+                 cache=None,
+                 settle_seconds: float = DEFAULT_SETTLE_SECONDS,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 process_existing: bool = False,
+                 use_inotify: bool = True,
+                 profile_root: Optional[str] = None):
+        """
+        Initialize the watcher.
+
+        Args:
+            directories: Directories to watch
+            on_result: Optional callback called as on_result(path, results, error)
+            output_file: Optional JSON Lines file each result is appended to
+            cache: Optional AnalysisCache that results are stored in
+            settle_seconds: Seconds a file's size must stay unchanged
+            poll_interval: Seconds between directory scans or size checks
+            process_existing: Whether to analyze files that already exist
+            use_inotify: Whether to use inotify when it is available
+            profile_root: Optional directory whose <profile ID>/savegame
+                folders are watched, including ones created later
+        """
+        self.directories = [str(Path(d)) for d in directories]
+        self.on_result = on_result
+        self.output_file = output_file
+        self.cache = cache
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and INotify is not None
+        self.profile_root = profile_root
+
+        # path -> (size, mtime) of files already analyzed or skipped
+        self._seen: Dict[str, Tuple[int, int]] = {}
+        # path -> (size, time the size last changed) of files still being written
+        self._pending: Dict[str, Tuple[int, float]] = {}
+        self._watch_descriptors: Dict[str, int] = {}
+        # path -> mtime of record files as of the last poll
+        self._mtimes: Dict[str, int] = {}
+        # directory -> mtime as of its last listing
+        self._directory_mtimes: Dict[str, int] = {}
+        # profile root and profile folders without a savegame folder -> mtime
+        # as of the last search for savegame folders
+        self._profile_mtimes: Dict[str, int] = {}
+        # path -> line written to output_file for the file
+        self._output_lines: Dict[str, str] = {}
+        self._next_full_scan = 0.0
+        self._worker = None
+        self._running = False
+
+        if not process_existing:
+            for path in self._scan():
+                signature = self._signature(path)
+                self._seen[path] = signature
+                if signature is not None:
+                    self._mtimes[path] = signature[1]
+
+    @staticmethod
+    def _signature(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def _list(directory: str) -> List[os.DirEntry]:
+        """List the record files in a directory."""
+        try:
+            with os.scandir(directory) as entries:
+                return [entry for entry in entries if entry.name.endswith('.aoe2record') and entry.is_file()]
+        except OSError:
+            return []
+
+    def _scan(self) -> List[str]:
+        """List all record files in the watched directories."""
+        return [entry.path for directory in self.directories for entry in self._list(directory)]
+
+    def _poll(self, now: float) -> List[str]:
+        """List the record files that were added or modified since the last poll."""
+        full_scan = now >= self._next_full_scan
+        if full_scan:
+            self._next_full_scan = now + FULL_SCAN_INTERVAL
+
+        changed = []
+        for directory in self.directories:
+            try:
+                directory_mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            if not full_scan and self._directory_mtimes.get(directory) == directory_mtime:
+                continue
+            self._directory_mtimes[directory] = directory_mtime
+
+            for entry in self._list(directory):
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                except OSError:
+                    continue
+                if self._mtimes.get(entry.path) != mtime:
+                    self._mtimes[entry.path] = mtime
+                    changed.append(entry.path)
+        return changed
+
+    def _discover(self, inotify) -> List[str]:
+        """
+        Start watching savegame folders created under the profile root.
+
+        Returns:
+            Record files already in the new folders
+        """
+        if self.profile_root is None:
+            return []
+
+        mtimes = self._directory_mtimes_of(self._profile_mtimes or [self.profile_root])
+        if mtimes == self._profile_mtimes:
+            return []
+
+        # Taken before searching, so folders created during the search are
+        # found next time
+        try:
+            with os.scandir(self.profile_root) as entries:
+                waiting = [entry.path for entry in entries
+                           if entry.is_dir() and not os.path.isdir(os.path.join(entry.path, 'savegame'))]
+        except OSError:
+            waiting = []
+        self._profile_mtimes = {self.profile_root: mtimes.get(self.profile_root),
+                                **self._directory_mtimes_of(waiting)}
+
+        paths = []
+        for directory in find_savegame_directories(self.profile_root):
+            directory = str(Path(directory))
+            if directory in self.directories:
+                continue
+            self.directories.append(directory)
+            logger.info("Watching new savegame folder %s", directory)
+            if inotify is not None:
+                self._add_watch(inotify, directory)
+            paths.extend(entry.path for entry in self._list(directory))
+        return paths
+
+    @staticmethod
+    def _directory_mtimes_of(directories) -> Dict[str, Optional[int]]:
+        mtimes = {}
+        for directory in directories:
+            try:
+                mtimes[directory] = os.stat(directory).st_mtime_ns
+            except OSError:
+                mtimes[directory] = None
+        return mtimes
+
+    def _add_watch(self, inotify, directory: str):
+        mask = inotify_flags.CREATE | inotify_flags.MODIFY | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+        try:
+            self._watch_descriptors[directory] = inotify.add_watch(directory, mask)
+        except OSError:
+            pass
+
+    def _touch(self, path: str, now: float):
+        """Record that a file may have changed."""
+        signature = self._signature(path)
+        if signature is None or self._seen.get(path) == signature:
+            return
+
+        size = signature[0]
+        previous = self._pending.get(path)
+        if previous is None or previous[0] != size:
+            self._pending[path] = (size, now)
+
+    def _ready_files(self, now: float) -> List[str]:
+        """Get pending files whose size has settled, updating the rest."""
+        ready = []
+        for path, (size, changed_at) in list(self._pending.items()):
+            signature = self._signature(path)
+            if signature is None:
+                del self._pending[path]
+            elif signature[0] != size:
+                self._pending[path] = (signature[0], now)
+            elif now - changed_at >= self.settle_seconds and size > 0:
+                del self._pending[path]
+                self._seen[path] = signature
+                ready.append(path)
+        return ready
+
+    def _handle_result(self, path: str, results: Optional[Dict], error: Optional[str]):
+        """Store a finished analysis and notify the caller."""
+        if results is not None:
+            if self.cache is not None:
+                self.cache.put(path, results)
+            if self.output_file:
+                self._write_output(path, json.dumps(results) + '\n')
+
+        if self.on_result is not None:
+            self.on_result(path, results, error)
+
+    def _write_output(self, path: str, line: str):
+        """Append a file's result line, replacing the line written for it earlier."""
+        previous = self._output_lines.get(path)
+        self._output_lines[path] = line
+        if previous is not None:
+            try:
+                with open(self.output_file, encoding='utf-8') as f, atomic_output(self.output_file) as out:
+                    for existing in f:
+                        if existing != previous:
+                            out.write(existing)
+                    out.write(line)
+                return
+            except OSError as e:
+                logger.warning("Could not replace the earlier result of %s in %s: %s", path, self.output_file, e)
+
+        with open(self.output_file, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+    def _events(self, inotify) -> List[str]:
+        """Wait for file events and return the paths that changed."""
+        if inotify is None:
+            time.sleep(self.poll_interval)
+            return self._poll(time.monotonic())
+
+        paths = []
+        watch_dirs = {wd: directory for directory, wd in self._watch_descriptors.items()}
+        for event in inotify.read(timeout=int(self.poll_interval * 1000)):
+            if event.name.endswith('.aoe2record') and event.wd in watch_dirs:
+                paths.append(os.path.join(watch_dirs[event.wd], event.name))
+        return paths
+
+    def _analyze(self, path: str) -> Tuple[Optional[Dict], Optional[str]]:
+        """Analyze a file in the worker process, replacing the worker if it crashed."""
+        try:
+            results, error, _, metrics = self._worker.submit(analyze_file_task, path).result()
+        except BrokenProcessPool as e:
+            # e.g. the worker was killed or ran out of memory on this file
+            logger.error("Worker process crashed analyzing %s, starting a new one: %s", path, e)
+            METRICS.files_failed.inc(reason='worker_error')
+            self._worker.shutdown(wait=False)
+            self._worker = create_process_pool(1)
+            return None, f"worker process crashed: {e}"
+        except Exception as e:
+            logger.error("Worker failed analyzing %s: %s", path, e)
+            METRICS.files_failed.inc(reason='worker_error')
+            return None, str(e)
+
+        METRICS.merge(metrics)
+        return results, error
+
+    def run(self, max_files: Optional[int] = None):
+        """
+        Watch for new record files until stopped.
+
+        Args:
+            max_files: Optional number of files after which to stop
+        """
+        inotify = None
+        if self.use_inotify:
+            inotify = INotify()
+            for directory in self.directories:
+                self._add_watch(inotify, directory)
+
+        processed = 0
+        self._running = True
+        # A single warm worker keeps the parser loaded between games
+        self._worker = create_process_pool(1)
+        try:
+            while self._running:
+                now = time.monotonic()
+                for path in self._discover(inotify) + self._events(inotify):
+                    self._touch(path, now)
+
+                for path in self._ready_files(time.monotonic()):
+                    results, error = self._analyze(path)
+                    self._handle_result(path, results, error)
+                    processed += 1
+                    if max_files is not None and processed >= max_files:
+                        return
+        finally:
+            self._running = False
+            self._worker.shutdown()
+            if inotify is not None:
+                inotify.close()
+
+    def stop(self):
+        """Stop watching after the current check completes."""
+        self._running = False
@@ -0,0 +1,148 @@
+"""
+Benchmark writing large result sets in each output format.
+
+Synthetic results shaped like real ones (bursts and interval histograms
+included) are written with the old single-shot json.dumps(indent=2) and
+with each apm_output writer. For each, the time spent encoding (writing to
+a discarding stream) is shown next to the total time, and the raw disk
+write speed of the same bytes is the I/O baseline.
+
+Usage:
+    python benchmarks/bench_output.py [--results 100000] [--directory DIR] [--no-orjson]
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apm_accumulators import IntervalTracker  # noqa: E402
+import apm_output  # noqa: E402
+from apm_output import WRITERS, write_results  # noqa: E402
+
+
+class _NullStream(io.TextIOBase):
+    """Text stream that counts and discards what is written."""
+
+    def __init__(self):
+        self.characters = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.characters += len(text)
+        return len(text)
+
+
+def _interval_summaries(rng, count):
+    summaries = []
+    for _ in range(count):
+        intervals = IntervalTracker()
+        timestamp = 0
+        for _ in range(2000):
+            timestamp += rng.expovariate(1 / 400)
+            intervals.add(1, timestamp)
+        summaries.append(intervals.results(1))
+    return summaries
+
+
+def synthetic_results(count, seed=0):
+    rng = random.Random(seed)
+    civilizations = ['Franks', 'Mayans', 'Britons', 'Huns', 'Aztecs', 'Chinese']
+    intervals = _interval_summaries(rng, 50)
+    results = []
+    for index in range(count):
+        players = []
+        for number in (1, 2):
+            players.append({
+                'number': number,
+                'name': f"player{rng.randrange(10000)}",
+                'civilization': rng.choice(civilizations),
+                'winner': number == 1,
+                'total_actions': rng.randrange(1000, 9000),
+                'apm': round(rng.uniform(20, 200), 2),
+                'duration_minutes': round(rng.uniform(10, 60), 2),
+                'bursts': {
+                    label: [{'start_seconds': 1412.3, 'end_seconds': 1422.3, 'actions': 61, 'apm': 366.0}] * 3
+                    for label in ('10s', '60s')
+                },
+                'intervals': rng.choice(intervals)
+            })
+        results.append({'file': f"game{index}.aoe2record", 'map': 'Arabia', 'version': 'DE',
+                        'partial': False, 'players': players})
+    return results
+
+
+def _time(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--results', type=int, default=100000)
+    parser.add_argument('--directory', help='Directory to write to (default: a temporary one)')
+    parser.add_argument('--no-orjson', action='store_true', help='Encode with the json module only')
+    args = parser.parse_args()
+    if args.no_orjson:
+        apm_output.orjson = None
+
+    results = synthetic_results(args.results)
+    directory = args.directory or tempfile.mkdtemp()
+    print(f"{args.results} results, writing to {directory}")
+
+    # I/O baseline: the bytes of the compact JSON output, written in one go
+    data = io.StringIO()
+    WRITERS['json'](data, indent=None).write_all(results)
+    data = data.getvalue().encode('utf-8')
+    path = os.path.join(directory, 'baseline.bin')
+
+    def raw_write():
+        with open(path, 'wb') as f:
+            f.write(data)
+            os.fsync(f.fileno())
+    seconds = _time(raw_write)
+    print(f"  {'disk write':<28} {seconds:7.2f}s  {len(data) / seconds / 1e6:7.0f} MB/s")
+
+    def single_shot():
+        with open(os.path.join(directory, 'single_shot.json'), 'w') as f:
+            f.write(json.dumps(results, indent=2))
+    print(f"  {'json.dumps(indent=2)':<28} {_time(single_shot):7.2f}s")
+
+    print(f"  encoder: {'orjson' if apm_output.orjson is not None else 'json'}")
+    cases = [
+        ('json, indent=2', 'results_indented.json', 'json', 2),
+        ('json --compact', 'results.json', 'json', None),
+        ('jsonl', 'results.jsonl', 'jsonl', None),
+        ('csv', 'results.csv', 'csv', None),
+        ('json --compact + gzip', 'results.json.gz', 'json', None),
+        ('csv + gzip', 'results.csv.gz', 'csv', None),
+    ]
+    try:
+        import zstandard  # noqa: F401
+        cases.append(('json --compact + zstd', 'results.json.zst', 'json', None))
+    except ImportError:
+        pass
+
+    print(f"  {'writer':<28} {'total':>8}  {'encode':>7}  {'size':>9}")
+    for label, name, output_format, indent in cases:
+        null = _NullStream()
+        writer = WRITERS[output_format](null, indent=indent) if output_format == 'json' else WRITERS[output_format](null)
+        encode_seconds = _time(lambda: writer.write_all(results))
+
+        path = os.path.join(directory, name)
+        total_seconds = _time(lambda: write_results(results, path, indent=indent))
+        size = os.path.getsize(path)
+        print(f"  {label:<28} {total_seconds:7.2f}s  {encode_seconds:6.2f}s  {size / 1e6:7.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
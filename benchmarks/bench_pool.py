@@ -0,0 +1,78 @@
+"""
+Benchmark worker pool spin-up time and per-worker memory.
+
+Compares a plain process pool, where every worker imports mgz and loads its
+reference data itself, with create_process_pool(), which forks workers from a
+preloaded fork server where available.
+
+Usage:
+    python benchmarks/bench_pool.py [--workers N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apm_scheduler import create_process_pool  # noqa: E402
+
+
+def _memory_kb():
+    """Get this process's resident and proportional set size in kB (Linux only)."""
+    values = {}
+    for name in ('/proc/self/status', '/proc/self/smaps_rollup'):
+        try:
+            with open(name) as f:
+                for line in f:
+                    key, _, rest = line.partition(':')
+                    if key in ('VmRSS', 'Pss'):
+                        values[key] = int(rest.split()[0])
+        except OSError:
+            continue
+    return values.get('VmRSS'), values.get('Pss')
+
+
+def _probe(_):
+    """Make the worker ready to parse and report its memory use."""
+    time.sleep(0.2)  # keep every worker busy so each one runs a probe
+    import apm_analyzer  # noqa: F401
+    from apm_reference import warm_up
+    warm_up()
+    return (os.getpid(),) + _memory_kb()
+
+
+def _measure(label, make_pool, workers):
+    start = time.perf_counter()
+    with make_pool(workers) as pool:
+        probes = list(pool.map(_probe, range(workers)))
+    elapsed = time.perf_counter() - start - 0.2
+
+    rss = [p[1] for p in probes if p[1] is not None]
+    pss = [p[2] for p in probes if p[2] is not None]
+    line = f"{label:<28} spin-up {elapsed:6.3f}s"
+    if rss:
+        line += f"   RSS/worker {sum(rss) / len(rss) / 1024:6.1f} MB"
+    if pss:
+        line += f"   PSS/worker {sum(pss) / len(pss) / 1024:6.1f} MB"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    args = parser.parse_args()
+
+    def plain_pool(workers):
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    print(f"{args.workers} workers")
+    _measure("spawn, cold workers", plain_pool, args.workers)
+    _measure("create_process_pool", create_process_pool, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark approximate (sampled) APM against exact counting.
+
+With record files, each is analyzed exactly and with --sample, and the APM
+error and speedup are reported. Without files, synthetic DE-style bodies
+(checksum syncs, viewlocks and move actions at a varying rate) are decoded
+in full and sampled instead.
+
+Usage:
+    python benchmarks/bench_sampling.py [--rate 0.2] [records ...]
+"""
+
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apm_analyzer import APMAnalyzer  # noqa: E402
+from apm_decoder import ResilientDecoder  # noqa: E402
+from apm_sampling import SampledDecoder  # noqa: E402
+from synthetic import synthetic_body  # noqa: E402
+
+
+def bench_synthetic(rate, games, minutes):
+    bodies = [synthetic_body(minutes, seed) for seed in range(games)]
+    bodies = [(body.data, body.apm()) for body in bodies]
+
+    start = time.perf_counter()
+    for data, _ in bodies:
+        for _ in ResilientDecoder(io.BytesIO(data)).operations():
+            pass
+    full_seconds = time.perf_counter() - start
+
+    errors, covered, totals = [], 0, {}
+    start = time.perf_counter()
+    estimates = [SampledDecoder(io.BytesIO(data), sample_rate=rate).estimate() for data, _ in bodies]
+    sampled_seconds = time.perf_counter() - start
+
+    for estimate, (_, true_apm) in zip(estimates, bodies):
+        for player, apm in true_apm.items():
+            result = estimate.player(player)
+            errors.append(abs(result['apm'] - apm) / apm)
+            covered += abs(result['apm'] - apm) <= (result['apm_error'] or 0)
+            estimated, actual = totals.get(player, (0, 0))
+            totals[player] = (estimated + result['apm'], actual + apm)
+
+    print(f"{games} synthetic {minutes}-minute games, sample rate {rate}")
+    print(f"  full decode  {full_seconds / games * 1000:7.1f} ms/game")
+    print(f"  sampled      {sampled_seconds / games * 1000:7.1f} ms/game "
+          f"({full_seconds / sampled_seconds:.1f}x faster)")
+    print(f"  per-game APM error: mean {statistics.mean(errors):.1%}, max {max(errors):.1%}; "
+          f"within 95% bounds {covered / len(errors):.0%}")
+    for player, (estimated, actual) in sorted(totals.items()):
+        print(f"  player {player} average over games: error {estimated / actual - 1:+.2%}")
+
+
+def bench_files(rate, files):
+    errors = []
+    exact_seconds = sampled_seconds = 0.0
+    for path in files:
+        start = time.perf_counter()
+        exact = APMAnalyzer(path)
+        if not exact.parse():
+            continue
+        exact_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        sampled = APMAnalyzer(path, sample_rate=rate)
+        sampled.parse()
+        sampled_seconds += time.perf_counter() - start
+
+        for number, info in exact.apm_data.items():
+            estimate = sampled.apm_data.get(number, {}).get('apm', 0)
+            if info['apm']:
+                errors.append(abs(estimate - info['apm']) / info['apm'])
+
+    if not errors:
+        print("No files could be analyzed")
+        return
+    print(f"{len(files)} files, sample rate {rate}")
+    print(f"  exact    {exact_seconds:7.2f}s")
+    print(f"  sampled  {sampled_seconds:7.2f}s ({exact_seconds / sampled_seconds:.1f}x faster)")
+    print(f"  per-player APM error: mean {statistics.mean(errors):.1%}, max {max(errors):.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('records', nargs='*', help='Record files to compare on')
+    parser.add_argument('--rate', type=float, default=0.2)
+    parser.add_argument('--games', type=int, default=40, help='Synthetic games (without records)')
+    parser.add_argument('--minutes', type=int, default=30, help='Synthetic game length')
+    args = parser.parse_args()
+
+    if args.records:
+        bench_files(args.rate, args.records)
+    else:
+        bench_synthetic(args.rate, args.games, args.minutes)
+
+
+if __name__ == '__main__':
+    main()
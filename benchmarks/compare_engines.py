@@ -0,0 +1,408 @@
+"""
+Compare every APM engine against the reference on a fixture corpus.
+
+The reference for a record file is the full match model (parse_match, the
+'match' decoder). Each engine is run on every fixture it supports, and its
+per-player action totals, game duration and age-up times are diffed
+against the reference:
+
+- record files given on the command line, plus truncated copies of them
+  (which parse_match usually can't read; engines must then report partial
+  results that don't exceed the full file's totals)
+- synthetic DE-style bodies with exactly known totals and age-ups (one of
+  them cancelled and researched again), whole and truncated
+
+Synthetic bodies have no header, so on them the exact engines run only
+APMAnalyzer's body decode (the step parse() runs after the header: action
+counting, player filtering and partial-result handling). Header parsing,
+version detection and decoder fallback are only covered by record files.
+
+Exact engines must match the reference exactly (durations within
+DURATION_TOLERANCE_MS, ages on whole fixtures only). Approximate engines must be within their reported
+95% error bounds, so about one player in twenty outside them is expected.
+The exit status is 1 if any exact engine mismatches or fails.
+
+Usage:
+    python benchmarks/compare_engines.py [--synthetic 8] [--truncate 0.5 0.9] [records or directories ...]
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apm_analyzer import APMAnalyzer  # noqa: E402
+from apm_cache import AnalysisCache  # noqa: E402
+from apm_metrics import MetricsRegistry, configure_logging  # noqa: E402
+from apm_sampling import DEFAULT_SAMPLE_RATE, SampledDecoder  # noqa: E402
+from apm_versions import ReplayVersion, SKIM_VERSIONS  # noqa: E402
+from synthetic import SyntheticBody, synthetic_body  # noqa: E402
+
+
+# Largest difference in game duration between exact engines and the reference
+DURATION_TOLERANCE_MS = 1000
+
+# Relative APM tolerance for approximate engines that report no error bound
+APPROXIMATE_TOLERANCE = 0.1
+
+
+@dataclass
+class Fixture:
+    """A record file or synthetic body to run the engines on."""
+
+    name: str
+    data: bytes
+    # Synthetic fixtures: the body and the length of the prefix used
+    body: Optional[SyntheticBody] = None
+    truncated: bool = False
+    # Truncated record files: reference of the full file
+    full_reference: Optional['EngineResult'] = None
+
+    @property
+    def synthetic(self) -> bool:
+        return self.body is not None
+
+
+@dataclass
+class EngineResult:
+    """Per-player totals reported by an engine for one fixture."""
+
+    actions: Dict[int, int]
+    duration_ms: float
+    partial: bool = False
+    apm: Dict[int, float] = field(default_factory=dict)
+    apm_error: Dict[int, Optional[float]] = field(default_factory=dict)
+    # (name, start seconds) of each age phase, if phases are based on ages
+    ages: Dict[int, List[Tuple[str, float]]] = field(default_factory=dict)
+
+
+@dataclass
+class Engine:
+    """An engine and the kinds of fixtures it can run on."""
+
+    name: str
+    # Returns None if the engine can't read the fixture
+    run: Callable[[Fixture, argparse.Namespace], Optional[EngineResult]]
+    exact: bool = True
+    records: bool = True
+    synthetic: bool = True
+
+    def supports(self, fixture: Fixture) -> bool:
+        return self.synthetic if fixture.synthetic else self.records
+
+
+def _from_analyzer(fixture: Fixture, **options) -> Optional[EngineResult]:
+    """Run APMAnalyzer on a record fixture."""
+    analyzer = APMAnalyzer(f"{fixture.name}.aoe2record", data=fixture.data, metrics=MetricsRegistry(),
+                           **options)
+    if not analyzer.parse():
+        return None
+    return _from_results(analyzer.get_results())
+
+
+def _ages(phases: Dict[int, List[Dict]], basis: str) -> Dict[int, List[Tuple[str, float]]]:
+    """Get each player's age phases from phase results."""
+    if basis != 'ages':
+        return {}
+    return {number: [(phase['phase'], phase['start_seconds']) for phase in player_phases]
+            for number, player_phases in phases.items()}
+
+
+def _from_results(results: Dict) -> EngineResult:
+    players = results['players']
+    return EngineResult(
+        actions={player['number']: player['total_actions'] for player in players},
+        duration_ms=players[0]['duration_minutes'] * 60000 if players else 0,
+        partial=results['partial'],
+        apm={player['number']: player['apm'] for player in players},
+        apm_error={player['number']: player.get('apm_error') for player in players},
+        ages=_ages({player['number']: player.get('phases', []) for player in players},
+                   results.get('phase_basis')),
+    )
+
+
+def _count_body(fixture: Fixture, skim: bool) -> EngineResult:
+    """
+    Run APMAnalyzer's body decode on a synthetic fixture.
+
+    The body is decoded as parse() does once the header has been read on
+    the streaming path, with a DE version set when skimming.
+    """
+    analyzer = APMAnalyzer(f"{fixture.name}.aoe2record", data=fixture.data, metrics=MetricsRegistry())
+    if skim:
+        analyzer.version = ReplayVersion(next(iter(SKIM_VERSIONS)), 'synthetic', 0.0, 0)
+    action_counts, _ = analyzer._decode_actions(io.BytesIO(fixture.data))
+    analyzer._store_apm(action_counts, analyzer.decode_stats.covered_ms)
+    return EngineResult(
+        actions={number: apm['total_actions'] for number, apm in analyzer.apm_data.items()},
+        duration_ms=analyzer.duration_ms,
+        partial=analyzer.decode_stats.partial,
+        apm={number: apm['apm'] for number, apm in analyzer.apm_data.items()},
+        ages=_ages({number: analyzer.phases.results(number, analyzer.duration_ms) for number in analyzer.apm_data},
+                   analyzer.phases.basis),
+    )
+
+
+def run_match(fixture: Fixture, args) -> Optional[EngineResult]:
+    return _from_analyzer(fixture, decoders=('match',))
+
+
+def run_stream(fixture: Fixture, args) -> Optional[EngineResult]:
+    if fixture.synthetic:
+        return _count_body(fixture, skim=False)
+    # Skims operations on versions that allow it
+    return _from_analyzer(fixture, decoders=('stream',))
+
+
+def run_skim(fixture: Fixture, args) -> Optional[EngineResult]:
+    return _count_body(fixture, skim=True)
+
+
+def run_sample(fixture: Fixture, args) -> Optional[EngineResult]:
+    if not fixture.synthetic:
+        return _from_analyzer(fixture, decoders=('sample',), sample_rate=args.rate)
+
+    estimate = SampledDecoder(io.BytesIO(fixture.data), sample_rate=args.rate).estimate()
+    players = {number: estimate.player(number) for number in estimate.players()}
+    return EngineResult(
+        actions={number: player['total_actions'] for number, player in players.items()},
+        duration_ms=estimate.duration_ms,
+        apm={number: player['apm'] for number, player in players.items()},
+        apm_error={number: player['apm_error'] for number, player in players.items()},
+    )
+
+
+def run_cache(fixture: Fixture, args) -> Optional[EngineResult]:
+    """Results served from AnalysisCache after a first analysis."""
+    path = os.path.join(args.scratch, f"{fixture.name}.aoe2record")
+    with open(path, 'wb') as f:
+        f.write(fixture.data)
+    cache = AnalysisCache()
+    cache.analyze(path)
+    results = cache.analyze(path)
+    return _from_results(results) if results is not None else None
+
+
+ENGINES = [
+    Engine('match', run_match, synthetic=False),
+    Engine('stream', run_stream),
+    # On record files, 'stream' already skims where the version allows it
+    Engine('skim', run_skim, records=False),
+    Engine('sample', run_sample, exact=False),
+    Engine('cache', run_cache, synthetic=False),
+]
+
+
+def reference(fixture: Fixture, results: Dict[str, Optional[EngineResult]]) -> Optional[EngineResult]:
+    """Get the result an engine's output is compared with."""
+    if fixture.synthetic:
+        counts, duration_ms = fixture.body.truth(len(fixture.data))
+        ages = {player: [('Dark Age', 0.0)] + [(name, round(start / 1000, 1))
+                                              for start, name in player_ages if start < duration_ms]
+                for player, player_ages in fixture.body.ages.items()}
+        return EngineResult(counts, duration_ms, partial=fixture.truncated, ages=ages)
+    if fixture.truncated:
+        return fixture.full_reference
+    return results.get('match')
+
+
+def compare(engine: Engine, fixture: Fixture, result: EngineResult, expected: EngineResult) -> List[str]:
+    """
+    Diff an engine's result against the reference.
+
+    Returns:
+        List of mismatch descriptions (empty if the result matches)
+    """
+    problems = []
+
+    if not fixture.synthetic and fixture.truncated:
+        # Only the full file's totals are known: a partial result must not exceed them
+        for number, actions in result.actions.items():
+            if actions > expected.actions.get(number, 0):
+                problems.append(f"player {number}: {actions} actions, more than the full file's "
+                                f"{expected.actions.get(number, 0)}")
+        if result.duration_ms > expected.duration_ms + DURATION_TOLERANCE_MS:
+            problems.append(f"duration {result.duration_ms / 1000:.1f}s exceeds the full file's "
+                            f"{expected.duration_ms / 1000:.1f}s")
+        if engine.exact and not result.partial:
+            problems.append("truncated file not reported as partial")
+        return problems
+
+    if engine.exact:
+        for number in sorted(set(result.actions) | set(expected.actions)):
+            actual, wanted = result.actions.get(number, 0), expected.actions.get(number, 0)
+            if actual != wanted:
+                problems.append(f"player {number}: {actual} actions, expected {wanted}")
+        if abs(result.duration_ms - expected.duration_ms) > DURATION_TOLERANCE_MS:
+            problems.append(f"duration {result.duration_ms / 1000:.1f}s, "
+                            f"expected {expected.duration_ms / 1000:.1f}s")
+        if fixture.synthetic and result.partial != expected.partial:
+            problems.append(f"partial is {result.partial}, expected {expected.partial}")
+        # Age-ups researched before a cut can't be told from the prefix alone
+        if not fixture.truncated:
+            for number in sorted(set(result.ages) | set(expected.ages)):
+                actual, wanted = result.ages.get(number, []), expected.ages.get(number, [])
+                if actual != wanted:
+                    problems.append(f"player {number}: ages {actual}, expected {wanted}")
+        return problems
+
+    minutes = expected.duration_ms / 60000
+    for number, wanted_actions in sorted(expected.actions.items()):
+        wanted = wanted_actions / minutes if minutes else 0
+        actual = result.apm.get(number, 0)
+        bound = result.apm_error.get(number)
+        if bound is None:
+            bound = APPROXIMATE_TOLERANCE * wanted
+        if abs(actual - wanted) > bound:
+            problems.append(f"player {number}: {actual:.1f} APM, expected {wanted:.1f} (bound ±{bound:.1f})")
+    return problems
+
+
+def record_fixtures(paths: List[str], fractions: List[float]) -> List[Fixture]:
+    """Load record files, and make truncated copies of each."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(str(p) for p in Path(path).rglob('*.aoe2record')))
+        else:
+            files.append(path)
+
+    fixtures = []
+    for path in files:
+        with open(path, 'rb') as f:
+            data = f.read()
+        name = Path(path).stem
+        fixtures.append(Fixture(name, data))
+        for fraction in fractions:
+            fixtures.append(Fixture(f"{name}-cut{fraction:.0%}", data[:int(len(data) * fraction)],
+                                    truncated=True))
+    return fixtures
+
+
+def synthetic_fixtures(count: int, minutes: float, fractions: List[float]) -> List[Fixture]:
+    """Build synthetic bodies, and truncated copies of each."""
+    fixtures = []
+    for seed in range(count):
+        body = synthetic_body(minutes, seed, base_apm=(40 + 20 * seed % 120, 100 + 15 * seed % 150))
+        fixtures.append(Fixture(f"synthetic-{seed}", body.data, body=body))
+        for fraction in fractions:
+            # Cut mid-operation, as a crashed or interrupted recording would be
+            length = int(len(body.data) * fraction) + 3
+            fixtures.append(Fixture(f"synthetic-{seed}-cut{fraction:.0%}", body.data[:length],
+                                    body=body, truncated=True))
+    return fixtures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('records', nargs='*', help='Record files or directories')
+    parser.add_argument('--synthetic', type=int, default=8, help='Synthetic bodies (default: 8)')
+    parser.add_argument('--minutes', type=float, default=30, help='Synthetic game length')
+    parser.add_argument('--truncate', type=float, nargs='*', default=[0.5, 0.9],
+                        help='Fractions to truncate copies of each fixture at')
+    parser.add_argument('--rate', type=float, default=DEFAULT_SAMPLE_RATE, help='Sample rate')
+    parser.add_argument('--engines', nargs='*', choices=[engine.name for engine in ENGINES],
+                        help='Engines to run (default: all)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="List every mismatch, and show the analyzer's warnings")
+    args = parser.parse_args()
+
+    # Truncated fixtures make the analyzer warn about every damaged file
+    configure_logging('warning' if args.verbose else 'critical')
+
+    args.scratch = tempfile.mkdtemp()
+
+    engines = [engine for engine in ENGINES if not args.engines or engine.name in args.engines]
+    fixtures = (record_fixtures(args.records, args.truncate)
+                + synthetic_fixtures(args.synthetic, args.minutes, args.truncate))
+
+    # Truncated record files are checked against their full file's reference
+    full_references = {}
+    for fixture in fixtures:
+        if not fixture.synthetic and not fixture.truncated:
+            full_references[fixture.name] = run_match(fixture, args)
+        elif not fixture.synthetic:
+            fixture.full_reference = full_references.get(fixture.name.rsplit('-cut', 1)[0])
+
+    # engine -> {fixture name: seconds}, and (engine, fixture name, problems)
+    seconds: Dict[str, Dict[str, float]] = {engine.name: {} for engine in engines}
+    mismatches = []
+    errors = []
+
+    for fixture in fixtures:
+        results: Dict[str, Optional[EngineResult]] = {}
+        for engine in engines:
+            if not engine.supports(fixture):
+                continue
+            start = time.perf_counter()
+            try:
+                result = engine.run(fixture, args)
+            except Exception as e:
+                errors.append((engine, fixture, f"{type(e).__name__}: {e}"))
+                continue
+            seconds[engine.name][fixture.name] = time.perf_counter() - start
+            results[engine.name] = result
+            # The reference decoder isn't expected to read truncated files
+            if result is None and not (engine.name == 'match' and fixture.truncated):
+                errors.append((engine, fixture, "no result"))
+
+        expected = reference(fixture, results)
+        for engine in engines:
+            result = results.get(engine.name)
+            if result is None or expected is None or (engine.name == 'match' and not fixture.synthetic
+                                                       and not fixture.truncated):
+                continue
+            problems = compare(engine, fixture, result, expected)
+            if problems:
+                mismatches.append((engine, fixture, problems))
+
+    print(f"{len(fixtures)} fixtures ({sum(f.synthetic for f in fixtures)} synthetic, "
+          f"{sum(f.truncated for f in fixtures)} truncated), sample rate {args.rate}\n")
+    print(f"{'Engine':<10} {'Fixtures':>8} {'Mismatch':>9} {'Errors':>7} {'Time':>9} {'Speedup':>8}")
+    print('-' * 56)
+    for engine in engines:
+        timings = seconds[engine.name]
+        # Baseline: the reference decoder on record files, the full decode on synthetic bodies
+        speedups = []
+        for baseline in ('match', 'stream'):
+            if baseline == engine.name or baseline not in seconds:
+                continue
+            shared = [name for name in timings if name in seconds[baseline]]
+            own_time = sum(timings[name] for name in shared)
+            if shared and own_time:
+                base_time = sum(seconds[baseline][name] for name in shared)
+                speedups.append(f"{base_time / own_time:.1f}x vs {baseline}")
+        engine_mismatches = sum(1 for e, _, _ in mismatches if e is engine)
+        engine_errors = sum(1 for e, _, _ in errors if e is engine)
+        print(f"{engine.name:<10} {len(timings):>8} {engine_mismatches:>9} {engine_errors:>7} "
+              f"{sum(timings.values()):>8.2f}s {', '.join(speedups) or '-':>8}")
+
+    if not any(not fixture.synthetic for fixture in fixtures):
+        print("\nNo record files given: 'match' and 'cache' were not run.")
+
+    approximate = [m for m in mismatches if not m[0].exact]
+    if approximate:
+        print(f"\nApproximate engines outside their 95% bounds: {len(approximate)} fixture(s) "
+              f"(a few are expected)")
+
+    failures = [m for m in mismatches if m[0].exact]
+    shown = [m for m in mismatches if m[0].exact or args.verbose]
+    shown += [(engine, fixture, [message]) for engine, fixture, message in errors]
+    if shown:
+        print()
+    for engine, fixture, problems in shown:
+        for problem in problems:
+            print(f"{engine.name:<10} {fixture.name}: {problem}")
+
+    sys.exit(1 if failures or errors else 0)
+
+
+if __name__ == '__main__':
+    main()
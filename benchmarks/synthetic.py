@@ -0,0 +1,164 @@
+"""
+Synthetic DE-style record bodies for benchmarks.
+
+Bodies contain checksum syncs (with DE game times every 20 ticks),
+viewlocks and move actions for two players, at a rate that rises over the
+game with periodic bursts, and a Feudal Age research by each player, one
+of which is cancelled (unqueued) and researched again. The offset of every action and sync is kept, so
+the exact action counts and game time of any prefix (e.g. a truncated
+copy) are known.
+"""
+
+import bisect
+import math
+import random
+import struct
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from mgz.fast import Action, Operation
+
+# Feudal Age technology id and research time, and the SPECIAL order id of
+# unqueueing (as in apm_accumulators.AGE_TECHNOLOGIES and UNQUEUE_ORDER)
+FEUDAL_AGE = 101
+FEUDAL_RESEARCH_MS = 130 * 1000
+UNQUEUE_ORDER = 4
+
+
+def _sync(increment, current_time=None):
+    if current_time is None:
+        return struct.pack('<II', Operation.SYNC.value, increment)
+    values = [0] * 88
+    for player in range(3):
+        values[player * 11 + 1] = 1000
+        values[player * 11 + 3] = 50
+        values[player * 11 + 8] = player
+    return (struct.pack('<III', Operation.SYNC.value, increment, 0)
+            + struct.pack('<88I', *values) + struct.pack('<I', current_time))
+
+
+def _action(action_type, player, payload, sequence):
+    action_bytes = bytes([player]) + struct.pack('<h', len(payload)) + payload
+    return (struct.pack('<IIB', Operation.ACTION.value, len(action_bytes) + 1, action_type.value)
+            + action_bytes + struct.pack('<I', sequence))
+
+
+def _research(building_id, technology_id):
+    return struct.pack('<Ihh5xI', building_id, 1, technology_id, building_id)
+
+
+def _unqueue(building_id):
+    return struct.pack('<Iiff4xh2xh2xI', 1, -1, 0.0, 0.0, 0, UNQUEUE_ORDER, building_id)
+
+
+@dataclass
+class SyntheticBody:
+    """A synthetic body and where its actions and syncs end."""
+
+    data: bytes
+    # (end offset, player number) of each action
+    actions: List[Tuple[int, int]]
+    # (end offset, game time in ms after it) of each sync
+    syncs: List[Tuple[int, int]]
+    # (start ms, name) of each age reached per player, after the Dark Age
+    ages: Dict[int, List[Tuple[int, str]]] = field(default_factory=dict)
+
+    def truth(self, length: Optional[int] = None) -> Tuple[Dict[int, int], int]:
+        """
+        Get the exact action counts and game time of a prefix of the body.
+
+        Args:
+            length: Prefix length in bytes (default: the whole body)
+
+        Returns:
+            Tuple of (action counts by player number, game time in ms)
+        """
+        length = len(self.data) if length is None else length
+        counts: Dict[int, int] = {}
+        for end, player in self.actions:
+            if end > length:
+                break
+            counts[player] = counts.get(player, 0) + 1
+
+        index = bisect.bisect_right([end for end, _ in self.syncs], length)
+        duration_ms = self.syncs[index - 1][1] if index else 0
+        return counts, duration_ms
+
+    def apm(self) -> Dict[int, float]:
+        """Get each player's exact APM over the whole body."""
+        counts, duration_ms = self.truth()
+        return {player: count / (duration_ms / 60000) for player, count in counts.items()}
+
+
+def synthetic_body(minutes: float, seed: int, base_apm: Tuple[int, int] = (60, 100)) -> SyntheticBody:
+    """
+    Build a DE-style 1v1 body whose APM rises over the game, with bursts.
+
+    Args:
+        minutes: Game length
+        seed: Random seed
+        base_apm: Average APM of players 1 and 2
+
+    Returns:
+        SyntheticBody
+    """
+    rng = random.Random(seed)
+    out = []
+    offset = 0
+    actions = []
+    syncs = []
+    time_ms = sequence = tick = 0
+    length_ms = minutes * 60000
+
+    # Player 1 researches Feudal Age, unqueues it and researches it again
+    # after the first research would have finished (in games over 7
+    # minutes); player 2 researches it once. Events are (game time, player,
+    # type, payload).
+    events = [
+        (length_ms * 0.10, 1, Action.RESEARCH, _research(1001, FEUDAL_AGE)),
+        (length_ms * 0.12, 1, Action.SPECIAL, _unqueue(1001)),
+        (length_ms * 0.15, 2, Action.RESEARCH, _research(1002, FEUDAL_AGE)),
+        (length_ms * 0.40, 1, Action.RESEARCH, _research(1001, FEUDAL_AGE)),
+    ]
+    research_ms = {1: length_ms * 0.40, 2: length_ms * 0.15}
+
+    def emit(data):
+        nonlocal offset
+        out.append(data)
+        offset += len(data)
+        return offset
+
+    while time_ms < length_ms:
+        time_ms += 250
+        tick += 1
+        syncs.append((emit(_sync(250, time_ms if tick % 20 == 0 else None)), time_ms))
+        emit(struct.pack('<IffI', Operation.VIEWLOCK.value, 1.0, 2.0, 0))
+
+        for player, player_apm in zip((1, 2), base_apm):
+            burst = 1.8 if (time_ms // 20000) % 7 == 0 else 1.0
+            expected = player_apm * (0.5 + time_ms / length_ms) * burst / 60000 * 250
+            # Poisson-distributed number of actions this tick
+            count, p, cumulative, u = 0, math.exp(-expected), math.exp(-expected), rng.random()
+            while u > cumulative:
+                count += 1
+                p *= expected / count
+                cumulative += p
+            for _ in range(count):
+                selected = rng.randint(1, 12)
+                payload = struct.pack('<4x2fh6x', 10.0, 20.0, selected) + struct.pack(f'<{selected}I', *range(selected))
+                sequence += 1
+                actions.append((emit(_action(Action.MOVE, player, payload, sequence)), player))
+
+        while events and events[0][0] <= time_ms:
+            _, player, action_type, payload = events.pop(0)
+            sequence += 1
+            actions.append((emit(_action(action_type, player, payload, sequence)), player))
+
+    syncs.append((emit(_sync(100)), time_ms + 100))
+
+    # Research actions are timestamped at the end of their tick
+    ages = {}
+    for player, start in research_ms.items():
+        tick_end = math.ceil(start / 250) * 250
+        ages[player] = [(tick_end + FEUDAL_RESEARCH_MS, 'Feudal Age')]
+    return SyntheticBody(b''.join(out), actions, syncs, ages)
@@ -203,6 +203,33 @@ def example_8_error_handling():
             print(f"  ✗ Unexpected error: {e}")
 
 
+def example_9_cross_game_matchups():
+    """Example 9: Head-to-head and civ matchup statistics across games"""
+    print("\nExample 9: Cross-Game Matchups")
+    print("-" * 50)
+
+    from apm_stats import MatchupIndex
+
+    # Build the index once from batch output, then query it repeatedly
+    # (created with: apm_cli.py records/ --batch --format json --output all_results.json)
+    index = MatchupIndex.from_json_file('all_results.json')
+    print(f"Indexed {index.game_count} games, {len(index.players())} players")
+
+    record = index.head_to_head('TheViper', 'Hera')
+    if record['games']:
+        print(f"\nTheViper vs Hera: {record['player1_wins']}-{record['player2_wins']} "
+              f"in {record['games']} game(s)")
+        print(f"  Median APM difference: {record['apm_delta']['median']:.2f}")
+
+    matchup = index.civ_matchup('Aztecs', 'Mayans')
+    if matchup['games']:
+        print(f"\nAztecs vs Mayans: {matchup['civ1_win_rate']} win rate "
+              f"over {matchup['games']} game(s)")
+        for bucket in matchup['win_rate_by_apm_delta']:
+            print(f"  APM advantage {bucket['apm_delta_from']:+d} to {bucket['apm_delta_to']:+d}: "
+                  f"{bucket['win_rate']:.1%} ({bucket['games']} games)")
+
+
 if __name__ == '__main__':
     print("AOE2 Record APM Analyzer - Examples")
     print("=" * 50)
@@ -221,6 +248,7 @@ if __name__ == '__main__':
     # example_6_filter_by_civilization()
     # example_7_custom_output()
     # example_8_error_handling()
+    # example_9_cross_game_matchups()
 
     print("\nExamples are ready to use!")
     print("Edit this file to uncomment and run specific examples.")
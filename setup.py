@@ -17,10 +17,14 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/yourusername/aoe2-apm-analyzer",
-    py_modules=['apm_analyzer', 'apm_cli'],
+    py_modules=['apm_analyzer', 'apm_cli', 'apm_prefetch', 'apm_cache', 'apm_stats', 'apm_scheduler', 'apm_decoder', 'apm_watch', 'apm_accumulators', 'apm_reference', 'apm_preload', 'apm_store', 'apm_sampling', 'apm_versions', 'apm_output', 'apm_async', 'apm_metrics'],
     install_requires=[
         'mgz>=1.8.0',
     ],
+    extras_require={
+        # File events instead of polling in watch mode (Linux)
+        'watch': ['inotify_simple'],
+    },
     python_requires='>=3.7',
     entry_points={
         'console_scripts': [